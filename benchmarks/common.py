@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: common.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to share the helpers of the benchmark scripts: the ORCID
+# iD generator, the latency statistics, a throwaway data directory with a
+# SQLite database and an in-process SMTP server that accepts and counts the
+# emails of the voting app.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import random
+import re
+import socketserver
+import sys
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+# The root directory of the repository, added to the import path so the scripts can import the app
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+# Regular expressions to extract the CSRF token and the result of a vote
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+RESULT_PATTERN = re.compile(r"<h4>(.*?)</h4>")
+
+
+def random_orcid(rng: random.Random) -> str:
+    """Returns a random ORCID iD with a valid check character."""
+    # Imported here, the app reads its data directory when it is first imported and the scripts set it after importing this module
+    from sees_voting_app.eligibility import orcid_checksum
+
+    digits = "".join(str(rng.randrange(10)) for _ in range(15))
+    digits += orcid_checksum(digits)
+    return "-".join(digits[i : i + 4] for i in range(0, 16, 4))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Returns the given percentile of a list of values, in milliseconds."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+
+@dataclass
+class LoadStats:
+    """A class to collect the latencies and the outcomes of the requests."""
+
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    outcomes: Dict[str, int] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, kind: str, latency: float, outcome: Optional[str] = None) -> None:
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            if outcome is not None:
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def report(self, duration: float) -> str:
+        lines = [f"{'Request':<28}{'Count':>8}{'Req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for kind, values in sorted(self.latencies.items()):
+            lines.append(
+                f"{kind:<28}{len(values):>8}{len(values) / duration:>10.1f}"
+                f"{percentile(values, 0.50):>10.1f}{percentile(values, 0.95):>10.1f}{percentile(values, 0.99):>10.1f}"
+            )
+        lines.append("")
+        lines.extend(f"{outcome:<32}{count:>8}" for outcome, count in sorted(self.outcomes.items()))
+        lines.append(f"{'Votes recorded per second':<32}{self.outcomes.get('vote recorded', 0) / duration:>8.1f}")
+        return "\n".join(lines)
+
+
+def prepare_data_dir(directory: Path, database_uri: Optional[str] = None, smtp_port: int = 25, candidates: int = 8) -> Path:
+    """Creates a data directory with a .env file, a candidates list and, by default, a SQLite database."""
+    directory.mkdir(parents=True, exist_ok=True)
+    database_uri = database_uri or f"sqlite:///{directory / 'votes.sqlite3'}"
+    (directory / ".env").write_text(
+        "\n".join(
+            [
+                'SECRET_KEY="benchmark"',
+                'ADMIN_API_TOKEN="benchmark"',
+                'MAIL_SERVER="127.0.0.1"',
+                f"MAIL_PORT={smtp_port}",
+                "MAIL_USE_TLS=",
+                'MAIL_SENDER_ADDRESS="sees@example.org"',
+                'ADMIN_MAILING_LIST=["admin@example.org"]',
+                f'DATABASE_URI="{database_uri}"',
+                "VOTING_ENDS=2099-12-31 23:59:59",
+                # All the simulated voters share one address
+                "RATE_LIMIT_IP_PER_MINUTE=0",
+                "",
+            ]
+        )
+    )
+    rows = ["name,bio_url"] + [f"Candidate {i},https://example.org/bio_{i}" for i in range(1, candidates + 1)]
+    (directory / "candidates.csv").write_text("\n".join(rows) + "\n")
+    return directory
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP to accept the emails of smtplib and count them."""
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        self.reply("220 localhost benchmark SMTP sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode(errors="replace").upper()
+            if command in ("HELO", "EHLO"):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.received()
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """An in-process SMTP server that accepts and counts the emails, on a free local port."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def received(self) -> None:
+        with self._lock:
+            self.messages += 1
+
+    def start(self) -> "SmtpSink":
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: db_backends.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to compare the vote submission throughput of the SQLite
+# mode with a MySQL server. For each database a gunicorn server with the
+# same number of workers is started on a throwaway data directory, loaded
+# with the simulated voters of load_profile.py, and the votes per second and
+# the latency of the submissions are reported side by side.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from common import LoadStats, SmtpSink, percentile, prepare_data_dir
+from load_profile import run_client, start_server
+
+
+def run_backend(name: str, database_uri: Optional[str], args: argparse.Namespace) -> Dict[str, float]:
+    """Loads a gunicorn server on the given database and returns its vote throughput and submission latencies."""
+    smtp_sink = SmtpSink().start()
+    work_dir = Path(tempfile.mkdtemp(prefix=f"sees-db-{name}-"))
+    data_dir = prepare_data_dir(work_dir / "data", database_uri, smtp_sink.port)
+    url = f"http://127.0.0.1:{args.port}/"
+    server = start_server(args.worker_class, args.workers, f"127.0.0.1:{args.port}", str(data_dir))
+    try:
+        stats = LoadStats()
+        deadline = time.perf_counter() + args.duration
+        clients = [
+            threading.Thread(target=run_client, args=(url, deadline, args.post_ratio, args.duplicate_ratio, args.seed + i, stats))
+            for i in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = time.perf_counter() - start
+        print(f"\n{name} ({args.workers} {args.worker_class} workers)")
+        print(stats.report(duration))
+    finally:
+        server.terminate()
+        server.wait()
+        smtp_sink.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    submissions = stats.latencies.get("POST new", [])
+    return {
+        "votes_per_second": stats.outcomes.get("vote recorded", 0) / duration,
+        "p50_ms": percentile(submissions, 0.50) if submissions else 0.0,
+        "p99_ms": percentile(submissions, 0.99) if submissions else 0.0,
+        # The failed submissions and the connection errors, the rejected duplicates are expected
+        "errors": sum(count for outcome, count in stats.outcomes.items() if outcome.startswith("POST ")) + len(stats.latencies.get("error", [])),
+    }
+
+
+def main() -> None:
+    """Main entry point of the database comparison."""
+    parser = argparse.ArgumentParser(description="SEES Voting App SQLite and MySQL comparison")
+    parser.add_argument("--mysql-uri", help="URI of a throwaway MySQL schema, only the SQLite mode is run without it.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of gunicorn workers of each server.")
+    parser.add_argument("--worker-class", choices=["sync", "gevent"], default="sync", help="Worker class of the servers.")
+    parser.add_argument("--clients", type=int, default=64, help="Number of concurrent simulated voters.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duration of each run in seconds.")
+    parser.add_argument("--post-ratio", type=float, default=0.5, help="Share of the requests that submit a vote.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05, help="Share of the votes that reuse an ORCID iD.")
+    parser.add_argument("--seed", type=int, default=2024, help="Seed of the simulated voters.")
+    parser.add_argument("--port", type=int, default=5050, help="Port of the started servers.")
+    args = parser.parse_args()
+
+    # The SQLite database is created in the throwaway data directory
+    backends = {"sqlite": None}
+    if args.mysql_uri:
+        backends["mysql"] = args.mysql_uri
+    results = {name: run_backend(name, database_uri, args) for name, database_uri in backends.items()}
+
+    print(f"\n{'Database':<12}{'Votes/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'Errors':>8}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['votes_per_second']:>10.1f}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: e2e.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to benchmark the voting app end to end in a single
+# process. It boots create_flask_app() against a throwaway SQLite database (or
+# the given database URI) and an in-process SMTP server, drives a mix of form
+# loads, new votes and duplicate ORCID iD and email submissions through the
+# Flask test client and reports the latency of each request kind and of each
+# stage of a vote, the votes per second and the email throughput.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import argparse
+import functools
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+from common import CSRF_PATTERN, RESULT_PATTERN, LoadStats, SmtpSink, prepare_data_dir, random_orcid
+
+
+def instrument(owner, name: str, stage: str, stats: LoadStats) -> None:
+    """Replaces a function of a class or module with a wrapper that records its duration as a stage."""
+    function = getattr(owner, name)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.record(f"stage: {stage}", time.perf_counter() - start)
+
+    setattr(owner, name, wrapper)
+
+
+def classify(body: str) -> str:
+    """Returns the outcome of a vote from the alert of the returned page."""
+    result = RESULT_PATTERN.search(body)
+    if result is None:
+        return "no alert"
+    if result.group(1) == "Vote Submitted Successfully":
+        return "vote recorded"
+    if "ORCID iD is already in use" in body:
+        return "duplicate ORCID iD rejected"
+    if "email address is already in use" in body:
+        return "duplicate email rejected"
+    return "vote rejected"
+
+
+def run_client(app, deadline: float, post_ratio: float, duplicate_ratio: float, seed: int, candidates: int, stats: LoadStats) -> None:
+    """Runs a simulated voter with its own session until the deadline."""
+    rng = random.Random(seed)
+    client = app.test_client()
+    token = None
+    voted: List[Tuple[str, str]] = []
+
+    while time.perf_counter() < deadline:
+        if token is None or rng.random() >= post_ratio:
+            # Load the voting form, the session cookie is kept by the test client
+            start = time.perf_counter()
+            response = client.get("/")
+            stats.record("GET /", time.perf_counter() - start, f"GET {response.status_code}")
+            match = CSRF_PATTERN.search(response.get_data(as_text=True))
+            token = match.group(1) if match else token
+            continue
+
+        # Submit a vote, some of them reuse the ORCID iD or the email of an earlier vote
+        orcid_id = random_orcid(rng)
+        email = f"{orcid_id}@example.org"
+        kind = "POST new"
+        if voted and rng.random() < duplicate_ratio:
+            previous_orcid_id, previous_email = rng.choice(voted)
+            if rng.random() < 0.5:
+                orcid_id, kind = previous_orcid_id, "POST duplicate ORCID iD"
+            else:
+                email, kind = previous_email, "POST duplicate email"
+        choices = rng.sample(range(1, candidates + 1), min(4, candidates))
+        data = {"csrf_token": token, "full_name": "Benchmark Voter", "email": email, "orcid_id": orcid_id}
+        for rank in range(4):
+            data[f"selection_{rank + 1}"] = f"Candidate {choices[rank]}" if rank < len(choices) and rng.random() < 0.8 else "None"
+        data["selection_1"] = f"Candidate {choices[0]}"
+
+        start = time.perf_counter()
+        response = client.post("/", data=data)
+        outcome = classify(response.get_data(as_text=True)) if response.status_code == 200 else f"POST {response.status_code}"
+        stats.record(kind, time.perf_counter() - start, outcome)
+        if outcome == "vote recorded":
+            voted.append((orcid_id, email))
+
+
+def main() -> None:
+    """Main entry point of the end-to-end benchmark."""
+    parser = argparse.ArgumentParser(description="SEES Voting App end-to-end benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent simulated voters.")
+    parser.add_argument("--duration", type=float, default=20.0, help="Duration of the test in seconds.")
+    parser.add_argument("--post-ratio", type=float, default=0.5, help="Share of the requests that submit a vote.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05, help="Share of the votes that reuse an ORCID iD or an email.")
+    parser.add_argument("--candidates", type=int, default=8, help="Number of candidates on the ballot.")
+    parser.add_argument("--database-uri", help="Database to use instead of a throwaway SQLite file, e.g. a MySQL test schema.")
+    parser.add_argument("--group-commit-ms", type=float, default=0.0, help="Group-commit window of the votes, 0 commits every vote on its own.")
+    parser.add_argument("--seed", type=int, default=2024, help="Seed of the simulated voters.")
+    parser.add_argument("--keep", action="store_true", help="Keep the data directory of the run.")
+    args = parser.parse_args()
+
+    # The app reads its configuration at import, so the data directory and the SMTP server come first
+    smtp_sink = SmtpSink().start()
+    work_dir = Path(tempfile.mkdtemp(prefix="sees-e2e-"))
+    data_dir = prepare_data_dir(work_dir / "data", args.database_uri, smtp_sink.port, args.candidates)
+    os.environ["DATA_DIR"] = str(data_dir)
+    os.environ["DB_GROUP_COMMIT_MS"] = str(args.group_commit_ms)
+    os.chdir(work_dir)
+
+    from sees_voting_app import create_flask_app, mail_outbox, routes
+    from sees_voting_app.voting_system import VotingSystem
+
+    app = create_flask_app()
+    stats = LoadStats()
+    instrument(VotingSystem, "record_vote_to_db", "database insert", stats)
+    instrument(VotingSystem, "record_vote", "journal and log", stats)
+    instrument(routes, "send_vote_to_admin_group", "mail enqueue", stats)
+    instrument(routes, "render_template", "render", stats)
+    mail_outbox.start()
+
+    try:
+        deadline = time.perf_counter() + args.duration
+        clients = [
+            threading.Thread(
+                target=run_client, args=(app, deadline, args.post_ratio, args.duplicate_ratio, args.seed + i, args.candidates, stats)
+            )
+            for i in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        duration = time.perf_counter() - start
+        print(stats.report(duration))
+
+        # Wait until the outbox has delivered the admin notification of every recorded vote
+        expected = stats.outcomes.get("vote recorded", 0)
+        start = time.perf_counter()
+        while smtp_sink.messages < expected and time.perf_counter() - start < 60:
+            time.sleep(0.05)
+        drain = time.perf_counter() - start
+        print(f"{'Emails delivered':<32}{smtp_sink.messages:>8}")
+        print(f"{'Emails per second':<32}{smtp_sink.messages / (duration + drain):>8.1f}")
+        print(f"{'Outbox drain after the load':<32}{drain:>7.1f}s")
+    finally:
+        smtp_sink.shutdown()
+        if args.keep:
+            print(f"The data directory is kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
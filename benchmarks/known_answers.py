@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: known_answers.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to check the counting methods of tally.py against small
+# elections with known results: the single transferable vote with Gregory
+# and Meek transfers, and the tie-break rules of the instant-runoff count.
+# The elected and eliminated candidates of every round and the final quota
+# are compared with the expected ones, a mismatch fails the run.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+from common import prepare_data_dir
+
+
+# The food election of the Wikipedia article on the single transferable vote, 20 ballots for 3 seats
+FOOD_CANDIDATES = ("Oranges", "Pears", "Chocolate", "Strawberries", "Sweets", "Hamburger")
+FOOD_BALLOTS = [
+    (4, ("Oranges",)),
+    (2, ("Pears", "Oranges")),
+    (8, ("Chocolate", "Strawberries")),
+    (4, ("Chocolate", "Sweets")),
+    (1, ("Strawberries",)),
+    (1, ("Sweets",)),
+]
+
+# The elections and their known results, the quota is the one of the last round
+ELECTIONS: List[Dict[str, Any]] = [
+    {
+        "name": "Food, Gregory transfers",
+        "method": "stv",
+        "seats": 3,
+        "candidates": FOOD_CANDIDATES,
+        "ballots": FOOD_BALLOTS,
+        "elected": ["Chocolate", "Oranges", "Strawberries"],
+        "eliminated": ["Hamburger", "Pears", "Sweets"],
+        "quota": 6.0,
+    },
+    {
+        # The quota follows the continuing votes, the surplus of Strawberries is exhausted and the quota converges to 33/7
+        "name": "Food, Meek transfers",
+        "method": "meek",
+        "seats": 3,
+        "candidates": FOOD_CANDIDATES,
+        "ballots": FOOD_BALLOTS,
+        "elected": ["Chocolate", "Strawberries", "Oranges"],
+        "eliminated": ["Hamburger", "Pears"],
+        "quota": 4.71429,
+    },
+    {
+        # B and C tie for the last place in round 2, C has fewer first preferences and is eliminated
+        "name": "Instant runoff, first-preference tie-break",
+        "method": "irv",
+        "seats": 1,
+        "candidates": ("A", "B", "C", "D"),
+        "ballots": [(6, ("A",)), (4, ("B",)), (3, ("C", "A")), (1, ("D", "C"))],
+        "elected": ["A"],
+        "eliminated": ["D", "C"],
+        "quota": None,
+    },
+    {
+        # A and B tie on every count, the candidate listed first is eliminated
+        "name": "Instant runoff, candidates order tie-break",
+        "method": "irv",
+        "seats": 1,
+        "candidates": ("A", "B"),
+        "ballots": [(2, ("A",)), (2, ("B",))],
+        "elected": ["B"],
+        "eliminated": ["A"],
+        "quota": None,
+    },
+]
+
+
+def count_election(election: Dict[str, Any]) -> Dict[str, Any]:
+    """Counts an election and returns its elected and eliminated candidates, in order, and the quota of its last round."""
+    from sees_voting_app.tally import RANKS, REPORT_DECIMALS, encode_ballots, instant_runoff, single_transferable_vote
+
+    candidates = election["candidates"]
+    # The ranks left empty are "None", as in the votes table
+    rows = [[*ranking, *["None"] * (RANKS - len(ranking))] for count, ranking in election["ballots"] for _ in range(count)]
+    ballots = encode_ballots(rows, candidates)
+    if election["method"] == "irv":
+        rounds = instant_runoff(ballots, len(candidates))
+    else:
+        transfers = "meek" if election["method"] == "meek" else "gregory"
+        rounds = single_transferable_vote(ballots, len(candidates), seats=election["seats"], transfers=transfers)
+    return {
+        "elected": [candidates[tally_round.elected] for tally_round in rounds if tally_round.elected is not None],
+        "eliminated": [candidates[tally_round.eliminated] for tally_round in rounds if tally_round.eliminated is not None],
+        "quota": round(rounds[-1].quota, REPORT_DECIMALS) if rounds[-1].quota is not None else None,
+    }
+
+
+def main() -> None:
+    """Main entry point of the known-answer checks."""
+    parser = argparse.ArgumentParser(description="SEES Voting App known-answer checks of the counting methods")
+    parser.parse_args()
+
+    # The app reads its configuration at import, so the data directory comes first
+    work_dir = Path(tempfile.mkdtemp(prefix="sees-known-answers-"))
+    data_dir = prepare_data_dir(work_dir / "data")
+    os.environ["DATA_DIR"] = str(data_dir)
+    os.chdir(work_dir)
+    try:
+        results = [(election, count_election(election)) for election in ELECTIONS]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failures = []
+    print(f"{'Election':<48}{'Result':>8}")
+    for election, result in results:
+        expected = {key: election[key] for key in ("elected", "eliminated", "quota")}
+        passed = result == expected
+        print(f"{election['name']:<48}{'ok' if passed else 'FAILED':>8}")
+        if not passed:
+            failures.append(f"{election['name']}: expected {expected}, counted {result}")
+
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
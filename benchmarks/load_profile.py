@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: load_profile.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to load test a running voting app, or a gunicorn server
+# started by this script with a given worker class. Each simulated client
+# loads the voting form, keeps its session cookie and CSRF token, and submits
+# votes, a share of them with an ORCID iD that has already voted. The script
+# reports the throughput and the latency percentiles of each request kind.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from common import CSRF_PATTERN, RESULT_PATTERN, ROOT_DIR, LoadStats, random_orcid
+
+
+def run_client(url: str, deadline: float, post_ratio: float, duplicate_ratio: float, seed: int, stats: LoadStats) -> None:
+    """Runs a simulated voter until the deadline."""
+    rng = random.Random(seed)
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    path = parts.path or "/"
+    cookie: Optional[str] = None
+    token: Optional[str] = None
+    voted: List[Tuple[str, str]] = []
+
+    while time.perf_counter() < deadline:
+        try:
+            if token is None or rng.random() >= post_ratio:
+                # Load the voting form
+                headers = {"Cookie": cookie} if cookie else {}
+                start = time.perf_counter()
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read().decode()
+                stats.record("GET /", time.perf_counter() - start, f"GET {response.status}")
+                cookie = (response.getheader("Set-Cookie") or "").split(";")[0] or cookie
+                match = CSRF_PATTERN.search(body)
+                token = match.group(1) if match else token
+                continue
+
+            # Submit a vote, some of them reuse an ORCID iD and an email that already voted
+            if voted and rng.random() < duplicate_ratio:
+                orcid_id, email = rng.choice(voted)
+                kind = "POST duplicate"
+            else:
+                orcid_id = random_orcid(rng)
+                email = f"{orcid_id}@example.org"
+                kind = "POST new"
+            choices = rng.sample(range(1, 4), 2)
+            data = {
+                "csrf_token": token,
+                "full_name": "Load Test",
+                "email": email,
+                "orcid_id": orcid_id,
+                "selection_1": f"Candidate {choices[0]}",
+                "selection_2": f"Candidate {choices[1]}",
+                "selection_3": "None",
+                "selection_4": "None",
+            }
+            headers = {"Content-Type": "application/x-www-form-urlencoded", "Cookie": cookie or ""}
+            start = time.perf_counter()
+            connection.request("POST", path, body=urlencode(data), headers=headers)
+            response = connection.getresponse()
+            body = response.read().decode()
+            result = RESULT_PATTERN.search(body)
+            if response.status == 200 and result and result.group(1) == "Vote Submitted Successfully":
+                outcome = "vote recorded"
+                voted.append((orcid_id, email))
+            elif response.status == 200 and result:
+                outcome = "vote rejected"
+            else:
+                outcome = f"POST {response.status}"
+            stats.record(kind, time.perf_counter() - start, outcome)
+        except (OSError, http.client.HTTPException) as e:
+            stats.record("error", 0.0, type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+
+def start_server(worker_class: str, workers: Optional[int], bind: str, data_dir: Optional[str]) -> subprocess.Popen:
+    """Starts a gunicorn server with the given worker class and waits until it accepts requests."""
+    environment = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_BIND=bind)
+    if workers:
+        environment["GUNICORN_WORKERS"] = str(workers)
+    if data_dir:
+        environment["DATA_DIR"] = data_dir
+    (ROOT_DIR / "logs").mkdir(exist_ok=True)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "sees_voting_app/gunicorn_config.py", "voting_app:app"], cwd=ROOT_DIR, env=environment
+    )
+    host, port = bind.rsplit(":", 1)
+    for _ in range(300):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1" if host == "0.0.0.0" else host, int(port), timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The gunicorn server did not start.")
+
+
+def main() -> None:
+    """Main entry point of the load test."""
+    parser = argparse.ArgumentParser(description="SEES Voting App load profile")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/", help="URL of the voting form.")
+    parser.add_argument("--clients", type=int, default=64, help="Number of concurrent simulated voters.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duration of the test in seconds.")
+    parser.add_argument("--post-ratio", type=float, default=0.5, help="Share of the requests that submit a vote.")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05, help="Share of the votes that reuse an ORCID iD.")
+    parser.add_argument("--seed", type=int, default=2024, help="Seed of the simulated voters.")
+    parser.add_argument("--serve", choices=["sync", "gevent"], help="Start a gunicorn server with this worker class first.")
+    parser.add_argument("--workers", type=int, help="Number of workers of the started server.")
+    parser.add_argument("--data-dir", help="Data directory (.env, candidates.csv) of the started server.")
+    args = parser.parse_args()
+
+    server = None
+    if args.serve:
+        parts = urlsplit(args.url)
+        server = start_server(args.serve, args.workers, f"{parts.hostname}:{parts.port or 80}", args.data_dir)
+
+    try:
+        stats = LoadStats()
+        deadline = time.perf_counter() + args.duration
+        clients = [
+            threading.Thread(target=run_client, args=(args.url, deadline, args.post_ratio, args.duplicate_ratio, args.seed + i, stats))
+            for i in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        print(stats.report(time.perf_counter() - start))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: micro.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to run the microbenchmarks of the voting app hot paths:
+# combine_results, VotingSystem.generate_candidates_list and
+# Voter.prepare_data. The results are compared with the baselines stored in
+# baselines.json, a benchmark slower than its baseline by more than the
+# tolerance is reported as a regression and fails the run.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from common import prepare_data_dir, random_orcid
+
+
+# The stored baselines, next to this file
+BASELINES_PATH = Path(__file__).resolve().parent / "baselines.json"
+
+
+def measure(function: Callable[[], None], number: int, repeat: int, setup: Optional[Callable[[], None]] = None) -> Dict[str, float]:
+    """Returns the best and the median time of a call, in microseconds, over the repeats."""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {"best_us": round(min(timings), 3), "median_us": round(statistics.median(timings), 3)}
+
+
+def write_ballots(data_dir: Path, votes: int, legacy_files: int) -> None:
+    """Writes the ballots of a run to the journal and, for the oldest ones, to per-vote CSV files."""
+    from sees_voting_app.journal import BallotJournal
+    from sees_voting_app.utils import RESULTS_HEADER
+    from sees_voting_app.voting_system import Voter
+
+    rng = random.Random(2024)
+    journal = BallotJournal(_directory=data_dir / "journal", _fsync_interval=0)
+    for i in range(votes):
+        orcid_id = random_orcid(rng)
+        selections = [f"Candidate {candidate}" for candidate in rng.sample(range(1, 9), 4)]
+        if i < legacy_files:
+            with open(data_dir / f"{orcid_id}_2024.03.01_12.00.{i % 60:02d}.csv", "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(RESULTS_HEADER)
+                writer.writerow(["Benchmark Voter", f"{orcid_id}@example.org", orcid_id, *selections])
+            continue
+        voter = Voter()
+        journal.append(
+            {
+                "ballot_id": voter.ballot_id,
+                "timestamp": voter.timestamp.isoformat(timespec="microseconds"),
+                "full_name": "Benchmark Voter",
+                "email": f"{orcid_id}@example.org",
+                "orcid_id": orcid_id,
+                "selections": selections,
+            },
+            wait=i == votes - 1,
+        )
+
+
+def run_benchmarks(data_dir: Path, votes: int, legacy_files: int) -> Dict[str, Dict[str, float]]:
+    """Runs the microbenchmarks and returns their timings."""
+    from sees_voting_app.utils import combine_results
+    from sees_voting_app.voting_system import Voter, VotingSystem, candidate_registry
+
+    write_ballots(data_dir, votes, legacy_files)
+
+    def remove_results() -> None:
+        for name in ("responses.csv", "responses.manifest.json"):
+            (data_dir / name).unlink(missing_ok=True)
+
+    results = {}
+    results[f"combine_results[{votes} votes]"] = measure(lambda: combine_results(), number=1, repeat=5, setup=remove_results)
+    results["combine_results[incremental, no new votes]"] = measure(lambda: combine_results(incremental=True), number=1, repeat=5)
+
+    voting_system = VotingSystem()
+    results["VotingSystem.generate_candidates_list"] = measure(voting_system.generate_candidates_list, number=10000, repeat=7)
+
+    candidates = candidate_registry.candidates_by_name
+    voter = Voter()
+    voter.full_name, voter.email, voter.orcid_id = "Benchmark Voter", "voter@example.org", "0000-0002-1825-0097"
+    voter.selection_1, voter.selection_2, voter.selection_3, voter.selection_4 = "Candidate 1", "Candidate 2", "Candidate 3", "None"
+
+    def prepare_data() -> None:
+        voter.selections_list.clear()
+        voter.prepare_data(candidates)
+
+    results["Voter.prepare_data"] = measure(prepare_data, number=10000, repeat=7)
+    return results
+
+
+def main() -> None:
+    """Main entry point of the microbenchmarks."""
+    parser = argparse.ArgumentParser(description="SEES Voting App microbenchmarks")
+    parser.add_argument("--votes", type=int, default=20000, help="Number of ballots merged by combine_results.")
+    parser.add_argument("--legacy-files", type=int, default=2000, help="Number of those ballots stored as per-vote CSV files.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown over the baseline, 0.25 is 25%%.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baselines.")
+    args = parser.parse_args()
+
+    # The app reads its configuration at import, so the data directory comes first
+    work_dir = Path(tempfile.mkdtemp(prefix="sees-micro-"))
+    data_dir = prepare_data_dir(work_dir / "data")
+    os.environ["DATA_DIR"] = str(data_dir)
+    os.chdir(work_dir)
+    try:
+        results = run_benchmarks(data_dir, args.votes, args.legacy_files)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baselines = json.loads(BASELINES_PATH.read_text()) if BASELINES_PATH.exists() else {}
+    regressions = []
+    print(f"{'Benchmark':<48}{'best us':>14}{'median us':>14}{'baseline us':>14}{'change':>10}")
+    for name, result in results.items():
+        baseline = baselines.get(name, {}).get("median_us")
+        change = f"{result['median_us'] / baseline - 1:>+10.0%}" if baseline else f"{'-':>10}"
+        print(f"{name:<48}{result['best_us']:>14.1f}{result['median_us']:>14.1f}{baseline or 0:>14.1f}{change}")
+        if baseline and result["median_us"] > baseline * (1 + args.tolerance):
+            regressions.append(name)
+
+    if args.save_baseline:
+        BASELINES_PATH.write_text(json.dumps(results, indent=4) + "\n")
+        print(f"The baselines are stored in {BASELINES_PATH}")
+    elif regressions:
+        print(f"Regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,38 @@
 # -----------------------------------------------------------------------------
 # Purpose:
 # This is the main entry point for the sees-voting-app. This file is used to
-# configure the Flask app and initialize the Mail instance.
+# configure the Flask app and initialize the Mail instance and the mail outbox.
 #
 # Copyright (C) 2024 GSECARS, The University of Chicago, USA
 # This software is distributed under the terms of the MIT license.
 # -----------------------------------------------------------------------------
 
 import logging
-from flask import Flask
+import time
+from flask import Flask, g, request
 from flask_mailman import Mail
-from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from sees_voting_app.config import Config, MailConfig, initialize_db
+from sees_voting_app.admission import AdmissionControl
+from sees_voting_app.config import Base, Config, MailConfig, data_dir, engine_registry
+from sees_voting_app.log_pipeline import LogPipeline
+from sees_voting_app.mail_queue import MailOutbox
+from sees_voting_app.metrics import metrics
+from sees_voting_app.page_cache import static_url
+from sees_voting_app.profiler import ProfilerMiddleware
 
 
 __all__ = ["create_flask_app"]
 
 
+# The seconds between two updates of the connection pool metrics of a worker
+POOL_METRICS_INTERVAL = 1.0
+
 # Create a Mail instance
 mail = Mail()
+# Create the mail outbox, the emails are sent by a background thread of each worker
+mail_outbox = MailOutbox(_path=data_dir / "mail_outbox.sqlite3")
 # Get the sender address and admin mailing list
 mail_config = MailConfig()
 sender_address = mail_config.sender_address
@@ -32,23 +44,33 @@ admin_mailing_list = mail_config.admin_mailing_list
 # Set the voting period end date
 voting_ends = Config.VOTING_ENDS
 
-# Initialize the database
-db_config, db_engine, db_session, Base = initialize_db()
+# Limit the vote submissions, the limits are shared by all the workers
+admission_control = AdmissionControl(
+    _directory=data_dir / "admission",
+    _ip_per_minute=Config.RATE_LIMIT_IP_PER_MINUTE,
+    _orcid_per_minute=Config.RATE_LIMIT_ORCID_PER_MINUTE,
+    _max_in_flight=Config.MAX_VOTES_IN_FLIGHT,
+)
+
+# Get the session registry of the database, the engine is created on first use
+db_session = engine_registry.session
 
 # Create the logs directory if it doesn't exist
 Path("logs").mkdir(exist_ok=True)
+# Create the log pipeline, the log files are written by the gunicorn master only
+log_pipeline = LogPipeline(_directory=Path("logs"), _queue_size=Config.LOG_QUEUE_SIZE)
 # Set up vote logging
 vote_logger = logging.getLogger("vote")
 vote_logger.setLevel(logging.INFO)
-vote_handler = RotatingFileHandler("logs/sees_voting_app.log", maxBytes=512 * 1024 * 1024, backupCount=1000000)
-vote_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
-vote_logger.addHandler(vote_handler)
+log_pipeline.attach(vote_logger)
 # Set up flask logging
 flask_logger = logging.getLogger("werkzeug")
 flask_logger.setLevel(logging.INFO)
-flask_handler = RotatingFileHandler("logs/flask.log", maxBytes=512 * 1024 * 1024, backupCount=1000000)
-flask_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
-flask_logger.addHandler(flask_handler)
+log_pipeline.attach(flask_logger)
+# Set up mail outbox logging
+mail_logger = logging.getLogger("mail")
+mail_logger.setLevel(logging.INFO)
+log_pipeline.attach(mail_logger)
 
 
 def create_flask_app(config_class=Config) -> Flask:
@@ -62,15 +84,76 @@ def create_flask_app(config_class=Config) -> Flask:
 
     # Initialize the Mail instance
     mail.init_app(app)
-
-    # Create all tables in the database
-    Base.metadata.create_all(bind=db_engine)
+    mail_outbox.init_app(app, mail)
+
+    # Create all tables in the database, the models are registered when the voting system is imported
+    from sees_voting_app.voting_system import VotingSystem
+
+    Base.metadata.create_all(bind=engine_registry.engine)
+
+    # Create the rows of the live vote tallies
+    VotingSystem().seed_tallies()
+
+    # Build the voter index if the gunicorn master has not built it, e.g. in debug mode
+    VotingSystem().warm_voter_index(only_if_missing=True)
+
+    # Use content-hashed URLs for the static files, the versioned URLs can be cached by the browsers
+    app.add_template_global(static_url)
+
+    # The time the connection pool state of this worker was last published
+    pool_published_at = float("-inf")
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        nonlocal pool_published_at
+        labels = {"endpoint": request.endpoint or "none", "method": request.method}
+        metrics.observe("sees_request_duration_seconds", time.perf_counter() - g.request_start, labels)
+        # Publish the connection pool state of this worker, at most once per interval
+        if g.request_start - pool_published_at < POOL_METRICS_INTERVAL:
+            return response
+        pool_published_at = g.request_start
+        status = engine_registry.pool_status()
+        metrics.set("sees_db_pool_checked_out", status.get("checked_out", 0))
+        metrics.set("sees_db_pool_overflow", status.get("overflow", 0))
+        metrics.set_total("sees_db_pool_checkouts_total", status["checkouts"])
+        metrics.set_total("sees_db_pool_checkout_timeouts_total", status["checkout_timeouts"])
+        metrics.set_total("sees_db_pool_wait_seconds_total", status["wait_time_total_ms"] / 1000)
+        return response
+
+    @app.after_request
+    def cache_static_files(response):
+        if request.endpoint == "static" and request.args.get("v"):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config["STATIC_MAX_AGE"]
+            response.cache_control.immutable = True
+        return response
 
     # Import and register the voting blueprint
     from sees_voting_app.routes import voting
 
     app.register_blueprint(voting)
 
+    # Profile the requests with the admin profiling header, or a random share of the requests
+    if app.config["ADMIN_API_TOKEN"] or app.config["PROFILE_SAMPLE_RATE"] > 0:
+        app.wsgi_app = ProfilerMiddleware(
+            _wsgi_app=app.wsgi_app,
+            _directory=Path("logs") / "profiles",
+            _token=app.config["ADMIN_API_TOKEN"],
+            _sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+            _min_duration=app.config["PROFILE_MIN_DURATION_MS"] / 1000,
+            _interval=app.config["PROFILE_INTERVAL_MS"] / 1000,
+            _max_per_minute=app.config["PROFILE_MAX_PER_MINUTE"],
+        )
+
+    # Take the client address from the X-Forwarded-For header set by the trusted reverse proxies
+    if app.config["TRUSTED_PROXIES"] > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+
     # Add a teardown app context to remove the database session after each request
     @app.teardown_appcontext
     def cleanup(response_or_exception):
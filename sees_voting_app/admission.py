@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: admission.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the admission control of the vote submissions.
+# Token buckets keyed by client IP and by ORCID iD limit the submission rate,
+# and a cap of the submissions in flight in all the workers sheds the load.
+# The state of both is kept in memory-mapped files shared by the gunicorn
+# workers, every update is made under an exclusive lock of the file.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Iterator, Optional, Tuple
+
+
+__all__ = ["AdmissionControl", "ConcurrencyLimiter", "RateLimiter"]
+
+
+# A token bucket: key hash, tokens left and time of the last update
+_BUCKET = struct.Struct("Qdd")
+# A worker of the concurrency cap: pid and submissions in flight
+_WORKER = struct.Struct("qq")
+# The buckets probed for a key before the least recently used one is replaced
+_PROBES = 8
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@dataclass
+class _SharedFile:
+    """A memory-mapped file of fixed size, opened again by every process and locked across processes and threads."""
+
+    _path: Path = field(compare=False, repr=False)
+    _size: int = field(compare=False, repr=False)
+    _file: Optional[IO[bytes]] = field(init=False, compare=False, repr=False, default=None)
+    _mmap: Optional[mmap.mmap] = field(init=False, compare=False, repr=False, default=None)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def _open(self) -> None:
+        # The lock of a file is shared by the processes that inherit it, so every process opens its own
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._path, "a+b")
+        if os.fstat(self._file.fileno()).st_size != self._size:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._file.fileno()).st_size != self._size:
+                    self._file.truncate(0)
+                    self._file.truncate(self._size)
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def locked(self) -> Iterator[mmap.mmap]:
+        """Returns the mapped file under an exclusive lock."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield self._mmap
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def clear(self) -> None:
+        """Resets the file to zeros."""
+        with self.locked() as shared:
+            shared[:] = bytes(self._size)
+
+
+@dataclass
+class RateLimiter:
+    """A class to keep token buckets in a shared hash table, a bucket that is not used for long is replaced."""
+
+    _path: Path = field(compare=False, repr=False)
+    _buckets: int = field(compare=False, repr=False, default=65536)
+    _file: Optional[_SharedFile] = field(init=False, compare=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        self._file = _SharedFile(_path=self._path, _size=self._buckets * _BUCKET.size)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # Zero marks an empty bucket
+        return struct.unpack("<Q", hashlib.blake2b(key.encode(), digest_size=8).digest())[0] | 1
+
+    def allow(self, key: str, per_minute: float) -> Tuple[bool, float]:
+        """Takes a token of the bucket of a key, returns False and the seconds until the next token if the bucket is empty.
+
+        A bucket holds up to per_minute tokens and is refilled at per_minute tokens per minute.
+        """
+        key_hash = self._hash(key)
+        rate, now = per_minute / 60, time.time()
+        start = key_hash % self._buckets
+        with self._file.locked() as buckets:
+            # Find the bucket of the key, or the least recently used of the probed buckets
+            position, oldest = None, None
+            for probe in range(_PROBES):
+                offset = (start + probe) % self._buckets * _BUCKET.size
+                bucket_hash, _, updated = _BUCKET.unpack_from(buckets, offset)
+                if bucket_hash == key_hash:
+                    position = offset
+                    break
+                if oldest is None or updated < oldest[1]:
+                    oldest = (offset, updated)
+            if position is None:
+                position = oldest[0]
+                tokens, updated = per_minute, now
+            else:
+                _, tokens, updated = _BUCKET.unpack_from(buckets, position)
+                tokens = min(per_minute, tokens + max(0.0, now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            _BUCKET.pack_into(buckets, position, key_hash, tokens, now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self) -> None:
+        self._file.clear()
+
+
+@dataclass
+class ConcurrencyLimiter:
+    """A class to cap the requests in flight in all the workers, every worker counts its own requests in a shared slot."""
+
+    _path: Path = field(compare=False, repr=False)
+    _limit: int = field(compare=False, repr=False, default=0)
+    _workers: int = field(compare=False, repr=False, default=256)
+    _file: Optional[_SharedFile] = field(init=False, compare=False, repr=False, default=None)
+    _slot: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _slot_pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        self._file = _SharedFile(_path=self._path, _size=self._workers * _WORKER.size)
+
+    def _own_slot(self, workers: mmap.mmap) -> int:
+        """Returns the slot of this process, a free slot or the slot of a process that is gone is claimed on first use."""
+        pid = os.getpid()
+        if self._slot_pid == pid:
+            return self._slot
+        free = None
+        for slot in range(self._workers):
+            slot_pid, _ = _WORKER.unpack_from(workers, slot * _WORKER.size)
+            if slot_pid == pid:
+                free = slot
+                break
+            if free is None and (slot_pid == 0 or not _alive(slot_pid)):
+                free = slot
+        if free is None:
+            raise RuntimeError("There is no free slot for this worker in the concurrency limiter.")
+        _WORKER.pack_into(workers, free * _WORKER.size, pid, 0)
+        self._slot, self._slot_pid = free, pid
+        return free
+
+    def acquire(self) -> bool:
+        """Counts a new request in flight, returns False if the cap is reached."""
+        with self._file.locked() as workers:
+            in_flight = sum(_WORKER.unpack_from(workers, slot * _WORKER.size)[1] for slot in range(self._workers))
+            if in_flight >= self._limit:
+                return False
+            offset = self._own_slot(workers) * _WORKER.size
+            pid, count = _WORKER.unpack_from(workers, offset)
+            _WORKER.pack_into(workers, offset, pid, count + 1)
+        return True
+
+    def release(self) -> None:
+        """Counts a request of this process out."""
+        with self._file.locked() as workers:
+            offset = self._own_slot(workers) * _WORKER.size
+            pid, count = _WORKER.unpack_from(workers, offset)
+            _WORKER.pack_into(workers, offset, pid, max(0, count - 1))
+
+    def remove_process(self, pid: int) -> None:
+        """Frees the slot of a process that exited, with the requests it had in flight."""
+        with self._file.locked() as workers:
+            for slot in range(self._workers):
+                if _WORKER.unpack_from(workers, slot * _WORKER.size)[0] == pid:
+                    _WORKER.pack_into(workers, slot * _WORKER.size, 0, 0)
+
+    def clear(self) -> None:
+        self._file.clear()
+
+
+@dataclass
+class AdmissionControl:
+    """A class to admit or shed the vote submissions before any form, database or mail work, a limit of 0 is disabled."""
+
+    _directory: Path = field(compare=False, repr=False)
+    _ip_per_minute: float = field(compare=False, repr=False, default=0.0)
+    _orcid_per_minute: float = field(compare=False, repr=False, default=0.0)
+    _max_in_flight: int = field(compare=False, repr=False, default=0)
+    _rate_limiter: Optional[RateLimiter] = field(init=False, compare=False, repr=False, default=None)
+    _concurrency_limiter: Optional[ConcurrencyLimiter] = field(init=False, compare=False, repr=False, default=None)
+
+    def __post_init__(self) -> None:
+        self._rate_limiter = RateLimiter(_path=self._directory / "rate_limits.bin")
+        self._concurrency_limiter = ConcurrencyLimiter(_path=self._directory / "in_flight.bin", _limit=self._max_in_flight)
+
+    def admit(self, client: str, orcid_id: str) -> Optional[Tuple[str, float]]:
+        """Admits a submission, returns the reason of the rejection and the seconds to wait if it is rejected.
+
+        An admitted submission holds a slot of the concurrency cap until release() is called.
+        """
+        if self._ip_per_minute > 0:
+            allowed, retry_after = self._rate_limiter.allow(f"ip:{client}", self._ip_per_minute)
+            if not allowed:
+                return "ip", retry_after
+        if self._orcid_per_minute > 0 and orcid_id:
+            allowed, retry_after = self._rate_limiter.allow(f"orcid:{orcid_id.strip().upper()}", self._orcid_per_minute)
+            if not allowed:
+                return "orcid_id", retry_after
+        if self._max_in_flight > 0 and not self._concurrency_limiter.acquire():
+            return "concurrency", 1.0
+        return None
+
+    def release(self) -> None:
+        """Releases the concurrency slot of an admitted submission."""
+        if self._max_in_flight > 0:
+            self._concurrency_limiter.release()
+
+    def remove_process(self, pid: int) -> None:
+        """Frees the concurrency slot of a worker that exited, called by the gunicorn master."""
+        if self._max_in_flight > 0:
+            self._concurrency_limiter.remove_process(pid)
+
+    def clear(self) -> None:
+        """Resets the buckets and the requests in flight of the previous run, called by the gunicorn master on start."""
+        self._rate_limiter.clear()
+        self._concurrency_limiter.clear()
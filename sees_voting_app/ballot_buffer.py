@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: ballot_buffer.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the write-behind buffer of the ballots. When the
+# database fails, or while the circuit breaker keeps the requests away from
+# it, the ballots are stored in a local SQLite database and a background
+# replayer thread adds them to the database in batches once it recovers.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sees_voting_app import vote_logger
+from sees_voting_app.database import DBException, DuplicateVoteException
+from sees_voting_app.metrics import metrics
+from sees_voting_app.voter_index import normalize_email
+
+
+__all__ = ["BallotBuffer", "CircuitBreaker"]
+
+
+@dataclass
+class CircuitBreaker:
+    """A class to keep the requests away from a failing database, a single trial call probes it after the reset timeout."""
+
+    _failure_threshold: int = field(compare=False, repr=False, default=3)
+    _reset_timeout: float = field(compare=False, repr=False, default=30.0)
+    _failures: int = field(init=False, compare=False, repr=False, default=0)
+    _opened_at: Optional[float] = field(init=False, compare=False, repr=False, default=None)
+    _trial_at: Optional[float] = field(init=False, compare=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    @property
+    def state(self) -> str:
+        """Returns closed, open or half_open."""
+        if self._opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self._opened_at < self._reset_timeout else "half_open"
+
+    def allow(self) -> bool:
+        """Returns True if a call may go to the database."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self._reset_timeout:
+                return False
+            # Let a single call probe the database, another one may try if the trial never reports back
+            if self._trial_at is not None and now - self._trial_at < self._reset_timeout:
+                return False
+            self._trial_at = now
+            return True
+
+    def record_success(self) -> None:
+        """Closes the breaker."""
+        with self._lock:
+            if self._opened_at is not None:
+                metrics.set("sees_db_breaker_open", 0)
+            self._failures, self._opened_at, self._trial_at = 0, None, None
+
+    def record_failure(self) -> None:
+        """Opens the breaker after the threshold of consecutive failures, or again after a failed trial."""
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self._failure_threshold:
+                self._opened_at, self._trial_at = time.monotonic(), None
+                metrics.set("sees_db_breaker_open", 1)
+
+
+@dataclass
+class BallotBuffer:
+    """A class to durably buffer the ballots that could not be written to the database and to replay them from a background thread."""
+
+    _path: Path = field(compare=False, repr=False)
+    _breaker: CircuitBreaker = field(compare=False, repr=False, default_factory=CircuitBreaker)
+    _batch_size: int = field(compare=False, repr=False, default=500)
+    _replay: Optional[Callable[[List[Dict[str, Any]]], Dict[str, str]]] = field(init=False, compare=False, repr=False, default=None)
+    _retry_base: float = field(init=False, compare=False, repr=False, default=5.0)
+    _retry_max: float = field(init=False, compare=False, repr=False, default=300.0)
+    _poll_interval: float = field(init=False, compare=False, repr=False, default=2.0)
+    _claim_timeout: float = field(init=False, compare=False, repr=False, default=300.0)
+    _table_pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _pending: bool = field(init=False, compare=False, repr=False, default=True)
+    _thread: Optional[threading.Thread] = field(init=False, compare=False, repr=False, default=None)
+    _thread_pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _wakeup: threading.Event = field(init=False, compare=False, repr=False, default_factory=threading.Event)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker
+
+    def init_replay(self, replay: Callable[[List[Dict[str, Any]]], Dict[str, str]]) -> None:
+        """Sets the function that adds a batch of ballots to the database and returns the outcome of each ballot ID."""
+        self._replay = replay
+
+    @contextmanager
+    def _connect(self):
+        """Returns a connection to the buffer database, the table is created on first use."""
+        connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            if self._table_pid != os.getpid():
+                # The ORCID iD and normalized email columns reject a second ballot of a voter who is waiting in the buffer
+                connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS ballots (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ballot_id TEXT NOT NULL UNIQUE,
+                        orcid_id TEXT NOT NULL UNIQUE,
+                        email TEXT NOT NULL UNIQUE,
+                        payload TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        next_attempt_at REAL NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        claimed_by INTEGER,
+                        claimed_at REAL,
+                        last_error TEXT
+                    )
+                    """
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS ballots_due ON ballots (status, next_attempt_at)")
+                self._table_pid = os.getpid()
+            yield connection
+        finally:
+            connection.close()
+
+    def add(self, ballot: Dict[str, Any], error: Optional[str] = None) -> None:
+        """Stores a ballot until it is added to the database, a ballot already in the buffer is kept once."""
+        now = time.time()
+        # A ballot that has just failed is not retried right away
+        next_attempt_at = now + self._retry_base if error is not None else now
+        try:
+            with metrics.time("buffer_add"), self._connect() as connection:
+                connection.execute(
+                    "INSERT INTO ballots (ballot_id, orcid_id, email, payload, created_at, next_attempt_at, last_error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (ballot["ballot_id"], ballot["orcid_id"], normalize_email(ballot["email"]), json.dumps(ballot), now, next_attempt_at, error),
+                )
+        except sqlite3.IntegrityError as e:
+            if "ballots.ballot_id" in str(e):
+                return
+            field_name = "orcid_id" if "ballots.orcid_id" in str(e) else "email"
+            raise DuplicateVoteException(f"The {field_name} of the vote is already in the ballot buffer.", field_name=field_name)
+        except sqlite3.Error as e:
+            raise DBException(f"An error occurred while adding the vote to the ballot buffer: {e}")
+
+        self._pending = True
+        metrics.inc("sees_ballot_buffer_total", {"event": "buffered"})
+        self.start()
+
+    def buffered_field(self, email: str, orcid_id: str) -> Optional[str]:
+        """Returns the field of a voter that is already waiting in the buffer, None if the voter is not in it.
+
+        The buffer is only read while it has pending ballots, the replayer of every worker checks for them once per poll interval.
+        """
+        if not self._pending or not self._path.exists():
+            return None
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT orcid_id = ? FROM ballots WHERE status = 'pending' AND (orcid_id = ? OR email = ?) LIMIT 1",
+                    (orcid_id, orcid_id, normalize_email(email)),
+                ).fetchone()
+        except sqlite3.Error as e:
+            raise DBException(f"An error occurred while checking the voter in the ballot buffer: {e}")
+        if row is None:
+            return None
+        return "orcid_id" if row[0] else "email"
+
+    def counts(self) -> Dict[str, int]:
+        """Returns the number of rows of the buffer by status."""
+        if not self._path.exists():
+            return {}
+        with self._connect() as connection:
+            return dict(connection.execute("SELECT status, COUNT(*) FROM ballots GROUP BY status").fetchall())
+
+    def start(self) -> None:
+        """Starts the replayer thread of this process if it is not already running."""
+        if self._thread_pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="ballot-buffer", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        """The replayer loop, adds the due ballots to the database until the process exits."""
+        while True:
+            self._wakeup.wait(timeout=self._poll_interval)
+            self._wakeup.clear()
+            try:
+                while self.replay():
+                    pass
+                self._pending = self._has_pending()
+            except Exception as e:
+                vote_logger.exception(f"An error occurred while replaying the ballot buffer: {e}")
+
+    def _has_pending(self) -> bool:
+        """Returns True if any worker has a ballot waiting in the buffer."""
+        if not self._path.exists():
+            return False
+        with self._connect() as connection:
+            return connection.execute("SELECT EXISTS (SELECT 1 FROM ballots WHERE status = 'pending')").fetchone()[0] == 1
+
+    def _claim(self, connection) -> List[Tuple[int, int, Dict[str, Any]]]:
+        """Claims the due ballots for this process, oldest first."""
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                """
+                SELECT id, attempts, payload FROM ballots
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                AND (claimed_at IS NULL OR claimed_at < ?)
+                ORDER BY id LIMIT ?
+                """,
+                (now, now - self._claim_timeout, self._batch_size),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE ballots SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(os.getpid(), now, row[0]) for row in rows],
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return [(row[0], row[1], json.loads(row[2])) for row in rows]
+
+    def _release(self, connection, rows: List[Tuple[int, int, Dict[str, Any]]], error: Optional[Exception] = None) -> None:
+        """Returns the claimed ballots to the buffer, with a retry backoff if the replay failed."""
+        now = time.time()
+        updates = []
+        for row_id, attempts, _ in rows:
+            if error is not None:
+                attempts += 1
+            delay = min(self._retry_base * 2 ** (attempts - 1), self._retry_max) if error is not None else 0.0
+            updates.append((attempts, now + delay, str(error) if error is not None else None, row_id))
+        connection.executemany(
+            "UPDATE ballots SET attempts = ?, next_attempt_at = ?, last_error = COALESCE(?, last_error), claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+            updates,
+        )
+
+    def replay(self) -> bool:
+        """Adds one batch of buffered ballots to the database, returns True if a full batch was added."""
+        if self._replay is None:
+            return False
+        with self._connect() as connection:
+            rows = self._claim(connection)
+            if not rows:
+                return False
+            if not self._breaker.allow():
+                self._release(connection, rows)
+                return False
+
+            try:
+                with metrics.time("buffer_replay"):
+                    outcomes = self._replay([row[2] for row in rows])
+            except DBException as e:
+                self._breaker.record_failure()
+                self._release(connection, rows, error=e)
+                return False
+            self._breaker.record_success()
+
+            # The ballots in the database leave the buffer, the duplicates are kept for the administrators
+            recorded = [(row[0],) for row in rows if outcomes.get(row[2]["ballot_id"]) == "recorded"]
+            duplicates = [(row[0],) for row in rows if outcomes.get(row[2]["ballot_id"]) == "duplicate"]
+            connection.executemany("DELETE FROM ballots WHERE id = ?", recorded)
+            connection.executemany(
+                "UPDATE ballots SET status = 'duplicate', last_error = 'The voter is already in the database.', claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                duplicates,
+            )
+            metrics.inc("sees_ballot_buffer_total", {"event": "recorded"}, amount=len(recorded))
+            if duplicates:
+                metrics.inc("sees_ballot_buffer_total", {"event": "duplicate"}, amount=len(duplicates))
+                vote_logger.warning(f"{len(duplicates)} buffered ballots were not added, their voters are already in the database.")
+
+        return len(rows) >= self._batch_size
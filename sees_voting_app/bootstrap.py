@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: bootstrap.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to estimate how sensitive the result of the election is
+# to the ballots that were cast. The ballot set is resampled with replacement
+# thousands of times and counted again, which gives the win probability of
+# every candidate and an interval of the margin of victory. The unique
+# rankings and their counts are kept in shared memory, every worker of the
+# process pool reads them without a copy and only receives a seed and the
+# number of replicates of each task.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sees_voting_app.tally import (
+    RANKS,
+    borda_count,
+    first_preferences,
+    group_ballots,
+    instant_runoff,
+    load_ballots,
+    single_transferable_vote,
+)
+
+
+__all__ = ["BOOTSTRAP_METHODS", "bootstrap", "count_winners", "format_bootstrap", "run_bootstrap"]
+
+
+# The counting methods that can be resampled
+BOOTSTRAP_METHODS = ("irv", "stv", "meek", "borda", "first")
+# The replicates counted by a task of the process pool
+TASK_REPLICATES = 250
+
+# The shared arrays and the count settings of a worker process
+_worker: Dict[str, Any] = {}
+
+
+def count_winners(
+    method: str, ballots: np.ndarray, n_candidates: int, weights: np.ndarray, seats: int = 1, winners: Optional[Sequence[int]] = None
+) -> Tuple[List[int], float]:
+    """Counts weighted ballots, returns the elected candidates and the margin of victory of the given winners as a share of the ballots.
+
+    The margin is the smallest count of the winners minus the largest count of the others, in the last round in which one of the others
+    still has votes. The winners are the elected candidates of this count by default, the margin of other winners is negative if they lose.
+    """
+    if method in ("irv", "stv", "meek"):
+        if method == "irv":
+            rounds = instant_runoff(ballots, n_candidates, weights)
+        else:
+            transfers = "meek" if method == "meek" else "gregory"
+            rounds = single_transferable_vote(ballots, n_candidates, seats=seats, weights=weights, transfers=transfers)
+        elected = [tally_round.elected for tally_round in rounds if tally_round.elected is not None]
+        counts = [tally_round.counts for tally_round in rounds]
+    elif method in ("borda", "first"):
+        scores = borda_count(ballots, n_candidates, weights) if method == "borda" else first_preferences(ballots, n_candidates, weights)
+        elected = [int(i) for i in np.argsort(-scores, kind="stable")[:seats]]
+        counts = [scores]
+    else:
+        raise ValueError(f"Unknown counting method: {method}")
+
+    winners = list(elected if winners is None else winners)
+    total = float(np.sum(weights))
+    others = np.ones(n_candidates, dtype=bool)
+    others[winners] = False
+    if not winners or not others.any() or total == 0:
+        return elected, 0.0
+    final = next((round_counts for round_counts in reversed(counts) if (round_counts[others] > 0).any()), counts[-1])
+    return elected, float((np.min(final[winners]) - np.max(final[others])) / total)
+
+
+def _attach(names: Tuple[str, str], n_groups: int, n_candidates: int, method: str, seats: int, observed_winners: List[int]) -> None:
+    """Attaches a worker to the shared rankings and counts of the ballot groups."""
+    # The workers share the resource tracker of the parent, which unlinks the blocks once
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    groups = np.ndarray((n_groups, RANKS), dtype=np.int16, buffer=blocks[0].buf)
+    counts = np.ndarray((n_groups,), dtype=np.float64, buffer=blocks[1].buf)
+    _worker.update(
+        blocks=blocks,
+        groups=groups,
+        n_ballots=int(round(counts.sum())),
+        probabilities=counts / counts.sum(),
+        n_candidates=n_candidates,
+        method=method,
+        seats=seats,
+        observed_winners=observed_winners,
+    )
+
+
+def _replicates(seed: np.random.SeedSequence, replicates: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Counts a number of resampled ballot sets, returns the wins of every candidate and the margin of the observed winners in each replicate."""
+    rng = np.random.default_rng(seed)
+    wins = np.zeros(_worker["n_candidates"], dtype=np.int64)
+    margins = np.empty(replicates, dtype=np.float64)
+    for i in range(replicates):
+        # A multinomial draw of the group counts is the same as drawing the ballots with replacement
+        weights = rng.multinomial(_worker["n_ballots"], _worker["probabilities"]).astype(np.float64)
+        winners, margins[i] = count_winners(
+            _worker["method"], _worker["groups"], _worker["n_candidates"], weights, _worker["seats"], winners=_worker["observed_winners"]
+        )
+        wins[winners] += 1
+    return wins, margins
+
+
+def bootstrap(
+    ballots: np.ndarray,
+    n_candidates: int,
+    method: str = "irv",
+    replicates: int = 10000,
+    seats: int = 1,
+    workers: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Resamples the ballots with replacement and counts every replicate in a process pool.
+
+    Returns the observed winners and margin, the win probability of every candidate and the margins of the observed winners in the
+    replicates, which are negative in the replicates that other candidates win.
+    """
+    if method not in BOOTSTRAP_METHODS:
+        raise ValueError(f"Unknown counting method: {method}")
+    groups, counts = group_ballots(ballots)
+    observed_winners, observed_margin = count_winners(method, groups, n_candidates, counts, seats)
+    if len(groups) == 0 or replicates <= 0:
+        return {"winners": observed_winners, "margin": observed_margin, "win_probabilities": np.zeros(n_candidates), "margins": np.empty(0)}
+
+    # Copy the groups to shared memory once, the tasks only carry their seed and size
+    blocks = [shared_memory.SharedMemory(create=True, size=array.nbytes) for array in (groups, counts)]
+    try:
+        for block, array in zip(blocks, (groups, counts)):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+
+        sizes = [min(TASK_REPLICATES, replicates - start) for start in range(0, replicates, TASK_REPLICATES)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        initargs = (tuple(block.name for block in blocks), len(groups), n_candidates, method, seats, observed_winners)
+        wins = np.zeros(n_candidates, dtype=np.int64)
+        margins = []
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_attach, initargs=initargs) as executor:
+            for task_wins, task_margins in executor.map(_replicates, seeds, sizes):
+                wins += task_wins
+                margins.append(task_margins)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return {
+        "winners": observed_winners,
+        "margin": observed_margin,
+        "win_probabilities": wins / replicates,
+        "margins": np.concatenate(margins),
+    }
+
+
+def format_bootstrap(candidates: Sequence[str], result: Dict[str, Any], replicates: int) -> str:
+    """Returns the win probabilities and the margin of victory of a bootstrap as a text table."""
+    width = max(len(name) for name in [*candidates, "Candidate"])
+    probabilities = result["win_probabilities"]
+    lines = [f"{'Candidate':<{width}}{'Win probability':>18}", "-" * (width + 18)]
+    for i in np.argsort(-probabilities, kind="stable"):
+        lines.append(f"{candidates[i]:<{width}}{probabilities[i]:>18.4f}")
+    lines.append("")
+    lines.append(f"Elected: {', '.join(candidates[i] for i in result['winners'])}")
+    lines.append(f"Margin of victory: {result['margin']:.2%} of the ballots")
+    if len(result["margins"]):
+        low, median, high = np.percentile(result["margins"], [2.5, 50, 97.5])
+        lines.append(f"Margin of the elected candidates in the {replicates} replicates: median {median:.2%}, 95% interval {low:.2%} to {high:.2%}")
+    return "\n".join(lines)
+
+
+def run_bootstrap(
+    method: str = "irv", source: str = "db", replicates: int = 10000, seats: int = 1, workers: Optional[int] = None, seed: Optional[int] = None
+) -> str:
+    """Loads the ballots and returns the report of a bootstrap of the given counting method."""
+    candidates, ballots = load_ballots(source=source)
+    result = bootstrap(ballots, len(candidates), method=method, replicates=replicates, seats=seats, workers=workers, seed=seed)
+    return format_bootstrap(candidates, result, replicates)
@@ -11,18 +11,25 @@
 # -----------------------------------------------------------------------------
 
 import os
+import threading
+import time
 from datetime import datetime
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from dataclasses import dataclass, field
 from dotenv import load_dotenv
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional
 
 
-# Find the .env file in the parent directory
-env_path = Path(__file__).resolve().parent.parent / "data" / ".env"
+# Set the path to the data directory, it can be overridden with the DATA_DIR environment variable
+data_dir = Path(os.getenv("DATA_DIR", Path(__file__).resolve().parent.parent / "data"))
+
+# Find the .env file in the data directory
+env_path = data_dir / ".env"
 
 # Load the environment variables from the .env file
 load_dotenv(env_path)
@@ -32,9 +39,31 @@ class Config:
     """A class that includes the configuration settings for the Flask app."""
 
     SECRET_KEY = os.getenv("SECRET_KEY")
+    ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
     MAIL_SERVER = os.getenv("MAIL_SERVER")
     MAIL_PORT = os.getenv("MAIL_PORT")
     MAIL_USE_TLS = os.getenv("MAIL_USE_TLS")
+    MAIL_OUTBOX_BATCH_SIZE = int(os.getenv("MAIL_OUTBOX_BATCH_SIZE") or 50)
+    MAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("MAIL_OUTBOX_MAX_ATTEMPTS") or 8)
+    MAIL_ADMIN_DIGEST_INTERVAL = int(os.getenv("MAIL_ADMIN_DIGEST_INTERVAL") or 0)
+    JOURNAL_FSYNC_INTERVAL_MS = float(os.getenv("JOURNAL_FSYNC_INTERVAL_MS") or 5)
+    STATIC_URL_PREFIX = os.getenv("STATIC_URL_PREFIX") or "/vote/static"
+    STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE") or 365 * 24 * 60 * 60)
+    VOTER_INDEX_CAPACITY = int(os.getenv("VOTER_INDEX_CAPACITY") or 200000)
+    RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE") or 60)
+    RATE_LIMIT_ORCID_PER_MINUTE = float(os.getenv("RATE_LIMIT_ORCID_PER_MINUTE") or 5)
+    MAX_VOTES_IN_FLIGHT = int(os.getenv("MAX_VOTES_IN_FLIGHT") or 64)
+    TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES") or 0)
+    DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS") or 0)
+    DB_GROUP_COMMIT_MAX_VOTES = int(os.getenv("DB_GROUP_COMMIT_MAX_VOTES") or 100)
+    BALLOT_BUFFER_BATCH_SIZE = int(os.getenv("BALLOT_BUFFER_BATCH_SIZE") or 500)
+    DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES") or 3)
+    DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS") or 30)
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or 10000)
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+    PROFILE_MIN_DURATION_MS = float(os.getenv("PROFILE_MIN_DURATION_MS") or 0)
+    PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS") or 2)
+    PROFILE_MAX_PER_MINUTE = int(os.getenv("PROFILE_MAX_PER_MINUTE") or 6)
     VOTING_ENDS = datetime.strptime(os.getenv("VOTING_ENDS"), "%Y-%m-%d %H:%M:%S")
 
 
@@ -63,20 +92,290 @@ class DBConfig:
     """A class that provides the configuration settings for the database."""
 
     _database_uri: str = field(init=False, compare=False, repr=False)
+    _sqlite_busy_timeout: int = field(init=False, compare=False, repr=False)
+    _sqlite_synchronous: str = field(init=False, compare=False, repr=False)
+    _busy_retries: int = field(init=False, compare=False, repr=False)
 
     def __post_init__(self) -> None:
         self._database_uri = os.getenv("DATABASE_URI")
+        self._sqlite_busy_timeout = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS") or 5000)
+        self._sqlite_synchronous = (os.getenv("SQLITE_SYNCHRONOUS") or "NORMAL").upper()
+        self._busy_retries = int(os.getenv("DB_BUSY_RETRIES") or 5)
 
     @property
     def database_uri(self) -> str:
         return self._database_uri
 
+    @property
+    def is_sqlite(self) -> bool:
+        return self._database_uri.startswith("sqlite")
+
+    @property
+    def sqlite_busy_timeout(self) -> int:
+        """Returns the milliseconds a SQLite connection waits for the write lock before it fails with SQLITE_BUSY."""
+        return self._sqlite_busy_timeout
+
+    @property
+    def sqlite_synchronous(self) -> str:
+        """Returns the synchronous mode of SQLite, NORMAL is durable in WAL mode except for the last commits on a power loss."""
+        if self._sqlite_synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown SQLITE_SYNCHRONOUS mode: {self._sqlite_synchronous}")
+        return self._sqlite_synchronous
+
+    @property
+    def busy_retries(self) -> int:
+        """Returns the number of times a write that failed on a locked SQLite database is tried again."""
+        return self._busy_retries
+
+
+@dataclass
+class ServerConfig:
+    """A class that provides the gunicorn worker settings and the database pool sizes derived from them."""
+
+    _worker_class: str = field(init=False, compare=False, repr=False)
+    _workers: int = field(init=False, compare=False, repr=False)
+    _worker_connections: int = field(init=False, compare=False, repr=False)
+    _db_max_connections: int = field(init=False, compare=False, repr=False)
+    _db_pool_size: Optional[int] = field(init=False, compare=False, repr=False)
+    _db_max_overflow: Optional[int] = field(init=False, compare=False, repr=False)
+    _db_pool_recycle: int = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+        cpu_count = os.cpu_count() or 1
+        # Sync workers block on I/O so more processes are needed, a gevent worker multiplexes its requests
+        default_workers = cpu_count if self.cooperative else 2 * cpu_count + 1
+        self._workers = int(os.getenv("GUNICORN_WORKERS") or default_workers)
+        self._worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS") or 1000)
+        self._db_max_connections = int(os.getenv("DB_MAX_CONNECTIONS") or 100)
+        self._db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE") or 1800)
+        self._db_pool_size = int(os.getenv("DB_POOL_SIZE")) if os.getenv("DB_POOL_SIZE") else None
+        self._db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW")) if os.getenv("DB_MAX_OVERFLOW") else None
+
+    @property
+    def worker_class(self) -> str:
+        return self._worker_class
+
+    @property
+    def cooperative(self) -> bool:
+        """Returns True if the workers use gevent greenlets instead of blocking on I/O."""
+        return self._worker_class == "gevent"
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def worker_connections(self) -> int:
+        return self._worker_connections
+
+    @property
+    def db_pool_size(self) -> int:
+        """Returns the pool size of each worker, about 80% of its share of the DB_MAX_CONNECTIONS budget."""
+        if self._db_pool_size is not None:
+            return self._db_pool_size
+        return max(1, self._db_max_connections // self._workers * 4 // 5)
+
+    @property
+    def db_max_overflow(self) -> int:
+        """Returns the overflow of each worker, the rest of its share of the DB_MAX_CONNECTIONS budget."""
+        if self._db_max_overflow is not None:
+            return self._db_max_overflow
+        return max(0, self._db_max_connections // self._workers - self.db_pool_size)
+
+    @property
+    def db_max_connections(self) -> int:
+        return self._db_max_connections
+
+    @property
+    def db_connections(self) -> int:
+        """Returns the most connections all the workers can open, above DB_MAX_CONNECTIONS if there are more workers than connections."""
+        return self._workers * (self.db_pool_size + self.db_max_overflow)
+
+    @property
+    def sqlite_pool_size(self) -> int:
+        """Returns the pool size of each worker on a SQLite database, the DB_MAX_CONNECTIONS budget does not apply."""
+        return self._db_pool_size if self._db_pool_size is not None else 2
+
+    @property
+    def sqlite_max_overflow(self) -> int:
+        """Returns the overflow of each worker on a SQLite database."""
+        return self._db_max_overflow if self._db_max_overflow is not None else 2
+
+    @property
+    def db_pool_recycle(self) -> int:
+        """Returns the age in seconds after which a pooled connection is replaced, below the server wait_timeout."""
+        return self._db_pool_recycle
+
+
+@dataclass
+class PoolStats:
+    """A class to collect how long the requests of this process wait for a pooled connection."""
+
+    _waits: int = field(init=False, compare=False, repr=False, default=0)
+    _timeouts: int = field(init=False, compare=False, repr=False, default=0)
+    _wait_time: float = field(init=False, compare=False, repr=False, default=0.0)
+    _max_wait_time: float = field(init=False, compare=False, repr=False, default=0.0)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def record(self, wait_time: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self._waits += 1
+            self._timeouts += timed_out
+            self._wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._waits = self._timeouts = 0
+            self._wait_time = self._max_wait_time = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self._waits,
+                "checkout_timeouts": self._timeouts,
+                "wait_time_total_ms": round(self._wait_time * 1000, 3),
+                "wait_time_avg_ms": round(self._wait_time * 1000 / self._waits, 3) if self._waits else 0.0,
+                "wait_time_max_ms": round(self._max_wait_time * 1000, 3),
+            }
+
+
+# The checkout statistics of the connection pool of this process
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records the time spent waiting for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return connection
+
+
+@dataclass
+class EngineRegistry:
+    """A class that provides the single engine and session registry of each process.
+
+    The engine is created on first use. After a fork its pool is replaced, without closing the parent connections, so the workers never share a socket.
+    """
+
+    _engine: Optional[Engine] = field(init=False, compare=False, repr=False, default=None)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _session: scoped_session = field(init=False, compare=False, repr=False)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self._session = scoped_session(self._create_session)
+
+    def _create_engine(self) -> Engine:
+        """Creates the engine with the pool sizes derived from the worker settings."""
+        db_config = DBConfig()
+        server_config = ServerConfig()
+        if db_config.is_sqlite:
+            return self._create_sqlite_engine(db_config)
+        connect_args = {}
+        # The C extension of mysql-connector blocks the gevent hub, use the pure Python protocol instead
+        if server_config.cooperative and db_config.database_uri.startswith("mysql+mysqlconnector"):
+            connect_args["use_pure"] = True
+        return create_engine(
+            db_config.database_uri,
+            poolclass=InstrumentedQueuePool,
+            pool_size=server_config.db_pool_size,
+            max_overflow=server_config.db_max_overflow,
+            pool_timeout=30,
+            pool_pre_ping=True,
+            pool_recycle=server_config.db_pool_recycle,
+            connect_args=connect_args,
+        )
+
+    @staticmethod
+    def _create_sqlite_engine(db_config: DBConfig) -> Engine:
+        """Creates the engine of a SQLite database file shared by the gunicorn workers.
+
+        The database is in WAL mode, so the readers never wait for the single writer, and a writer waits up to the busy timeout for the
+        lock. Every worker keeps a few connections of its own, a connection opens no socket and is never shared after a fork.
+        """
+        if ":memory:" in db_config.database_uri or db_config.database_uri.rstrip("/") == "sqlite:":
+            raise ValueError("An in-memory SQLite database is not shared by the workers, use a database file.")
+        server_config = ServerConfig()
+        engine = create_engine(
+            db_config.database_uri,
+            poolclass=InstrumentedQueuePool,
+            pool_size=server_config.sqlite_pool_size,
+            max_overflow=server_config.sqlite_max_overflow,
+            pool_timeout=30,
+            connect_args={"timeout": db_config.sqlite_busy_timeout / 1000, "check_same_thread": False},
+        )
+        synchronous = db_config.sqlite_synchronous
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, _) -> None:
+            # Let SQLAlchemy begin the transactions, the sqlite3 module would only begin them before a write
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={db_config.sqlite_busy_timeout}")
+            cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def begin_transaction(connection) -> None:
+            connection.exec_driver_sql("BEGIN")
+
+        return engine
+
+    def _create_session(self, **kwargs) -> Session:
+        """Creates a session bound to the engine of this process."""
+        return Session(bind=self.engine, autoflush=False, **kwargs)
+
+    @property
+    def engine(self) -> Engine:
+        """Returns the engine of this process, it is created or its pool replaced as needed."""
+        if self._engine is None or self._pid != os.getpid():
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+                    self._pid = os.getpid()
+                elif self._pid != os.getpid():
+                    self.dispose()
+        return self._engine
+
+    @property
+    def session(self) -> scoped_session:
+        return self._session
+
+    def dispose(self) -> None:
+        """Replaces the pool after a fork, the connections inherited from the parent are left to it."""
+        self._session.remove()
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+        self._pid = os.getpid()
+        pool_stats.reset()
+
+    def pool_status(self) -> Dict[str, Any]:
+        """Returns the state and the checkout statistics of the connection pool of this process."""
+        status = {"pid": os.getpid()}
+        pool = self.engine.pool
+        if isinstance(pool, QueuePool):
+            status.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=max(0, pool.overflow()),
+                max_overflow=pool._max_overflow,
+            )
+        status.update(pool_stats.as_dict())
+        return status
+
 
-def initialize_db():
-    """Initialize the database."""
-    db_config = DBConfig()
-    db_engine = create_engine(db_config.database_uri, pool_size=10, max_overflow=2, pool_timeout=30)
-    db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=db_engine))
-    # Create a declarative base
-    base = declarative_base()
-    return db_config, db_engine, db_session, base
+# The declarative base of the database models
+Base = declarative_base()
+# The engine and session registry of this process
+engine_registry = EngineRegistry()
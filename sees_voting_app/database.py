@@ -5,53 +5,118 @@
 # -----------------------------------------------------------------------------
 # Purpose:
 # This file is used to define the database configuration and the database
-# models for the SEES election voting app.
+# models for the SEES election voting app, and the retry of the writes that
+# find a SQLite database locked by another worker.
 #
 # Copyright (C) 2024 GSECARS, The University of Chicago, USA
 # This software is distributed under the terms of the MIT license.
 # -----------------------------------------------------------------------------
 
+import random
+import sqlite3
+import time
 from contextlib import contextmanager
+from functools import wraps
 from sqlalchemy import Column, Integer, String, DateTime, UniqueConstraint
+from sqlalchemy.dialects import mysql
+from typing import Callable, Optional, TypeVar
 
-from sees_voting_app import Base, initialize_db
+from sees_voting_app import Base, db_session
+from sees_voting_app.config import DBConfig
+from sees_voting_app.metrics import metrics
 
-# Move the global declaration to the top
-global db_session
-db_session = None
+
+# The primary SQLite result codes of a locked database, SQLITE_BUSY and SQLITE_LOCKED
+SQLITE_BUSY_CODES = (5, 6)
+# The first and the longest wait before a locked write is tried again, in seconds
+BUSY_RETRY_BASE = 0.01
+BUSY_RETRY_MAX = 0.5
+
+F = TypeVar("F", bound=Callable)
 
 
 # Add a context manager for the session
 @contextmanager
-def session_scope():
-    """Return a session scope for the database."""
-    global db_session
-    if db_session is None:
-        db_config, db_engine, db_session, Base = initialize_db()
+def session_scope(commit_stage: Optional[str] = None):
+    """Return a session scope for the database, the commit is timed as the given stage of a vote."""
     session = db_session()
     try:
         yield session
-        session.commit()
+        if commit_stage is None:
+            session.commit()
+        else:
+            with metrics.time(commit_stage):
+                session.commit()
+    except Exception:
+        session.rollback()
+        raise
     finally:
         session.close()
 
 
+def is_busy_error(error: Optional[BaseException]) -> bool:
+    """Returns True if an error, or an error it was raised from, is a SQLITE_BUSY or SQLITE_LOCKED error."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        original = getattr(error, "orig", None) or error
+        if isinstance(original, sqlite3.OperationalError):
+            # The extended result codes keep the primary code in their low byte
+            code = getattr(original, "sqlite_errorcode", None)
+            if (code is not None and code & 0xFF in SQLITE_BUSY_CODES) or "database is locked" in str(original):
+                return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def retry_on_busy(function: F) -> F:
+    """Tries a database write again, with a jittered exponential backoff, while it fails on a SQLite database locked by another worker."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        retries = DBConfig().busy_retries
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= retries or not is_busy_error(e):
+                    raise
+            metrics.inc("sees_db_busy_retries_total")
+            time.sleep(min(BUSY_RETRY_MAX, BUSY_RETRY_BASE * 2**attempt) * random.uniform(0.5, 1.0))
+            attempt += 1
+
+    return wrapper
+
+
 class VoteModel(Base):
     __tablename__ = "votes"
 
     id = Column(Integer, primary_key=True)
     full_name = Column(String(255), nullable=False)
+    # The emails are stored by their normalized key, so a lookup does not depend on the collation of the database
     email = Column(String(255), nullable=False, unique=True)
     orcid_id = Column(String(255), nullable=False, unique=True)
     selection_1 = Column(String(255), nullable=False)
     selection_2 = Column(String(255), nullable=False)
     selection_3 = Column(String(255), nullable=False)
     selection_4 = Column(String(255), nullable=False)
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"), nullable=False)
 
     __table_args__ = (UniqueConstraint("email", "orcid_id", name="unique_email_orcid"),)
 
 
+class TallyModel(Base):
+    __tablename__ = "vote_tallies"
+
+    id = Column(Integer, primary_key=True)
+    candidate = Column(String(255), nullable=False)
+    rank = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("candidate", "rank", name="unique_candidate_rank"),)
+
+
 class DBException(Exception):
 
     def __init__(self, message):
@@ -60,3 +125,15 @@ class DBException(Exception):
 
     def __str__(self):
         return f"{self.message}"
+
+
+class DuplicateVoteException(DBException):
+    """Raised when a vote violates the unique email or ORCID iD constraints."""
+
+    def __init__(self, message, field_name):
+        self.field_name = field_name
+        super().__init__(message)
+
+
+class VoteBufferedException(DBException):
+    """Raised when a vote could not be written to the database and was stored in the ballot buffer instead."""
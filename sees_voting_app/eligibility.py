@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: eligibility.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to check that a voter is on the roll of eligible voters.
+# The roll file (data/eligible_voters.csv) is compiled once into sorted arrays
+# of 64-bit keys of the ORCID iDs and emails, which every worker maps into
+# memory and searches without any database round trip. The roll is reloaded
+# when the file changes. It also validates the ORCID iD check digit.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import bisect
+import csv
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+
+__all__ = ["EligibilityRoll", "orcid_checksum", "valid_orcid"]
+
+
+# The header of the compiled roll: magic, signature of the roll file, number of ORCID iD and email keys
+_HEADER = struct.Struct("8sQQQQQ")
+_MAGIC = b"SEESROL1"
+_ORCID_PATTERN = re.compile(r"^(\d{4})-?(\d{4})-?(\d{4})-?(\d{3})([0-9X])$")
+
+
+def orcid_checksum(base_digits: str) -> str:
+    """Returns the ISO 7064 MOD 11-2 check character of the 15 base digits of an ORCID iD."""
+    total = 0
+    for digit in base_digits:
+        total = (total + int(digit)) * 2
+    result = (12 - total % 11) % 11
+    return "X" if result == 10 else str(result)
+
+
+def _orcid_digits(orcid_id: str) -> Optional[Tuple[str, str]]:
+    """Returns the 15 base digits and the check character of an ORCID iD, None if it is malformed."""
+    match = _ORCID_PATTERN.match(orcid_id.strip().upper())
+    if match is None:
+        return None
+    return "".join(match.groups()[:4]), match.group(5)
+
+
+def valid_orcid(orcid_id: str) -> bool:
+    """Returns True if the ORCID iD is well formed and its check character matches its digits."""
+    digits = _orcid_digits(orcid_id)
+    return digits is not None and orcid_checksum(digits[0]) == digits[1]
+
+
+def _orcid_key(orcid_id: str) -> Optional[int]:
+    digits = _orcid_digits(orcid_id)
+    return int(digits[0]) if digits is not None else None
+
+
+def _email_key(email: str) -> int:
+    return struct.unpack("<Q", hashlib.blake2b(email.strip().casefold().encode(), digest_size=8).digest())[0]
+
+
+def _contains(keys: Sequence[int], key: int) -> bool:
+    position = bisect.bisect_left(keys, key)
+    return position < len(keys) and keys[position] == key
+
+
+@dataclass
+class EligibilityRoll:
+    """A class to check the voters against the roll of eligible voters, every voter is eligible if there is no roll file."""
+
+    _path: Path = field(compare=False, repr=False)
+    _signature: Optional[Tuple[int, int, int]] = field(init=False, compare=False, repr=False, default=None)
+    _mmap: Optional[mmap.mmap] = field(init=False, compare=False, repr=False, default=None)
+    _orcids: Optional[memoryview] = field(init=False, compare=False, repr=False, default=None)
+    _emails: Optional[memoryview] = field(init=False, compare=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    @property
+    def _compiled_path(self) -> Path:
+        return self._path.with_suffix(".idx")
+
+    def _file_signature(self) -> Optional[Tuple[int, int, int]]:
+        """Returns the inode, modification time and size of the roll file, None if there is no roll."""
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _compile(self, signature: Tuple[int, int, int]) -> None:
+        """Compiles the roll file into the sorted ORCID iD and email keys."""
+        orcids, emails = set(), set()
+        with open(self._path, "r", newline="") as file:
+            reader = csv.DictReader(file)
+            columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+            for row in reader:
+                orcid_id = row.get(columns.get("orcid_id", ""), "") or ""
+                email = row.get(columns.get("email", ""), "") or ""
+                if orcid_id.strip() and _orcid_key(orcid_id) is not None:
+                    orcids.add(_orcid_key(orcid_id))
+                if email.strip():
+                    emails.add(_email_key(email))
+
+        temporary_path = self._compiled_path.with_name(f"{self._compiled_path.name}.{os.getpid()}.tmp")
+        with open(temporary_path, "wb") as file:
+            file.write(_HEADER.pack(_MAGIC, *signature, len(orcids), len(emails)))
+            file.write(array("Q", sorted(orcids)).tobytes())
+            file.write(array("Q", sorted(emails)).tobytes())
+        os.replace(temporary_path, self._compiled_path)
+
+    def _map(self, signature: Tuple[int, int, int]) -> bool:
+        """Maps the compiled roll if it was compiled from the current roll file."""
+        try:
+            with open(self._compiled_path, "rb") as file:
+                compiled = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+        magic, inode, mtime, size, orcid_count, email_count = _HEADER.unpack_from(compiled, 0)
+        if magic != _MAGIC or (inode, mtime, size) != signature or len(compiled) != _HEADER.size + 8 * (orcid_count + email_count):
+            compiled.close()
+            return False
+
+        self._release()
+        view = memoryview(compiled)
+        self._orcids = view[_HEADER.size : _HEADER.size + 8 * orcid_count].cast("Q")
+        self._emails = view[_HEADER.size + 8 * orcid_count :].cast("Q")
+        self._mmap = compiled
+        return True
+
+    def _release(self) -> None:
+        """Unmaps the current roll."""
+        if self._orcids is not None:
+            self._orcids.release()
+            self._emails.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._orcids = self._emails = self._mmap = None
+
+    def refresh(self) -> None:
+        """Maps the roll again if the roll file has been replaced or modified, compiling it if needed."""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            if signature is None:
+                self._release()
+            elif not self._map(signature):
+                self._compile(signature)
+                self._map(signature)
+            self._signature = signature
+
+    def invalidate(self) -> None:
+        """Forces a reload on the next check, e.g. after a SIGHUP."""
+        self._signature = None
+
+    @property
+    def enabled(self) -> bool:
+        """Returns True if there is a roll of eligible voters."""
+        self.refresh()
+        return self._mmap is not None
+
+    def is_eligible(self, email: str, orcid_id: str) -> bool:
+        """Returns True if the ORCID iD or the email of the voter is on the roll, or if there is no roll."""
+        self.refresh()
+        with self._lock:
+            if self._mmap is None:
+                return True
+            orcid_key = _orcid_key(orcid_id)
+            if orcid_key is not None and _contains(self._orcids, orcid_key):
+                return True
+            return _contains(self._emails, _email_key(email))
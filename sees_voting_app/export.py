@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: export.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to export the ballots of the votes table. The rows are
+# streamed from the database in fixed-size chunks and written one chunk at a
+# time to a Parquet, Arrow IPC or CSV file, so the memory use does not grow
+# with the number of voters. In the Parquet and Arrow files the selections
+# are dictionary-encoded columns of the candidate names.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import csv
+import os
+from pathlib import Path
+from sqlalchemy import select, union
+from typing import Any, Iterator, List, Optional, Sequence
+
+from sees_voting_app.config import data_dir
+from sees_voting_app.database import VoteModel, session_scope
+from sees_voting_app.utils import RESULTS_HEADER
+from sees_voting_app.voting_system import candidate_registry
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+__all__ = ["EXPORT_FORMATS", "export_ballots"]
+
+
+# The export formats and their file extensions
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+# The columns read from the votes table, in the order of the exported columns
+_COLUMNS = (
+    VoteModel.id,
+    VoteModel.timestamp,
+    VoteModel.full_name,
+    VoteModel.email,
+    VoteModel.orcid_id,
+    VoteModel.selection_1,
+    VoteModel.selection_2,
+    VoteModel.selection_3,
+    VoteModel.selection_4,
+)
+_SELECTIONS = ("selection_1", "selection_2", "selection_3", "selection_4")
+
+
+def _chunks(session, chunk_size: int) -> Iterator[Sequence[Any]]:
+    """Streams the rows of the votes table in chunks, the driver keeps a server-side cursor where it supports one."""
+    result = session.execute(select(*_COLUMNS).order_by(VoteModel.id).execution_options(yield_per=chunk_size))
+    yield from result.partitions()
+
+
+def _candidate_names(session) -> List[str]:
+    """Returns the dictionary of the selection columns: the current candidates, then any other name found in the votes table."""
+    names = [candidate.name for candidate in candidate_registry.candidates]
+    found = session.execute(union(*(select(getattr(VoteModel, column)) for column in _SELECTIONS))).scalars()
+    names.extend(sorted(set(found) - set(names) - {"None"}))
+    return names
+
+
+def _arrow_schema() -> "pa.Schema":
+    selection_type = pa.dictionary(pa.int16(), pa.string())
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("timestamp", pa.timestamp("us")),
+            ("full_name", pa.string()),
+            ("email", pa.string()),
+            ("orcid_id", pa.string()),
+            *((column, selection_type) for column in _SELECTIONS),
+        ]
+    )
+
+
+def _arrow_batch(rows: Sequence[Any], schema: "pa.Schema", dictionary: "pa.Array", index: dict) -> "pa.RecordBatch":
+    """Converts a chunk of rows to a record batch, the empty ranks are nulls of the selection columns."""
+    columns = list(zip(*rows))
+    arrays = [pa.array(values, type=schema.field(i).type) for i, values in enumerate(columns[:5])]
+    for values in columns[5:]:
+        indices = pa.array([index.get(name) for name in values], type=pa.int16())
+        arrays.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_ballots(fmt: str = "parquet", path: Optional[Path] = None, chunk_size: int = 10000) -> int:
+    """Exports the votes table to a Parquet, Arrow IPC or CSV file, returns the number of exported ballots.
+
+    The file is written next to its final path and renamed, so a reader never sees a partial export.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt != "csv" and pa is None:
+        raise RuntimeError("The Parquet and Arrow exports need pyarrow, install it with: pip install pyarrow")
+
+    path = Path(path) if path is not None else data_dir / f"ballots{EXPORT_FORMATS[fmt]}"
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    exported = 0
+    with session_scope() as session:
+        if fmt == "csv":
+            # The CSV file has the columns of the responses.csv file
+            with open(temporary_path, "w", newline="", buffering=1024 * 1024) as file:
+                writer = csv.writer(file)
+                writer.writerow(RESULTS_HEADER)
+                for rows in _chunks(session, chunk_size):
+                    writer.writerows(row[2:] for row in rows)
+                    exported += len(rows)
+        else:
+            names = _candidate_names(session)
+            dictionary = pa.array(names, type=pa.string())
+            index = {name: i for i, name in enumerate(names)}
+            schema = _arrow_schema()
+            if fmt == "parquet":
+                writer = pq.ParquetWriter(temporary_path, schema, compression="zstd")
+            else:
+                writer = pa.ipc.new_file(str(temporary_path), schema)
+            try:
+                for rows in _chunks(session, chunk_size):
+                    batch = _arrow_batch(rows, schema, dictionary, index)
+                    if fmt == "parquet":
+                        writer.write_batch(batch)
+                    else:
+                        writer.write(batch)
+                    exported += len(rows)
+            finally:
+                writer.close()
+
+    os.replace(temporary_path, path)
+    return exported
@@ -12,11 +12,12 @@
 # This software is distributed under the terms of the MIT license.
 # -----------------------------------------------------------------------------
 
+from typing import Tuple
 from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField, BooleanField, SubmitField
 from wtforms.validators import ValidationError, DataRequired, Email, Regexp
 
-from sees_voting_app.voting_system import Candidate
+from sees_voting_app.eligibility import valid_orcid
 
 
 def NoDefaultRequired(form, field) -> None:
@@ -25,6 +26,12 @@ def NoDefaultRequired(form, field) -> None:
         raise ValidationError("Please select a candidate.")
 
 
+def ValidOrcidChecksum(form, field) -> None:
+    """Validator to ensure that the check digit of the ORCID iD matches its other digits."""
+    if field.data and not valid_orcid(field.data):
+        raise ValidationError("Please check your ORCID iD, its check digit does not match the other digits.")
+
+
 class VoteForm(FlaskForm):
     """Form template for the ranking vote."""
 
@@ -38,6 +45,7 @@ class VoteForm(FlaskForm):
                 r"^\d{4}-\d{4}-\d{4}-\d{3}[0-9X]$",
                 message="Please enter a valid ORCID iD (e.g. 0000-0000-0000-0000)",
             ),
+            ValidOrcidChecksum,
         ],
     )
     selection_1 = SelectField("Choice 1", validators=[DataRequired(), NoDefaultRequired], choices=[])
@@ -47,10 +55,8 @@ class VoteForm(FlaskForm):
     send_email = BooleanField("Send a confirmation email", default="checked")
     submit = SubmitField("Submit Your Vote")
 
-    def set_candidate_choices(self, candidates: list[Candidate]) -> None:
-        """Set the choices for the form."""
-        default_choice = ("None", "Select a candidate...")
-        choices = [default_choice] + [(candidate.name, candidate.name) for candidate in candidates]
+    def set_candidate_choices(self, choices: Tuple[Tuple[str, str], ...]) -> None:
+        """Set the prebuilt choices, including the default option, for the form."""
         self.selection_1.choices = choices
         self.selection_2.choices = choices
         self.selection_3.choices = choices
@@ -10,20 +10,103 @@
 # This software is distributed under the terms of the MIT license.
 # -----------------------------------------------------------------------------
 
-from sees_voting_app import db_session
+import os
+from dotenv import load_dotenv
+from pathlib import Path
+
+# Load the .env file first, the worker class must be known before the app modules are imported
+load_dotenv(Path(os.getenv("DATA_DIR", Path(__file__).resolve().parent.parent / "data")) / ".env")
+if os.getenv("GUNICORN_WORKER_CLASS") == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import signal
+
+from sees_voting_app import admission_control, db_session, log_pipeline, mail_outbox
+from sees_voting_app.config import DBConfig, ServerConfig, engine_registry
+from sees_voting_app.metrics import metrics
+from sees_voting_app import voting_system
+from sees_voting_app.database import DBException
+from sees_voting_app.voting_system import candidate_registry
+
+# Get the worker settings from the .env file
+server_config = ServerConfig()
 
 # Gunicorn configuration
-bind = "0.0.0.0:5000"
-workers = 8
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+worker_class = server_config.worker_class
+workers = server_config.workers
+worker_connections = server_config.worker_connections
 timeout = 60
 graceful_timeout = 30
 accesslog = "logs/gunicorn_access.log"
 errorlog = "logs/gunicorn_error.log"
 
 
+def on_starting(server) -> None:
+    """Master initialization, before the workers are started."""
+    # Every worker keeps at least one connection, more workers than DB_MAX_CONNECTIONS go over the budget
+    if not DBConfig().is_sqlite and server_config.db_connections > server_config.db_max_connections:
+        server.log.warning(
+            f"The {server_config.workers} workers can open {server_config.db_connections} database connections, "
+            f"more than DB_MAX_CONNECTIONS={server_config.db_max_connections}. Lower GUNICORN_WORKERS or raise DB_MAX_CONNECTIONS."
+        )
+    # The master writes the log records of all the workers
+    log_pipeline.start_listener()
+    # Start the metrics of this run from zero
+    metrics.clear()
+    # Start the rate limits and the submissions in flight of this run from zero
+    admission_control.clear()
+    # Build the voter index from the votes table, the workers share it
+    try:
+        voting_system.VotingSystem().warm_voter_index()
+    except DBException as e:
+        # An empty index is still correct, the unique constraints reject the duplicates and add them to the index
+        server.log.warning(f"The voter index is built empty: {e.message}")
+        voting_system.voter_index.rebuild([])
+    # Compile the roll of eligible voters once, the workers map the compiled roll
+    voting_system.eligibility_roll.refresh()
+    # Do not hand the connections of the master to the workers
+    engine_registry.engine.dispose()
+
+
+def on_exit(server) -> None:
+    """Master shutdown."""
+    log_pipeline.stop_listener()
+
+
 def post_fork(server, worker) -> None:
     """Post-fork server and worker initialization."""
-    db_session.remove()
+    # Give the worker its own connection pool, the connections of the master are not shared
+    engine_registry.dispose()
+
+
+def reload_shared_files(signum, frame) -> None:
+    """Reloads the candidates list and the roll of eligible voters on the next request."""
+    candidate_registry.invalidate()
+    voting_system.eligibility_roll.invalidate()
+
+
+def post_worker_init(worker) -> None:
+    """Worker initialization after the worker signal handlers are installed."""
+    # Reload the candidates list and the roll of eligible voters on SIGHUP sent to the worker
+    signal.signal(signal.SIGHUP, reload_shared_files)
+    # Send the access log through the log pipeline instead of writing the file from every worker
+    worker.log.access_log.handlers = []
+    log_pipeline.attach(worker.log.access_log)
+    # Start the mail dispatcher so that emails left in the outbox are sent after a restart
+    mail_outbox.start()
+    # Start the replayer so that ballots left in the buffer are added to the database
+    voting_system.ballot_buffer.start()
+
+
+def child_exit(server, worker) -> None:
+    """Master cleanup after a worker exited."""
+    # The gauges of the worker are gone with it, its counters stay in the totals
+    metrics.remove_process(worker.pid)
+    # The submissions the worker had in flight are gone with it
+    admission_control.remove_process(worker.pid)
 
 
 def post_worker_exit(server, worker) -> None:
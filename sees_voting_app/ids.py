@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: ids.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to generate the ballot IDs and timestamps. The IDs follow
+# the UUIDv7 layout (RFC 9562): they sort by creation time, are unique across
+# the gunicorn workers thanks to their random bits and are generated without
+# any lock.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import itertools
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Tuple
+
+
+__all__ = ["new_ballot_id"]
+
+
+# Anchor the monotonic clock to the wall clock once, so the timestamps of a process never go backwards
+_CLOCK_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+# Sequence number that orders the IDs created by a process within the same clock tick
+_sequence = itertools.count()
+
+
+def new_ballot_id() -> Tuple[str, datetime]:
+    """Returns a new UUIDv7 ballot ID and the local timestamp, with microsecond resolution, embedded in it."""
+    now_ns = _CLOCK_OFFSET_NS + time.monotonic_ns()
+    milliseconds, sub_milliseconds = divmod(now_ns, 1_000_000)
+    # 12 bits of sub-millisecond precision, 16 bits of sequence and 46 random bits
+    fraction = sub_milliseconds * 4096 // 1_000_000
+    sequence = next(_sequence) & 0xFFFF
+    random_bits = int.from_bytes(os.urandom(6), "big") & ((1 << 46) - 1)
+    value = (milliseconds << 80) | (0x7 << 76) | (fraction << 64) | (0b10 << 62) | (sequence << 46) | random_bits
+
+    seconds, nanoseconds = divmod(now_ns, 1_000_000_000)
+    timestamp = datetime.fromtimestamp(seconds).replace(microsecond=nanoseconds // 1000)
+    return str(uuid.UUID(int=value)), timestamp
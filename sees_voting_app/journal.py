@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: journal.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the ballot journal of the voting app. Every
+# worker appends its ballots to its own JSON-lines file, a flusher thread
+# fsyncs the file every few milliseconds (group commit) and the writers wait
+# for their ballot to be on disk. The reader functions stream the ballots
+# back for the results and tally tooling.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, IO, Iterator, Optional, Tuple
+
+
+__all__ = ["BallotJournal", "iter_journal", "iter_journal_file"]
+
+
+# The journal files are named ballots-<pid>-<start time in ns>.jsonl
+JOURNAL_GLOB = "ballots-*.jsonl"
+
+
+def _fsync(file_descriptor: int) -> None:
+    """Flushes a file to disk, in the gevent thread pool when the worker is monkey patched so the other requests keep running."""
+    if "gevent.monkey" in sys.modules and sys.modules["gevent.monkey"].is_module_patched("threading"):
+        import gevent
+
+        gevent.get_hub().threadpool.apply(os.fsync, (file_descriptor,))
+    else:
+        os.fsync(file_descriptor)
+
+
+def _checksum(ballot: Dict[str, Any]) -> int:
+    """Returns the CRC32 of the canonical JSON encoding of a ballot."""
+    return zlib.crc32(json.dumps(ballot, sort_keys=True, separators=(",", ":")).encode())
+
+
+@dataclass
+class BallotJournal:
+    """A class to append the ballots to a per-worker journal file with group-commit fsync."""
+
+    _directory: Path = field(compare=False, repr=False)
+    _fsync_interval: float = field(compare=False, repr=False, default=0.005)
+    _sync_timeout: float = field(compare=False, repr=False, default=30.0)
+    _file: Optional[IO[str]] = field(init=False, compare=False, repr=False, default=None)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _written: int = field(init=False, compare=False, repr=False, default=0)
+    _synced: int = field(init=False, compare=False, repr=False, default=0)
+    _error: Optional[Exception] = field(init=False, compare=False, repr=False, default=None)
+    _condition: threading.Condition = field(init=False, compare=False, repr=False, default_factory=threading.Condition)
+
+    def _open(self) -> None:
+        """Opens the journal file of this process and starts its flusher thread."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        path = self._directory / f"ballots-{os.getpid()}-{time.time_ns()}.jsonl"
+        self._file = open(path, "a", encoding="utf-8")
+        # Make the new directory entry durable
+        directory_fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+        self._written = self._synced = 0
+        self._error = None
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="ballot-journal", daemon=True).start()
+
+    def append(self, ballot: Dict[str, Any], wait: bool = True) -> None:
+        """Appends a ballot to the journal, by default waits until the ballot is fsynced.
+
+        The error of a failed fsync is raised by this and every later append of the process, as is a sync that takes longer than the timeout.
+        """
+        line = json.dumps({"crc": _checksum(ballot), "ballot": ballot}, separators=(",", ":")) + "\n"
+        with self._condition:
+            # The file and the flusher thread belong to the process that opened them
+            if self._pid != os.getpid():
+                self._open()
+            if self._error is not None:
+                raise self._error
+            self._file.write(line)
+            self._file.flush()
+            self._written += 1
+            sequence = self._written
+            self._condition.notify_all()
+            deadline = time.monotonic() + self._sync_timeout
+            while wait and self._synced < sequence:
+                if self._error is not None:
+                    raise self._error
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"The ballot journal was not synced to disk within {self._sync_timeout} seconds.")
+                self._condition.wait(timeout=remaining)
+
+    def _run(self) -> None:
+        """The flusher loop, fsyncs the journal once per interval for all the ballots written meanwhile.
+
+        A failed fsync stops the loop, its error is kept for the waiting and the later appends.
+        """
+        pid = os.getpid()
+        while True:
+            with self._condition:
+                while self._synced >= self._written:
+                    self._condition.wait()
+                if self._pid != pid:
+                    return
+            # Let the concurrent writers join the group before syncing
+            time.sleep(self._fsync_interval)
+            try:
+                with self._condition:
+                    target = self._written
+                    file_descriptor = self._file.fileno()
+                _fsync(file_descriptor)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._synced = max(self._synced, target)
+                self._condition.notify_all()
+
+
+def iter_journal_file(path: Path, offset: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Yields the offset after each valid ballot of a journal file and the ballot itself.
+
+    Reading stops at the first torn or corrupted line, which can only be the tail of a file that was being written during a crash.
+    """
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            if _checksum(record["ballot"]) != record["crc"]:
+                return
+            offset += len(line)
+            yield offset, record["ballot"]
+
+
+def iter_journal(directory: Path, offsets: Optional[Dict[str, int]] = None) -> Iterator[Tuple[str, int, Dict[str, Any]]]:
+    """Yields the file name, the next offset and the ballot of every journal file, merged in timestamp and ballot ID order."""
+    offsets = offsets or {}
+    streams = []
+    for path in sorted(Path(directory).glob(JOURNAL_GLOB)):
+        stream = ((path.name, offset, ballot) for offset, ballot in iter_journal_file(path, offsets.get(path.name, 0)))
+        streams.append(stream)
+    return heapq.merge(*streams, key=lambda item: (item[2]["timestamp"], item[2].get("ballot_id", "")))
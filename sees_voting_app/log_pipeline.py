@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: log_pipeline.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the logging pipeline of the voting app. The log
+# records of a worker are put in a bounded in-memory queue, formatted as JSON
+# by a sender thread and sent as datagrams to a listener thread in the gunicorn
+# master, which is the only process that writes and rotates the log files. A
+# full queue drops records instead of blocking the request.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging.handlers import QueueHandler, RotatingFileHandler
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+__all__ = ["JsonFormatter", "LogPipeline", "PipelineHandler"]
+
+
+# The log file of each logger, the records of the other loggers go to the vote log
+LOG_FILES = {"vote": "sees_voting_app.log", "werkzeug": "flask.log", "gunicorn.access": "gunicorn_access.log", "mail": "mail.log"}
+# The attributes of every log record, the other attributes come from the extra argument of the logging call
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+# The maximum size of a datagram, a batch of records is split over several datagrams above it
+MAX_DATAGRAM_SIZE = 32 * 1024
+# The number of records sent or written at once
+BATCH_SIZE = 256
+
+
+class JsonFormatter(logging.Formatter):
+    """A formatter that writes a log record and its extra fields as a JSON object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="microseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        return json.dumps(entry, default=str)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """A rotating file handler that writes a batch of formatted lines with a single flush."""
+
+    def write_batch(self, lines: List[str]) -> None:
+        with self.lock:
+            if self.stream is None:
+                self.stream = self._open()
+            for line in lines:
+                if self.maxBytes > 0 and self.stream.tell() + len(line) + 1 > self.maxBytes:
+                    self.doRollover()
+                self.stream.write(line + self.terminator)
+            self.stream.flush()
+
+
+class PipelineHandler(QueueHandler):
+    """A handler that puts the records in the queue of the log pipeline without ever blocking."""
+
+    def __init__(self, pipeline: "LogPipeline") -> None:
+        super().__init__(queue=None)
+        self.pipeline = pipeline
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.pipeline.enqueue(record)
+
+
+@dataclass
+class LogPipeline:
+    """A class to send the log records of the workers to a single writer in the gunicorn master."""
+
+    _directory: Path = field(compare=False, repr=False)
+    _queue_size: int = field(compare=False, repr=False, default=10000)
+    _max_bytes: int = field(compare=False, repr=False, default=512 * 1024 * 1024)
+    _backup_count: int = field(compare=False, repr=False, default=1000000)
+    _queue: Optional[queue.Queue] = field(init=False, compare=False, repr=False, default=None)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _dropped: int = field(init=False, compare=False, repr=False, default=0)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+    _files: Dict[str, BatchRotatingFileHandler] = field(init=False, compare=False, repr=False, default_factory=dict)
+    _listener: Optional[socket.socket] = field(init=False, compare=False, repr=False, default=None)
+    _formatter: JsonFormatter = field(init=False, compare=False, repr=False, default_factory=JsonFormatter)
+
+    @property
+    def socket_path(self) -> Path:
+        return self._directory / "log_pipeline.sock"
+
+    @property
+    def dropped(self) -> int:
+        """Returns the number of records of this process dropped since the last drop notice."""
+        return self._dropped
+
+    def attach(self, logger: logging.Logger) -> None:
+        """Sends the records of a logger through the pipeline."""
+        logger.addHandler(PipelineHandler(self))
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Puts a record in the queue of this process, the record is dropped if the queue is full."""
+        if self._pid != os.getpid():
+            with self._lock:
+                # The queue and the sender thread belong to the process that created them
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=self._queue_size)
+                    self._dropped = 0
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._send, name="log-pipeline-sender", daemon=True).start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._dropped += 1
+
+    def _send(self) -> None:
+        """The sender loop, formats the records of this process and sends them to the listener in batches."""
+        pid = os.getpid()
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.settimeout(1.0)
+        while self._pid == pid:
+            lines = [self._formatter.format(self._queue.get())]
+            while len(lines) < BATCH_SIZE:
+                try:
+                    lines.append(self._formatter.format(self._queue.get_nowait()))
+                except queue.Empty:
+                    break
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                lines.append(self._drop_notice(dropped, pid))
+
+            for datagram in self._datagrams(lines):
+                try:
+                    sender.sendto(datagram, str(self.socket_path))
+                except socket.timeout:
+                    # The listener is too slow, drop the batch rather than fill the memory
+                    self._dropped += datagram.count(b"\n") + 1
+                except OSError:
+                    # No listener is running, e.g. in debug mode, this process writes the files itself
+                    self._write(datagram.decode().split("\n"))
+
+    @staticmethod
+    def _datagrams(lines: List[str]) -> List[bytes]:
+        """Packs the lines in as few datagrams as possible."""
+        datagrams, current, size = [], [], 0
+        for line in lines:
+            encoded = line.encode()
+            if current and size + len(encoded) + 1 > MAX_DATAGRAM_SIZE:
+                datagrams.append(b"\n".join(current))
+                current, size = [], 0
+            current.append(encoded)
+            size += len(encoded) + 1
+        if current:
+            datagrams.append(b"\n".join(current))
+        return datagrams
+
+    @staticmethod
+    def _drop_notice(dropped: int, pid: int) -> str:
+        """Returns the record that reports the dropped records."""
+        return json.dumps(
+            {
+                "time": datetime.now().isoformat(timespec="microseconds"),
+                "level": "WARNING",
+                "logger": "vote",
+                "pid": pid,
+                "message": f"{dropped} log records were dropped because the log queue was full.",
+                "dropped": dropped,
+            }
+        )
+
+    def _write(self, lines: List[str]) -> None:
+        """Writes the JSON lines to the log file of their logger."""
+        batches: Dict[str, List[str]] = {}
+        for line in lines:
+            try:
+                logger = json.loads(line).get("logger")
+            except ValueError:
+                continue
+            batches.setdefault(LOG_FILES.get(logger, LOG_FILES["vote"]), []).append(line)
+        for filename, batch in batches.items():
+            if filename not in self._files:
+                self._directory.mkdir(parents=True, exist_ok=True)
+                self._files[filename] = BatchRotatingFileHandler(
+                    self._directory / filename, maxBytes=self._max_bytes, backupCount=self._backup_count
+                )
+            self._files[filename].write_batch(batch)
+
+    def start_listener(self) -> None:
+        """Starts the listener thread that writes the records of all the workers, called in the gunicorn master."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._listener.bind(str(self.socket_path))
+        threading.Thread(target=self._listen, args=(self._listener,), name="log-pipeline-listener", daemon=True).start()
+
+    def stop_listener(self) -> None:
+        """Stops the listener and removes its socket."""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            self.socket_path.unlink(missing_ok=True)
+
+    def _listen(self, listener: socket.socket) -> None:
+        """The listener loop, writes the datagrams received meanwhile in one batch."""
+        while True:
+            try:
+                datagrams = [listener.recv(MAX_DATAGRAM_SIZE)]
+                listener.setblocking(False)
+                try:
+                    while len(datagrams) < BATCH_SIZE:
+                        datagrams.append(listener.recv(MAX_DATAGRAM_SIZE))
+                except BlockingIOError:
+                    pass
+                finally:
+                    listener.setblocking(True)
+            except OSError:
+                # The socket was closed
+                return
+            self._write(b"\n".join(datagrams).decode().split("\n"))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: mail_queue.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the mail outbox of the voting app. Emails are
+# stored in a local SQLite database by the request handlers and are sent by a
+# background dispatcher thread that reuses a single SMTP connection per batch,
+# retries failed messages with exponential backoff and can collapse the admin
+# vote notifications into periodic digests.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from flask_mailman import EmailMessage
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from sees_voting_app.metrics import metrics
+
+
+__all__ = ["MailOutbox"]
+
+
+# The records of the outbox are written to their own log file by the log pipeline
+logger = logging.getLogger("mail")
+
+
+@dataclass
+class MailOutbox:
+    """A class to durably queue emails and send them from a background thread."""
+
+    _path: Path = field(compare=False, repr=False)
+    _app: Any = field(init=False, compare=False, repr=False, default=None)
+    _mail: Any = field(init=False, compare=False, repr=False, default=None)
+    _batch_size: int = field(init=False, compare=False, repr=False, default=50)
+    _max_attempts: int = field(init=False, compare=False, repr=False, default=8)
+    _retry_base: float = field(init=False, compare=False, repr=False, default=5.0)
+    _retry_max: float = field(init=False, compare=False, repr=False, default=900.0)
+    _poll_interval: float = field(init=False, compare=False, repr=False, default=2.0)
+    _claim_timeout: float = field(init=False, compare=False, repr=False, default=300.0)
+    _digest_interval: float = field(init=False, compare=False, repr=False, default=0.0)
+    _thread: Optional[threading.Thread] = field(init=False, compare=False, repr=False, default=None)
+    _thread_pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _wakeup: threading.Event = field(init=False, compare=False, repr=False, default_factory=threading.Event)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def init_app(self, app, mail) -> None:
+        """Reads the outbox settings from the app configuration and creates the outbox table."""
+        self._app = app
+        self._mail = mail
+        self._batch_size = int(app.config.get("MAIL_OUTBOX_BATCH_SIZE", self._batch_size))
+        self._max_attempts = int(app.config.get("MAIL_OUTBOX_MAX_ATTEMPTS", self._max_attempts))
+        self._digest_interval = float(app.config.get("MAIL_ADMIN_DIGEST_INTERVAL", self._digest_interval))
+
+        # Create the outbox table
+        with self._connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    claimed_by INTEGER,
+                    claimed_at REAL,
+                    last_error TEXT
+                )
+                """
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, kind, next_attempt_at)")
+
+    @contextmanager
+    def _connect(self):
+        """Returns a connection to the outbox database, the connection is closed on exit."""
+        connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            yield connection
+        finally:
+            connection.close()
+
+    @property
+    def digest_enabled(self) -> bool:
+        """Returns True if the admin vote notifications are sent as periodic digests."""
+        return self._digest_interval > 0
+
+    def enqueue(self, msg: EmailMessage) -> None:
+        """Stores an email message in the outbox."""
+        payload = {
+            "subject": msg.subject,
+            "body": msg.body,
+            "from_email": msg.from_email,
+            "to": list(msg.to),
+            "cc": list(msg.cc),
+            "bcc": list(msg.bcc),
+            "reply_to": list(msg.reply_to),
+            "content_subtype": msg.content_subtype,
+        }
+        with metrics.time("mail_enqueue"):
+            self._insert(kind="message", payload=payload)
+
+    def enqueue_digest_entry(self, subject: str, header: str, entry: str, footer: str, from_email: str, to: List[str]) -> None:
+        """Stores an entry that is sent as part of the next digest email."""
+        payload = {"subject": subject, "header": header, "entry": entry, "footer": footer, "from_email": from_email, "to": list(to)}
+        with metrics.time("mail_enqueue"):
+            self._insert(kind="digest", payload=payload)
+
+    def _insert(self, kind: str, payload: Dict[str, Any]) -> None:
+        """Adds a new row to the outbox and wakes up the dispatcher."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO outbox (kind, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload), now, now),
+            )
+        self.start()
+        self._wakeup.set()
+
+    def start(self) -> None:
+        """Starts the dispatcher thread of this process if it is not already running."""
+        if self._thread_pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="mail-outbox", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self) -> None:
+        """The dispatcher loop, sends the due messages and digests until the process exits."""
+        while True:
+            self._wakeup.wait(timeout=self._poll_interval)
+            self._wakeup.clear()
+            try:
+                while self.dispatch():
+                    pass
+            except Exception as e:
+                logger.exception(f"An error occurred while dispatching the mail outbox: {e}")
+
+    def counts(self) -> Dict[str, int]:
+        """Returns the number of rows of the outbox by status."""
+        with self._connect() as connection:
+            return dict(connection.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    def _claim(self, connection, kind: str, limit: int) -> List[Tuple[int, int, Dict[str, Any]]]:
+        """Claims the due rows of the given kind for this process."""
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                """
+                SELECT id, attempts, payload FROM outbox
+                WHERE status = 'pending' AND kind = ? AND next_attempt_at <= ?
+                AND (claimed_at IS NULL OR claimed_at < ?)
+                ORDER BY id LIMIT ?
+                """,
+                (kind, now, now - self._claim_timeout, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE outbox SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                [(os.getpid(), now, row[0]) for row in rows],
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return [(row[0], row[1], json.loads(row[2])) for row in rows]
+
+    def _digest_due(self, connection) -> bool:
+        """Returns True if the oldest pending digest entry has waited for a full digest interval."""
+        row = connection.execute(
+            "SELECT MIN(created_at) FROM outbox WHERE status = 'pending' AND kind = 'digest' AND claimed_at IS NULL"
+        ).fetchone()
+        return row[0] is not None and row[0] <= time.time() - self._digest_interval
+
+    def _release(self, connection, rows: List[Tuple[int, int, Dict[str, Any]]], error: Exception) -> None:
+        """Schedules a retry with exponential backoff, or gives up after the maximum number of attempts."""
+        now = time.time()
+        updates = []
+        for row_id, attempts, _ in rows:
+            attempts += 1
+            status = "failed" if attempts >= self._max_attempts else "pending"
+            delay = min(self._retry_base * 2 ** (attempts - 1), self._retry_max)
+            updates.append((attempts, status, now + delay, str(error), row_id))
+        connection.executemany(
+            "UPDATE outbox SET attempts = ?, status = ?, next_attempt_at = ?, last_error = ?, claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+            updates,
+        )
+
+    def _delete(self, connection, row_ids: List[int]) -> None:
+        """Removes the sent rows from the outbox."""
+        connection.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    @staticmethod
+    def _build_digest(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Collapses the digest entries into a single message payload."""
+        body = entries[0]["header"] + "\n\n".join(entry["entry"] for entry in entries) + entries[0]["footer"]
+        return {
+            "subject": f"{entries[0]['subject']} ({len(entries)})",
+            "body": body,
+            "from_email": entries[0]["from_email"],
+            "to": entries[0]["to"],
+        }
+
+    def dispatch(self) -> bool:
+        """Sends one batch of due messages over a single SMTP connection, returns True if a full batch was claimed."""
+        with self._connect() as connection:
+            messages = self._claim(connection, kind="message", limit=self._batch_size)
+            digest = []
+            if self.digest_enabled and self._digest_due(connection):
+                digest = self._claim(connection, kind="digest", limit=self._batch_size * 20)
+            elif not self.digest_enabled:
+                # Send the digest entries left over from a previous configuration as regular messages
+                messages += self._claim(connection, kind="digest", limit=self._batch_size)
+            if not messages and not digest:
+                return False
+
+            with self._app.app_context():
+                mail_connection = self._mail.get_connection()
+                try:
+                    mail_connection.open()
+                except Exception as e:
+                    rows = messages + digest
+                    logger.warning(
+                        f"An error occurred while connecting to the mail server, {len(rows)} outbox rows are released: {e}",
+                        extra={"outbox_ids": [row[0] for row in rows], "attempts": [row[1] + 1 for row in rows]},
+                    )
+                    metrics.inc("sees_errors_total", {"kind": "smtp_connect"})
+                    self._release(connection, rows, error=e)
+                    return False
+
+                try:
+                    # Send the messages one by one so that a failure only affects its own row
+                    for row in messages:
+                        payload = row[2] if "entry" not in row[2] else self._build_digest([row[2]])
+                        try:
+                            with metrics.time("smtp_send"):
+                                self._send(mail_connection, payload)
+                        except Exception as e:
+                            logger.warning(
+                                f"An error occurred while sending the email of outbox row {row[0]}, attempt {row[1] + 1} of {self._max_attempts}: {e}",
+                                extra={"outbox_id": row[0], "attempt": row[1] + 1},
+                            )
+                            metrics.inc("sees_errors_total", {"kind": "smtp_send"})
+                            self._release(connection, [row], error=e)
+                        else:
+                            metrics.inc("sees_mail_sent_total")
+                            self._delete(connection, [row[0]])
+
+                    # Group the digest entries by recipients and send one email per group
+                    groups: Dict[Tuple[str, ...], List[Tuple[int, int, Dict[str, Any]]]] = {}
+                    for row in digest:
+                        groups.setdefault(tuple(row[2]["to"]), []).append(row)
+                    for rows in groups.values():
+                        try:
+                            with metrics.time("smtp_send"):
+                                self._send(mail_connection, self._build_digest([row[2] for row in rows]))
+                        except Exception as e:
+                            logger.warning(
+                                f"An error occurred while sending the digest email of {len(rows)} outbox rows: {e}",
+                                extra={"outbox_ids": [row[0] for row in rows], "attempts": [row[1] + 1 for row in rows]},
+                            )
+                            metrics.inc("sees_errors_total", {"kind": "smtp_send"})
+                            self._release(connection, rows, error=e)
+                        else:
+                            metrics.inc("sees_mail_sent_total")
+                            self._delete(connection, [row[0] for row in rows])
+                finally:
+                    mail_connection.close()
+
+        return len(messages) >= self._batch_size
+
+    @staticmethod
+    def _send(mail_connection, payload: Dict[str, Any]) -> None:
+        """Sends a message payload through an open mail connection."""
+        msg = EmailMessage(
+            subject=payload["subject"],
+            body=payload["body"],
+            from_email=payload["from_email"],
+            to=payload["to"],
+            cc=payload.get("cc"),
+            bcc=payload.get("bcc"),
+            reply_to=payload.get("reply_to"),
+            connection=mail_connection,
+        )
+        msg.content_subtype = payload.get("content_subtype", "plain")
+        mail_connection.send_messages([msg])
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: metrics.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to collect the metrics of the voting app. Every process
+# writes its counters and histograms to its own memory-mapped file, so a
+# timing span costs a few memory writes, and the /metrics endpoint merges the
+# files of all the gunicorn workers into the Prometheus text format.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+__all__ = ["Metrics", "metrics"]
+
+
+# The upper bounds, in seconds, of the buckets of the duration histograms
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# The type and the help text of every metric
+METRICS = {
+    "sees_request_duration_seconds": ("histogram", "Duration of the requests by endpoint and method."),
+    "sees_stage_duration_seconds": ("histogram", "Duration of each stage of a request."),
+    "sees_votes_total": ("counter", "Vote submissions by outcome."),
+    "sees_admission_rejections_total": ("counter", "Vote submissions shed by the admission control by reason."),
+    "sees_errors_total": ("counter", "Errors by kind."),
+    "sees_voter_index_lookups_total": ("counter", "Voter index lookups by result: new voter, confirmed duplicate or false positive."),
+    "sees_mail_sent_total": ("counter", "Emails sent by the mail outbox."),
+    "sees_mail_outbox_rows": ("gauge", "Rows of the mail outbox by status."),
+    "sees_db_group_commits_total": ("counter", "Transactions of the group commit of the votes."),
+    "sees_db_group_commit_votes_total": ("counter", "Votes written by the group commit."),
+    "sees_ballot_buffer_total": ("counter", "Votes stored in the ballot buffer and the outcome of their replay."),
+    "sees_ballot_buffer_rows": ("gauge", "Rows of the ballot buffer by status."),
+    "sees_db_breaker_open": ("gauge", "1 while the database circuit breaker of each worker is open."),
+    "sees_db_busy_retries_total": ("counter", "Database writes tried again after SQLITE_BUSY."),
+    "sees_db_pool_checkouts_total": ("counter", "Connections checked out of the database pools."),
+    "sees_db_pool_checkout_timeouts_total": ("counter", "Checkouts that timed out waiting for a connection."),
+    "sees_db_pool_wait_seconds_total": ("counter", "Time spent waiting for a connection of the database pools."),
+    "sees_db_pool_checked_out": ("gauge", "Connections checked out of the database pool of each worker."),
+    "sees_db_pool_overflow": ("gauge", "Overflow connections of the database pool of each worker."),
+}
+
+# The layout of the metrics files: the used size, then entries of key length, key padded to 8 bytes and value
+_USED = struct.Struct("q")
+_KEY_LENGTH = struct.Struct("i")
+_VALUE = struct.Struct("d")
+_INITIAL_SIZE = 64 * 1024
+
+# A metric key is a metric name and its sorted labels
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _entries(data: bytes) -> Iterator[Tuple[str, int, float]]:
+    """Yields the key, the value offset and the value of every entry of a metrics file."""
+    used = _USED.unpack_from(data, 0)[0] if len(data) >= _USED.size else 0
+    position = _USED.size
+    while position < used:
+        length = _KEY_LENGTH.unpack_from(data, position)[0]
+        key = data[position + _KEY_LENGTH.size : position + _KEY_LENGTH.size + length].decode()
+        position += (_KEY_LENGTH.size + length + 7) // 8 * 8
+        yield key, position, _VALUE.unpack_from(data, position)[0]
+        position += _VALUE.size
+
+
+class _MetricsFile:
+    """A memory-mapped file of float values, written by a single process and read by any."""
+
+    def __init__(self, path: Path) -> None:
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(_INITIAL_SIZE)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        if _USED.unpack_from(self._mmap, 0)[0] == 0:
+            _USED.pack_into(self._mmap, 0, _USED.size)
+        self._offsets = {key: offset for key, offset, _ in _entries(self._mmap)}
+
+    def _offset(self, key: str) -> int:
+        """Returns the value offset of a key, the entry is appended on first use."""
+        offset = self._offsets.get(key)
+        if offset is None:
+            encoded = key.encode()
+            used = _USED.unpack_from(self._mmap, 0)[0]
+            offset = used + (_KEY_LENGTH.size + len(encoded) + 7) // 8 * 8
+            if offset + _VALUE.size > len(self._mmap):
+                size = len(self._mmap) * 2
+                self._mmap.close()
+                self._file.truncate(size)
+                self._mmap = mmap.mmap(self._file.fileno(), 0)
+            _KEY_LENGTH.pack_into(self._mmap, used, len(encoded))
+            self._mmap[used + _KEY_LENGTH.size : used + _KEY_LENGTH.size + len(encoded)] = encoded
+            _VALUE.pack_into(self._mmap, offset, 0.0)
+            # The entry is complete before the readers can see it
+            _USED.pack_into(self._mmap, 0, offset + _VALUE.size)
+            self._offsets[key] = offset
+        return offset
+
+    def add(self, key: str, amount: float) -> None:
+        offset = self._offset(key)
+        _VALUE.pack_into(self._mmap, offset, _VALUE.unpack_from(self._mmap, offset)[0] + amount)
+
+    def set(self, key: str, value: float) -> None:
+        _VALUE.pack_into(self._mmap, self._offset(key), value)
+
+
+@dataclass
+class Metrics:
+    """A class to record the metrics of this process and to merge the metrics of all the processes."""
+
+    _directory: Path = field(compare=False, repr=False)
+    _counters: Optional[_MetricsFile] = field(init=False, compare=False, repr=False, default=None)
+    _gauges: Optional[_MetricsFile] = field(init=False, compare=False, repr=False, default=None)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    @staticmethod
+    def _key(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+        return json.dumps([name, sorted((labels or {}).items())])
+
+    def _open(self) -> None:
+        """Opens the metrics files of this process, the counters of a pid survive it, the gauges do not."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._counters = _MetricsFile(self._directory / f"counters_{os.getpid()}.db")
+        self._gauges = _MetricsFile(self._directory / f"gauges_{os.getpid()}.db")
+        self._pid = os.getpid()
+
+    def _write(self, mode: str, key: str, value: float) -> None:
+        """Adds to a counter, or sets a counter total or a gauge, in the files of this process."""
+        with self._lock:
+            # The files belong to the process that opened them
+            if self._pid != os.getpid():
+                self._open()
+            if mode == "gauge":
+                self._gauges.set(key, value)
+            elif mode == "total":
+                self._counters.set(key, value)
+            else:
+                self._counters.add(key, value)
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, amount: float = 1.0) -> None:
+        """Increments a counter."""
+        self._write("add", self._key(name, labels), amount)
+
+    def set_total(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        """Sets the running total of a counter kept by this process, e.g. the statistics of its database pool."""
+        self._write("total", self._key(name, labels), value)
+
+    def set(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        """Sets a gauge of this process, it is reported with a pid label."""
+        self._write("gauge", self._key(name, {**(labels or {}), "pid": str(os.getpid())}), value)
+
+    def observe(self, name: str, seconds: float, labels: Optional[Dict[str, str]] = None) -> None:
+        """Adds a duration to a histogram."""
+        labels = labels or {}
+        le = DURATION_BUCKETS[bisect.bisect_left(DURATION_BUCKETS, seconds)]
+        self._write("add", self._key(f"{name}_bucket", {**labels, "le": repr(le)}), 1)
+        self._write("add", self._key(f"{name}_sum", labels), seconds)
+        self._write("add", self._key(f"{name}_count", labels), 1)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """Times a stage of a request, the duration is recorded even if the stage raises an exception."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("sees_stage_duration_seconds", time.perf_counter() - start, {"stage": stage})
+
+    def clear(self) -> None:
+        """Removes the metrics files of the previous run, called by the gunicorn master on start."""
+        if self._directory.exists():
+            for path in self._directory.glob("*.db"):
+                path.unlink(missing_ok=True)
+
+    def remove_process(self, pid: int) -> None:
+        """Removes the gauges of a process that exited, its counters keep counting in the totals."""
+        (self._directory / f"gauges_{pid}.db").unlink(missing_ok=True)
+
+    def _collect(self) -> Dict[Key, float]:
+        """Merges the files of all the processes, the values of the same key are summed."""
+        values: Dict[Key, float] = {}
+        for path in sorted(self._directory.glob("*.db")) if self._directory.exists() else []:
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                continue
+            for key, _, value in _entries(data):
+                name, labels = json.loads(key)
+                key = (name, tuple(tuple(label) for label in labels))
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+    def exposition(self, extra: Optional[Dict[Key, float]] = None) -> str:
+        """Returns the metrics of all the processes in the Prometheus text format."""
+        values = self._collect()
+        values.update(extra or {})
+        lines: List[str] = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                lines.extend(self._histogram_lines(name, values))
+                continue
+            for (key_name, labels), value in sorted(values.items()):
+                if key_name == name:
+                    lines.append(f"{name}{self._labels(labels)} {value:.10g}")
+        return "\n".join(lines) + "\n"
+
+    def _histogram_lines(self, name: str, values: Dict[Key, float]) -> List[str]:
+        """Returns the cumulative bucket, sum and count lines of a histogram."""
+        lines = []
+        label_sets = sorted(labels for key_name, labels in values if key_name == f"{name}_count")
+        for labels in label_sets:
+            cumulative = 0.0
+            for le in DURATION_BUCKETS:
+                cumulative += values.get((f"{name}_bucket", tuple(sorted(labels + (("le", repr(le)),)))), 0.0)
+                bucket_labels = labels + (("le", "+Inf" if le == float("inf") else repr(le)),)
+                lines.append(f"{name}_bucket{self._labels(bucket_labels)} {cumulative:.10g}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values.get((f'{name}_sum', labels), 0.0):.10g}")
+            lines.append(f"{name}_count{self._labels(labels)} {values.get((f'{name}_count', labels), 0.0):.10g}")
+        return lines
+
+    @staticmethod
+    def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# The metrics of this process, next to the log files
+metrics = Metrics(_directory=Path("logs") / "metrics")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: page_cache.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to cache the rendered pages of the voting app. The pages
+# are rendered once per process and split around their CSRF token, so only
+# the token is injected for each request. It also provides the content-hashed
+# URLs of the static files, which can be cached by the browsers for a year.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import hashlib
+from dataclasses import dataclass, field
+from flask import current_app
+from pathlib import Path
+from typing import Dict, Hashable, Optional, Tuple
+
+
+__all__ = ["CachedPage", "PageCache", "static_url"]
+
+
+# The hashes of the static files, they only change on a deployment, i.e. on a restart
+_static_hashes: Dict[str, str] = {}
+
+
+@dataclass
+class CachedPage:
+    """A class to represent a rendered page split around its CSRF token."""
+
+    parts: Tuple[str, ...] = field(compare=False, repr=False)
+    etag: str = field(compare=False)
+
+    @property
+    def has_token(self) -> bool:
+        """Returns True if a CSRF token has to be injected in the page."""
+        return len(self.parts) > 1
+
+    def render(self, csrf_token: Optional[str] = None) -> str:
+        """Returns the page with the given CSRF token injected."""
+        return (csrf_token or "").join(self.parts)
+
+
+@dataclass
+class PageCache:
+    """A class to keep the rendered pages of this process."""
+
+    _pages: Dict[Hashable, CachedPage] = field(init=False, compare=False, repr=False, default_factory=dict)
+
+    def get(self, key: Hashable) -> Optional[CachedPage]:
+        """Returns the cached page for the given key, if any."""
+        return self._pages.get(key)
+
+    def store(self, key: Hashable, html: str, csrf_token: Optional[str] = None) -> CachedPage:
+        """Caches a rendered page, the CSRF token it was rendered with is cut out of it."""
+        parts = tuple(html.split(csrf_token)) if csrf_token else (html,)
+        page = CachedPage(parts=parts, etag=hashlib.sha256("".join(parts).encode()).hexdigest()[:32])
+        self._pages[key] = page
+        return page
+
+    def clear(self) -> None:
+        """Removes all the cached pages."""
+        self._pages.clear()
+
+
+def static_url(filename: str) -> str:
+    """Returns the URL of a static file with the hash of its content, used as a template global."""
+    if filename not in _static_hashes:
+        content = (Path(current_app.static_folder) / filename).read_bytes()
+        _static_hashes[filename] = hashlib.sha256(content).hexdigest()[:12]
+    return f"{current_app.config['STATIC_URL_PREFIX']}/{filename}?v={_static_hashes[filename]}"
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: profiler.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to profile single production requests. The profiling
+# middleware wraps the Flask app and, for the requests that carry the admin
+# profiling header or are picked by the sampling rate, samples the stack of
+# the request thread, or of the request greenlet in a gevent worker, every
+# few milliseconds. The samples are written as a collapsed-stack file, which
+# speedscope and the flame graph tools can open.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import collections
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Counter, Deque, Optional
+
+
+__all__ = ["ProfilerMiddleware", "SamplingProfiler"]
+
+
+# The header that requests a profile, its value must be the ADMIN_API_TOKEN
+PROFILE_HEADER = "HTTP_X_PROFILE_TOKEN"
+# Characters that are not kept in the profile file names
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]+")
+# The leaf frame of the samples taken while the request greenlet waits for another greenlet or for I/O
+SWITCHED_OUT_FRAME = "(switched out)"
+
+
+def _original(module: str, name: str):
+    """Returns a function of the standard library that is not replaced by the gevent monkey patching."""
+    if "gevent.monkey" in sys.modules:
+        return sys.modules["gevent.monkey"].get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+def _request_greenlet() -> Any:
+    """Returns the greenlet of the current request in a monkey patched gevent worker, None in a sync worker."""
+    if "gevent.monkey" in sys.modules and sys.modules["gevent.monkey"].is_module_patched("threading"):
+        import gevent
+
+        return gevent.getcurrent()
+    return None
+
+
+@dataclass
+class SamplingProfiler:
+    """A class to sample the stack of a thread, or of a greenlet of that thread, from a background OS thread.
+
+    The greenlets of a gevent worker share its thread, so the stack of the thread is only that of the profiled greenlet while it runs. When
+    the greenlet is switched out its own suspended stack is sampled instead, with the SWITCHED_OUT_FRAME leaf.
+    """
+
+    _thread_id: int = field(compare=False, repr=False)
+    _greenlet: Any = field(compare=False, repr=False, default=None)
+    _interval: float = field(compare=False, repr=False, default=0.002)
+    _stacks: Counter[str] = field(init=False, compare=False, repr=False, default_factory=collections.Counter)
+    _stopped: bool = field(init=False, compare=False, repr=False, default=False)
+    _running: Any = field(init=False, compare=False, repr=False, default=None)
+
+    def start(self) -> None:
+        """Starts the sampler, it is an OS thread even in a gevent worker so it samples while the greenlets run."""
+        self._running = _original("_thread", "allocate_lock")()
+        self._running.acquire()
+        _original("_thread", "start_new_thread")(self._run, ())
+
+    def stop(self) -> Counter[str]:
+        """Stops the sampler and returns the number of samples of each collapsed stack."""
+        self._stopped = True
+        # Wait for the sampler thread to finish its last sample
+        self._running.acquire(timeout=1.0)
+        return self._stacks
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        """Returns a stack as the root-first, semicolon-separated frames of the collapsed-stack format."""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})".replace(";", ","))
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    def _run(self) -> None:
+        sleep = _original("time", "sleep")
+        try:
+            while not self._stopped:
+                # An active greenlet has no saved frame only while it is the one running in its thread
+                frame = self._greenlet.gr_frame if self._greenlet is not None else None
+                if frame is not None:
+                    self._stacks[f"{self._collapse(frame)};{SWITCHED_OUT_FRAME}"] += 1
+                else:
+                    frame = sys._current_frames().get(self._thread_id)
+                    if frame is not None:
+                        self._stacks[self._collapse(frame)] += 1
+                sleep(self._interval)
+        finally:
+            self._running.release()
+
+
+@dataclass
+class ProfilerMiddleware:
+    """A WSGI middleware that profiles the requests with the admin profiling header or a random share of the requests."""
+
+    _wsgi_app: Callable = field(compare=False, repr=False)
+    _directory: Path = field(compare=False, repr=False)
+    _token: Optional[str] = field(compare=False, repr=False, default=None)
+    _sample_rate: float = field(compare=False, repr=False, default=0.0)
+    _min_duration: float = field(compare=False, repr=False, default=0.0)
+    _interval: float = field(compare=False, repr=False, default=0.002)
+    _max_per_minute: int = field(compare=False, repr=False, default=6)
+    _recent: Deque[float] = field(init=False, compare=False, repr=False, default_factory=collections.deque)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+    _running: bool = field(init=False, compare=False, repr=False, default=False)
+
+    def _requested(self, environ) -> bool:
+        """Returns True if the request carries the admin profiling header."""
+        header = environ.get(PROFILE_HEADER)
+        return bool(self._token and header and hmac.compare_digest(header.encode(), self._token.encode()))
+
+    def _acquire(self) -> bool:
+        """Takes a profiling slot, one profile at a time and at most max_per_minute profiles per minute in each worker."""
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and self._recent[0] < now - 60:
+                self._recent.popleft()
+            if self._running or len(self._recent) >= self._max_per_minute:
+                return False
+            self._running = True
+            self._recent.append(now)
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._running = False
+
+    def _write(self, environ, stacks: Counter[str], duration: float) -> Path:
+        """Writes the samples of a request to a collapsed-stack file and returns its path."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        request = _UNSAFE_NAME.sub("_", f"{environ.get('REQUEST_METHOD', '')}{environ.get('PATH_INFO', '')}").strip("_")
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}.{time.time_ns() // 1_000_000 % 1000:03d}_{request or 'root'}_{os.getpid()}_{duration * 1000:.0f}ms.collapsed"
+        path = self._directory / name
+        with open(path, "w") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        return path
+
+    def __call__(self, environ, start_response):
+        requested = self._requested(environ)
+        if not requested and (self._sample_rate <= 0 or random.random() >= self._sample_rate):
+            return self._wsgi_app(environ, start_response)
+        if not self._acquire():
+            return self._wsgi_app(environ, start_response)
+
+        profiler = SamplingProfiler(_thread_id=_original("_thread", "get_ident")(), _greenlet=_request_greenlet(), _interval=self._interval)
+        try:
+            profiler.start()
+            start = time.perf_counter()
+            try:
+                response = self._wsgi_app(environ, start_response)
+            finally:
+                duration = time.perf_counter() - start
+                stacks = profiler.stop()
+            # The sampled requests are only kept if they are slow, a requested profile is always written
+            if requested or (stacks and duration >= self._min_duration):
+                self._write(environ, stacks, duration)
+        finally:
+            self._release()
+        return response
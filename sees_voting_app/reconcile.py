@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: reconcile.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to reconcile the three records of the ballots: the ballot
+# files (the journal and the per-vote CSV files of older versions), the votes
+# table and the vote log. The ballots of the three sources are sorted by
+# ORCID iD with an external merge sort, so the memory use does not depend on
+# the number of voters, and merged to report the missing, duplicate and
+# conflicting ballots. The ballots missing from the votes table can be added
+# from the ballot files in batches.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import csv
+import heapq
+import itertools
+import json
+import os
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sees_voting_app.config import data_dir
+from sees_voting_app.database import VoteModel, session_scope
+from sees_voting_app.journal import iter_journal
+from sees_voting_app.utils import VOTE_FILE_PATTERN, vote_file_timestamp
+from sees_voting_app.voting_system import VotingSystem
+
+
+__all__ = ["SOURCES", "reconcile"]
+
+
+# The sources of the ballots, in the order of the report columns
+SOURCES = ("files", "db", "log")
+# The vote log and its rotated files
+VOTE_LOG_GLOB = "sees_voting_app.log*"
+
+# A ballot of a source: the normalized ORCID iD, the source and the ballot
+Record = Tuple[str, str, Dict[str, Any]]
+
+
+def _normalize_orcid(orcid_id: str) -> str:
+    return orcid_id.strip().upper()
+
+
+def _file_records() -> Iterator[Record]:
+    """Yields the ballots of the journal, once per ballot ID, and of the per-vote CSV files."""
+    seen_ballot_ids = set()
+    for _, _, ballot in iter_journal(data_dir / "journal"):
+        ballot_id = ballot.get("ballot_id")
+        if ballot_id is not None:
+            if ballot_id in seen_ballot_ids:
+                continue
+            seen_ballot_ids.add(ballot_id)
+        yield _normalize_orcid(ballot["orcid_id"]), "files", ballot
+
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            match = VOTE_FILE_PATTERN.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            with open(entry.path, "r", newline="") as file:
+                reader = csv.reader(file)
+                next(reader, None)  # Skip the header
+                for row in reader:
+                    if len(row) < 7:
+                        continue
+                    ballot = {
+                        "ballot_id": entry.name,
+                        "timestamp": vote_file_timestamp(match.group("timestamp")),
+                        "full_name": row[0],
+                        "email": row[1],
+                        "orcid_id": row[2],
+                        "selections": row[3:7],
+                    }
+                    yield _normalize_orcid(row[2]), "files", ballot
+
+
+def _db_records(chunk_size: int) -> Iterator[Record]:
+    """Yields the ballots of the votes table, streamed in chunks."""
+    columns = (
+        VoteModel.id,
+        VoteModel.timestamp,
+        VoteModel.full_name,
+        VoteModel.email,
+        VoteModel.orcid_id,
+        VoteModel.selection_1,
+        VoteModel.selection_2,
+        VoteModel.selection_3,
+        VoteModel.selection_4,
+    )
+    with session_scope() as session:
+        for row in session.query(*columns).yield_per(chunk_size):
+            ballot = {
+                "ballot_id": f"db:{row[0]}",
+                "timestamp": row[1].isoformat(timespec="microseconds"),
+                "full_name": row[2],
+                "email": row[3],
+                "orcid_id": row[4],
+                "selections": list(row[5:9]),
+            }
+            yield _normalize_orcid(row[4]), "db", ballot
+
+
+def _log_records(log_directory: Path) -> Iterator[Record]:
+    """Yields the ballots of the JSON vote log and its rotated files, the other lines are skipped."""
+    for path in sorted(log_directory.glob(VOTE_LOG_GLOB)):
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict) or entry.get("logger") != "vote" or "ballot_id" not in entry:
+                    continue
+                ballot = {"ballot_id": entry["ballot_id"], "orcid_id": entry["orcid_id"], "selections": entry["selections"]}
+                yield _normalize_orcid(entry["orcid_id"]), "log", ballot
+
+
+def _write_run(records: List[Record], directory: Path, number: int) -> Path:
+    """Sorts a run of records and writes it to a temporary file."""
+    records.sort(key=lambda record: record[0])
+    path = directory / f"run-{number:06d}.jsonl"
+    with open(path, "w", encoding="utf-8") as file:
+        file.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+    return path
+
+
+def _read_run(path: Path) -> Iterator[Record]:
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            yield tuple(json.loads(line))
+
+
+def _external_sort(records: Iterable[Record], directory: Path, run_size: int) -> Iterator[Record]:
+    """Sorts the records by ORCID iD, in memory if they fit in a single run, else in sorted runs merged from disk."""
+    runs = []
+    run = []
+    for record in records:
+        run.append(record)
+        if len(run) >= run_size:
+            runs.append(_write_run(run, directory, len(runs)))
+            run = []
+    if not runs:
+        run.sort(key=lambda record: record[0])
+        return iter(run)
+    if run:
+        runs.append(_write_run(run, directory, len(runs)))
+    return heapq.merge(*(_read_run(path) for path in runs), key=lambda record: record[0])
+
+
+def _issues(ballots: Dict[str, List[Dict[str, Any]]]) -> List[Tuple[str, str]]:
+    """Returns the issues of the ballots of one ORCID iD as (issue, detail) pairs."""
+    issues = []
+    for source in SOURCES:
+        if not ballots[source]:
+            issues.append((f"missing from {source}", ""))
+        elif len(ballots[source]) > 1:
+            issues.append((f"duplicate in {source}", f"{len(ballots[source])} ballots"))
+
+    # Compare the first ballot of every source that has one
+    present = [source for source in SOURCES if ballots[source]]
+    if len({tuple(ballots[source][0]["selections"]) for source in present}) > 1:
+        issues.append(("conflicting selections", ""))
+    emails = {ballots[source][0]["email"].strip().casefold() for source in present if "email" in ballots[source][0]}
+    if len(emails) > 1:
+        issues.append(("conflicting emails", ""))
+    return issues
+
+
+def _repair(ballots: List[Dict[str, Any]], counts: Counter) -> None:
+    """Adds a batch of ballots to the votes table, an email already used by another voter is reported as a duplicate."""
+    outcomes = VotingSystem().record_buffered_votes(ballots)
+    counts.update(f"repair: {outcome}" for outcome in outcomes.values())
+
+
+def reconcile(
+    report_path: Optional[Path] = None,
+    log_directory: Path = Path("logs"),
+    repair: bool = False,
+    run_size: int = 100000,
+    batch_size: int = 500,
+) -> Dict[str, int]:
+    """Reconciles the ballot files, the votes table and the vote log, returns the number of ORCID iDs with each issue.
+
+    Every issue is written to the report CSV file. With repair, a ballot that is only missing from the votes table is added to
+    it from the ballot files, the ORCID iDs with duplicate or conflicting ballots are left to the administrators.
+    """
+    report_path = Path(report_path) if report_path is not None else data_dir / "reconciliation.csv"
+    counts: Counter = Counter()
+    batch: List[Dict[str, Any]] = []
+
+    with tempfile.TemporaryDirectory(prefix="sees-reconcile-", dir=data_dir) as directory:
+        records = itertools.chain(_file_records(), _db_records(chunk_size=10000), _log_records(log_directory))
+        with open(report_path, "w", newline="") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["ORCIDiD", "Issue", "Detail", *(f"{source} selections" for source in SOURCES)])
+            for orcid_id, group in itertools.groupby(_external_sort(records, Path(directory), run_size), key=lambda record: record[0]):
+                ballots = {source: [] for source in SOURCES}
+                for _, source, ballot in group:
+                    ballots[source].append(ballot)
+                counts["ORCID iDs"] += 1
+                issues = _issues(ballots)
+                selections = [json.dumps(ballots[source][0]["selections"]) if ballots[source] else "" for source in SOURCES]
+                for issue, detail in issues:
+                    counts[issue] += 1
+                    writer.writerow([orcid_id, issue, detail, *selections])
+
+                # Only a ballot that is missing from the votes table and has a single, unambiguous ballot file is repaired
+                names = {issue for issue, _ in issues}
+                if repair and "missing from db" in names and len(ballots["files"]) == 1 and not names & {"conflicting selections", "conflicting emails"}:
+                    batch.append(ballots["files"][0])
+                    if len(batch) >= batch_size:
+                        _repair(batch, counts)
+                        batch = []
+
+    if batch:
+        _repair(batch, counts)
+    return dict(counts)
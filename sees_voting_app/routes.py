@@ -12,91 +12,230 @@
 # This software is distributed under the terms of the MIT license.
 # -----------------------------------------------------------------------------
 
-from flask import Blueprint, render_template, request, flash
+import hmac
+from flask import Blueprint, abort, current_app, g, jsonify, make_response, render_template, request
+from flask_wtf.csrf import generate_csrf
 from datetime import datetime
+from functools import wraps
 
-from sees_voting_app import sender_address, admin_mailing_list, vote_logger, voting_ends
-from sees_voting_app.database import DBException
+from sees_voting_app import sender_address, admin_mailing_list, admission_control, mail_outbox, vote_logger, voting_ends
+from sees_voting_app.database import DBException, DuplicateVoteException
 from sees_voting_app.forms import VoteForm
-from sees_voting_app.voting_system import Voter, VotingSystem
+from sees_voting_app.metrics import metrics
+from sees_voting_app.page_cache import PageCache
+from sees_voting_app.voting_system import Voter, VotingSystem, ballot_buffer, candidate_registry, eligibility_roll
 from sees_voting_app.utils import send_comfirmation_email, send_vote_to_admin_group, send_database_error_email
-from sees_voting_app.config import initialize_db
-
-global db_config, db_engine, db_session, base
-db_config = db_engine = db_session = base = None
+from sees_voting_app.config import engine_registry
 
 # Create a Blueprint for the voting routes
 voting = Blueprint("voting", __name__)
 
+# The rendered voting pages of this process
+page_cache = PageCache()
+
+# The alerts shown on the voting page as (category, message) pairs
+VOTING_ENDED_ALERT = (
+    "danger",
+    """
+    <p>The voting period has ended. We are no longer accepting votes. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+SUBMITTED_AFTER_END_ALERT = (
+    "danger",
+    """
+    <h4>Failure to Submit the Vote</h4>
+    <p>The voting period has ended. We are no longer accepting votes. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+DUPLICATE_ORCID_ALERT = (
+    "danger",
+    """
+    <h4>Failure to Submit the Vote</h4>
+    <p>The provided ORCID iD is already in use. Please check that your ORCID iD is correct. If you continue to experience issues or have any concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+DUPLICATE_EMAIL_ALERT = (
+    "danger",
+    """
+    <h4>Failure to Submit the Vote</h4>
+    <p>The provided email address is already in use. Please check that your email address is correct. If you continue to experience issues or have any concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+NOT_ELIGIBLE_ALERT = (
+    "danger",
+    """
+    <h4>Failure to Submit the Vote</h4>
+    <p>The provided ORCID iD and email address are not on the list of eligible voters. Please check that they are correct. If you believe you are eligible to vote, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+VOTE_SUBMITTED_ALERT = (
+    "success",
+    """
+    <h4>Vote Submitted Successfully</h4>
+    <p>Your vote has been recorded. Thank you for your participation. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+    """,
+)
+
+# The page of the submissions shed by the admission control, it is not rendered from a template to keep it cheap
+BUSY_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>SEES Election</title></head>
+<body>
+<h4>{title}</h4>
+<p>Your vote has not been submitted. Please go back and submit it again in {retry_after} seconds. If you continue to experience issues, please contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
+</body>
+</html>
+"""
+
+
+@voting.before_request
+def admit_vote():
+    """Sheds the vote submissions over the rate limits or the concurrency cap before any form, database or mail work."""
+    if request.endpoint != "voting.vote" or request.method != "POST":
+        return None
+    rejection = admission_control.admit(client=request.remote_addr or "", orcid_id=request.form.get("orcid_id", ""))
+    if rejection is None:
+        g.vote_admitted = True
+        return None
+
+    reason, retry_after = rejection
+    metrics.inc("sees_admission_rejections_total", {"reason": reason})
+    retry_after = max(1, int(retry_after + 0.999))
+    if reason == "concurrency":
+        status, title = 503, "The election server is busy"
+    else:
+        status, title = 429, "Too many submissions"
+    response = make_response(BUSY_PAGE.format(title=title, retry_after=retry_after), status)
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@voting.teardown_request
+def release_vote(exception=None) -> None:
+    """Releases the concurrency slot of an admitted vote submission."""
+    if g.pop("vote_admitted", False):
+        admission_control.release()
+
+
+def admin_required(view):
+    """Decorator that requires the ADMIN_API_TOKEN as a bearer token, the view is hidden if no token is configured."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get("ADMIN_API_TOKEN")
+        if not token:
+            abort(404)
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or not hmac.compare_digest(authorization[7:].encode(), token.encode()):
+            abort(401)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@voting.route("/admin/results", methods=["GET"])
+@admin_required
+def results():
+    """Return the live vote counts of each candidate at each rank."""
+    try:
+        tallies = VotingSystem().tallies()
+    except DBException as e:
+        return jsonify(error=e.message), 503
+
+    return jsonify(
+        total_votes=sum(counts[0] for counts in tallies.values()),
+        candidates=[{"name": name, "rank_counts": counts} for name, counts in tallies.items()],
+        generated_at=datetime.now().isoformat(timespec="seconds"),
+    )
+
+
+@voting.route("/admin/pool", methods=["GET"])
+@admin_required
+def pool():
+    """Return the state and the checkout wait times of the database pool of the worker that serves the request."""
+    return jsonify(**engine_registry.pool_status(), breaker=ballot_buffer.breaker.state)
+
+
+@voting.route("/metrics", methods=["GET"])
+@admin_required
+def metrics_endpoint():
+    """Return the metrics of all the workers in the Prometheus text format."""
+    extra = {}
+    try:
+        for status, count in mail_outbox.counts().items():
+            extra[("sees_mail_outbox_rows", (("status", status),))] = count
+    except Exception:
+        metrics.inc("sees_errors_total", {"kind": "mail_outbox"})
+    try:
+        for status, count in ballot_buffer.counts().items():
+            extra[("sees_ballot_buffer_rows", (("status", status),))] = count
+    except Exception:
+        metrics.inc("sees_errors_total", {"kind": "ballot_buffer"})
+    response = make_response(metrics.exposition(extra))
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
 
 @voting.route("/", methods=["GET", "POST"])
 def vote():
     """Display the voting form and process the vote."""
-    global db_config
-    if db_config is None:
-        db_config, db_engine, db_session, base = initialize_db()
-    # Create a form instance of the VoteForm
-    form = VoteForm()
-    # Get the list of candidates and set the choices for the form
-    voting_system = VotingSystem()
-    form.set_candidate_choices(voting_system.candidates)
+    # Get the prebuilt choices of the candidates
+    choices = candidate_registry.choices
 
     # Check if the voting period has ended
     voting_ended = datetime.now() >= voting_ends
 
     if voting_ended:
-        flash(
-            """
-            <p>The voting period has ended. We are no longer accepting votes. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
-            """,
-            "danger",
-        )
-        return render_template('vote.html', form=form, voting_ended=voting_ended)
+        # The closed election page is the same for everyone, it is rendered once and served with an ETag
+        page = page_cache.get(("ended", choices))
+        if page is None:
+            form = VoteForm(formdata=None, meta={"csrf": False})
+            form.set_candidate_choices(choices)
+            html = render_template("vote.html", form=form, voting_ended=voting_ended, alerts=[VOTING_ENDED_ALERT])
+            page = page_cache.store(("ended", choices), html)
+        response = make_response(page.render())
+        response.set_etag(page.etag)
+        response.last_modified = voting_ends
+        return response.make_conditional(request)
+
+    if request.method == "GET":
+        # The empty form only differs by its CSRF token, inject a new token in the cached page
+        page = page_cache.get(("open", choices))
+        if page is not None:
+            with metrics.time("page_cache"):
+                return page.render(generate_csrf() if page.has_token else None)
+
+    # Create a form instance of the VoteForm and set the choices for the form
+    form = VoteForm()
+    form.set_candidate_choices(choices)
+
+    if request.method == "GET":
+        with metrics.time("render"):
+            html = render_template("vote.html", form=form, voting_ended=voting_ended)
+        page_cache.store(("open", choices), html, csrf_token=form.csrf_token.current_token if form.meta.csrf else None)
+        return html
 
-    if form.validate_on_submit():
+    with metrics.time("validate"):
+        valid = form.validate_on_submit()
+
+    if valid:
 
         # Check if the voting period has ended
         if datetime.now() > voting_ends:
-            flash(
-                """
-                <h4>Failure to Submit the Vote</h4>
-                <p>The voting period has ended. We are no longer accepting votes. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
-                """,
-                "danger",
-            )
-            return render_template("vote.html", form=form, voting_ended=voting_ended)
+            metrics.inc("sees_votes_total", {"outcome": "after_end"})
+            return render_template("vote.html", form=form, voting_ended=voting_ended, alerts=[SUBMITTED_AFTER_END_ALERT])
 
-        try:
-            # Check if the orcid_id is already in the database
-            if voting_system.orcid_exists(orcid_id=request.form.get("orcid_id")):
-                print(f"The ORCID iD {request.form.get('orcid_id')} is already in the database.")
-                vote_logger.warning(f"The ORCID iD {request.form.get('orcid_id')} is already in the database.")
-                flash(
-                    """
-                    <h4>Failure to Submit the Vote</h4>
-                    <p>The provided ORCID iD is already in use. Please check that your ORCID iD is correct. If you continue to experience issues or have any concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
-                    """,
-                    "danger",
-                )
-                return render_template("vote.html", form=form, voting_ended=voting_ended)
-        except DBException as e:
-            send_database_error_email(sender_address=sender_address, mailing_list=admin_mailing_list, error=e.message)
-
-        try:
-            # Check if the email is already in the database
-            if voting_system.email_exists(email=request.form.get("email")):
-                print(f"The email address {request.form.get('email')} is already in the database.")
-                vote_logger.warning(f"The email address {request.form.get('email')} is already in the database.")
-                flash(
-                    """
-                    <h4>Failure to Submit the Vote</h4>
-                    <p>The provided email address is already in use. Please check that your email address is correct. If you continue to experience issues or have any concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
-                    """,
-                    "danger",
-                )
-                return render_template("vote.html", form=form, voting_ended=voting_ended)
-        except DBException as e:
-            send_database_error_email(sender_address=sender_address, mailing_list=admin_mailing_list, error=e.message)
+        # Check the voter against the roll of eligible voters before any database work
+        with metrics.time("eligibility"):
+            eligible = eligibility_roll.is_eligible(email=request.form.get("email"), orcid_id=request.form.get("orcid_id"))
+        if not eligible:
+            vote_logger.warning(
+                f"The voter {request.form.get('orcid_id')} is not on the roll of eligible voters.",
+                extra={"orcid_id": request.form.get("orcid_id"), "email": request.form.get("email")},
+            )
+            metrics.inc("sees_votes_total", {"outcome": "not_eligible"})
+            return render_template("vote.html", form=form, voting_ended=voting_ended, alerts=[NOT_ELIGIBLE_ALERT])
 
         # Create a Voter instance
         voter = Voter()
@@ -110,13 +249,28 @@ def vote():
         voter.selection_3 = request.form.get("selection_3")
         voter.selection_4 = request.form.get("selection_4")
 
-        # Record the vote
-        voting_system.record_vote(voter=voter)
+        # Record the vote to the database, duplicate ORCID iDs and emails are rejected by the unique constraints,
+        # the vote is kept in the ballot buffer if the database fails
+        voting_system = VotingSystem()
         try:
             voting_system.record_vote_to_db(voter=voter)
+        except DuplicateVoteException as e:
+            if e.field_name == "orcid_id":
+                vote_logger.warning(f"The ORCID iD {voter.orcid_id} is already in the database.", extra={"orcid_id": voter.orcid_id})
+                alert = DUPLICATE_ORCID_ALERT
+                metrics.inc("sees_votes_total", {"outcome": "duplicate_orcid_id"})
+            else:
+                vote_logger.warning(f"The email address {voter.email} is already in the database.", extra={"email": voter.email})
+                alert = DUPLICATE_EMAIL_ALERT
+                metrics.inc("sees_votes_total", {"outcome": "duplicate_email"})
+            return render_template("vote.html", form=form, voting_ended=voting_ended, alerts=[alert])
         except DBException as e:
+            metrics.inc("sees_errors_total", {"kind": "database"})
             send_database_error_email(sender_address=sender_address, mailing_list=admin_mailing_list, error=e.message)
 
+        # Record the vote to the backup file and the vote log
+        voting_system.record_vote(voter=voter)
+
         # Send a confirmation email
         if request.form.get("send_email"):
             send_comfirmation_email(sender_address=sender_address, voter=voter)
@@ -125,14 +279,10 @@ def vote():
         send_vote_to_admin_group(sender_address=sender_address, mailing_list=admin_mailing_list, voter=voter)
 
         # Thank the voter for voting
-        flash(
-            """
-            <h4>Vote Submitted Successfully</h4>
-            <p>Your vote has been recorded. Thank you for your participation. If you have any questions or concerns, please do not hesitate to contact us at <a href="mailto:sees_info@millenia.cars.aps.anl.gov">sees_info@millenia.cars.aps.anl.gov</a>.</p>
-            """,
-            "success",
-        )
+        metrics.inc("sees_votes_total", {"outcome": "recorded"})
+        with metrics.time("render"):
+            return render_template("vote.html", form=form, voting_ended=voting_ended, alerts=[VOTE_SUBMITTED_ALERT])
 
+    metrics.inc("sees_votes_total", {"outcome": "invalid"})
+    with metrics.time("render"):
         return render_template("vote.html", form=form, voting_ended=voting_ended)
-
-    return render_template("vote.html", form=form, voting_ended=voting_ended)
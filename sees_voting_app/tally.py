@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: tally.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to count the ranked ballots of the SEES election. The
+# ballots are loaded from the database, the responses.csv file or the ballot
+# journal into an integer matrix of candidate indices and are counted with
+# vectorized NumPy operations using instant-runoff, Borda and first-preference
+# methods. The multi-seat single transferable vote collapses the identical
+# rankings into weighted groups and counts them with exact fractions.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import csv
+import math
+import numpy as np
+from dataclasses import dataclass, field
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sees_voting_app.config import data_dir
+from sees_voting_app.database import VoteModel, session_scope
+from sees_voting_app.journal import iter_journal
+from sees_voting_app.voting_system import candidate_registry
+
+
+__all__ = [
+    "TallyRound",
+    "borda_count",
+    "encode_ballots",
+    "first_preferences",
+    "format_rounds",
+    "format_scores",
+    "group_ballots",
+    "instant_runoff",
+    "load_ballots",
+    "run_tally",
+    "single_transferable_vote",
+]
+
+
+# Number of ranked preferences on each ballot
+RANKS = 4
+# Value used in the ballot matrix for an empty preference
+EMPTY = -1
+# The transfer methods of the single transferable vote
+STV_TRANSFERS = ("gregory", "meek")
+# The Meek keep values are rounded up to this many decimals, which bounds the size of the fractions, as in the New Zealand Meek rules
+MEEK_DECIMALS = 9
+# The Meek iterations stop when the surpluses of the elected candidates are below this total
+MEEK_TOLERANCE = Fraction(1, 10**5)
+MEEK_MAX_ITERATIONS = 1000
+# The counts and the quotas of the reports are rounded to this many decimals, below the Meek tolerance the digits carry no information
+REPORT_DECIMALS = 5
+
+
+@dataclass
+class TallyRound:
+    """A class to represent a round of a count."""
+
+    number: int = field(compare=False)
+    counts: np.ndarray = field(compare=False, repr=False)
+    exhausted: float = field(compare=False, default=0.0)
+    eliminated: Optional[int] = field(compare=False, default=None)
+    elected: Optional[int] = field(compare=False, default=None)
+    quota: Optional[float] = field(compare=False, default=None)
+
+
+def encode_ballots(rows: Iterable[Sequence[str]], candidates: Sequence[str]) -> np.ndarray:
+    """Encodes rows of candidate names into an (n, RANKS) matrix of candidate indices."""
+    index = {name: i for i, name in enumerate(candidates)}
+    ballots = np.array([[index.get(name, EMPTY) for name in row[:RANKS]] for row in rows], dtype=np.int16)
+    return normalize_ballots(ballots.reshape(-1, RANKS))
+
+
+def normalize_ballots(ballots: np.ndarray) -> np.ndarray:
+    """Removes the repeated candidates of each ballot and moves the preferences left over the empty ranks."""
+    ballots = ballots.copy()
+    # Drop the later preferences that repeat an earlier candidate
+    for rank in range(1, RANKS):
+        repeated = (ballots[:, :rank] == ballots[:, rank : rank + 1]).any(axis=1)
+        ballots[repeated, rank] = EMPTY
+    # A stable sort on the empty flag moves the filled preferences to the front, keeping their order
+    order = np.argsort(ballots == EMPTY, axis=1, kind="stable")
+    return np.take_along_axis(ballots, order, axis=1)
+
+
+def load_ballots(source: str = "db", candidates: Optional[Sequence[str]] = None) -> Tuple[Tuple[str, ...], np.ndarray]:
+    """Loads the ballots from the database ("db"), the responses.csv file ("csv") or the ballot journal ("journal")."""
+    if candidates is None:
+        candidates = tuple(candidate.name for candidate in candidate_registry.candidates)
+
+    if source == "db":
+        with session_scope() as session:
+            query = session.query(VoteModel.selection_1, VoteModel.selection_2, VoteModel.selection_3, VoteModel.selection_4)
+            ballots = encode_ballots(query.yield_per(10000), candidates)
+    elif source == "csv":
+        with open(Path(data_dir) / "responses.csv", "r", newline="") as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Skip the header
+            ballots = encode_ballots((row[3:] for row in reader if row), candidates)
+    elif source == "journal":
+        ballots = encode_ballots((ballot["selections"] for _, _, ballot in iter_journal(Path(data_dir) / "journal")), candidates)
+    else:
+        raise ValueError(f"Unknown ballot source: {source}")
+
+    return tuple(candidates), ballots
+
+
+def _weights(ballots: np.ndarray, weights: Optional[np.ndarray]) -> np.ndarray:
+    """Returns the ballot weights, every ballot counts once if no weights are given."""
+    if weights is None:
+        return np.ones(len(ballots), dtype=np.float64)
+    return np.asarray(weights, dtype=np.float64)
+
+
+def first_preferences(ballots: np.ndarray, n_candidates: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """Returns the number of first preferences of each candidate."""
+    first = ballots[:, 0]
+    valid = first != EMPTY
+    return np.bincount(first[valid], weights=_weights(ballots, weights)[valid], minlength=n_candidates)
+
+
+def borda_count(ballots: np.ndarray, n_candidates: int, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """Returns the Borda score of each candidate, a preference at rank r is worth RANKS - r points."""
+    points = (RANKS - np.arange(RANKS, dtype=np.float64))[np.newaxis, :] * _weights(ballots, weights)[:, np.newaxis]
+    valid = ballots != EMPTY
+    return np.bincount(ballots[valid], weights=points[valid], minlength=n_candidates)
+
+
+def instant_runoff(ballots: np.ndarray, n_candidates: int, weights: Optional[np.ndarray] = None) -> List[TallyRound]:
+    """Runs an instant-runoff count and returns its rounds, the last round names the elected candidate.
+
+    Ties for the last place are broken by the lower first-preference count, then by the candidates order.
+    """
+    weights = _weights(ballots, weights)
+    # Map the empty preferences to an extra, always inactive, candidate so they can be gathered
+    indices = np.where(ballots == EMPTY, n_candidates, ballots).astype(np.intp)
+    active = np.ones(n_candidates + 1, dtype=bool)
+    active[n_candidates] = False
+    first = first_preferences(ballots, n_candidates, weights)
+    # The current top choice of every ballot, the extra candidate index marks an exhausted ballot
+    top = indices[:, 0].copy()
+    rounds = []
+
+    while True:
+        counts = np.bincount(top, weights=weights, minlength=n_candidates + 1)
+        tally_round = TallyRound(number=len(rounds) + 1, counts=counts[:n_candidates], exhausted=float(counts[n_candidates]))
+        rounds.append(tally_round)
+        counts = counts[:n_candidates]
+
+        # A candidate with a majority of the continuing ballots, or the last active candidate, is elected
+        remaining = np.flatnonzero(active[:n_candidates])
+        if len(remaining) == 0:
+            return rounds
+        leader = remaining[np.argmax(counts[remaining])]
+        if counts[leader] * 2 > counts.sum() or len(remaining) == 1:
+            tally_round.elected = int(leader)
+            return rounds
+
+        # Eliminate the active candidate with the fewest votes
+        order = np.lexsort((remaining, first[remaining], counts[remaining]))
+        tally_round.eliminated = int(remaining[order[0]])
+        active[tally_round.eliminated] = False
+
+        # Move only the ballots of the eliminated candidate to their highest ranked active candidate
+        moved = np.flatnonzero(top == tally_round.eliminated)
+        available = active[indices[moved]]
+        next_choice = indices[moved, available.argmax(axis=1)]
+        top[moved] = np.where(available.any(axis=1), next_choice, n_candidates)
+
+
+def group_ballots(ballots: np.ndarray, weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Collapses the identical rankings into unique ballot groups, returns the rankings and the total weight of each group."""
+    if len(ballots) == 0:
+        return ballots.reshape(0, RANKS), np.zeros(0, dtype=np.float64)
+    # Pack every ranking into one integer, 16 bits per rank from the first, a 1-D unique is much faster than a unique of rows
+    shifts = np.int64(16) * np.arange(RANKS - 1, -1, -1, dtype=np.int64)
+    keys = ((ballots.astype(np.int64) + 1) << shifts).sum(axis=1)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    groups = (((unique_keys[:, np.newaxis] >> shifts) & 0xFFFF) - 1).astype(ballots.dtype)
+    return groups, np.bincount(inverse.reshape(-1), weights=_weights(ballots, weights), minlength=len(groups))
+
+
+def _round_up(value: Fraction) -> Fraction:
+    scale = 10**MEEK_DECIMALS
+    return Fraction(math.ceil(value * scale), scale)
+
+
+def _exact(weight: float) -> Fraction:
+    """Returns a ballot weight as an exact number, the integer weights stay integers because they add much faster than fractions."""
+    return int(weight) if float(weight).is_integer() else Fraction(float(weight))
+
+
+def _ranking_prefixes(rankings: List[Tuple[int, ...]], values: List[Fraction]) -> Tuple[Dict[Tuple[int, ...], Fraction], Dict[Tuple[int, ...], List[Tuple[int, ...]]]]:
+    """Returns the total weight of the groups that start with every ranking prefix and the longer prefixes of each prefix."""
+    prefix_weights: Dict[Tuple[int, ...], Fraction] = {}
+    children: Dict[Tuple[int, ...], List[Tuple[int, ...]]] = {}
+    for ranking, value in zip(rankings, values):
+        for length in range(1, len(ranking) + 1):
+            prefix = ranking[:length]
+            if prefix not in prefix_weights:
+                prefix_weights[prefix] = 0
+                children.setdefault(ranking[: length - 1], []).append(prefix)
+            prefix_weights[prefix] += value
+    return prefix_weights, children
+
+
+def _meek_distribute(
+    prefix_weights: Dict[Tuple[int, ...], Fraction], children: Dict[Tuple[int, ...], List[Tuple[int, ...]]], keep: List[Fraction]
+) -> List[Fraction]:
+    """Spreads the ballots over their rankings, each candidate keeps its keep value of what reaches it and passes on the rest.
+
+    A hopeful candidate keeps the whole ballot, so the walk of a ranking prefix only goes on past the elected and excluded candidates.
+    """
+    votes = [Fraction(0)] * len(keep)
+    stack = [((), Fraction(1))]
+    while stack:
+        prefix, remainder = stack.pop()
+        for child in children.get(prefix, ()):
+            candidate = child[-1]
+            if keep[candidate]:
+                votes[candidate] += remainder * keep[candidate] * prefix_weights[child]
+            if keep[candidate] != 1:
+                stack.append((child, remainder * (1 - keep[candidate])))
+    return votes
+
+
+def _meek_count(
+    prefix_weights: Dict[Tuple[int, ...], Fraction],
+    children: Dict[Tuple[int, ...], List[Tuple[int, ...]]],
+    total: Fraction,
+    keep: List[Fraction],
+    elected: List[int],
+    hopeful: set,
+    seats: int,
+) -> Tuple[List[Fraction], Fraction, Fraction]:
+    """Lowers the keep values of the elected candidates until their surpluses are spread, returns the votes, exhausted votes and quota."""
+    for _ in range(MEEK_MAX_ITERATIONS):
+        votes = _meek_distribute(prefix_weights, children, keep)
+        exhausted = total - sum(votes)
+        quota = (total - exhausted) / (seats + 1)
+        # Stop as soon as another candidate is elected or the surpluses are small enough
+        if any(votes[candidate] > quota for candidate in hopeful):
+            break
+        if sum((votes[candidate] - quota for candidate in elected), Fraction(0)) < MEEK_TOLERANCE:
+            break
+        updated = False
+        for candidate in elected:
+            if votes[candidate]:
+                value = min(Fraction(1), _round_up(keep[candidate] * quota / votes[candidate]))
+                updated |= value != keep[candidate]
+                keep[candidate] = value
+        if not updated:
+            break
+    return votes, exhausted, quota
+
+
+def single_transferable_vote(
+    ballots: np.ndarray, n_candidates: int, seats: int, weights: Optional[np.ndarray] = None, transfers: str = "gregory"
+) -> List[TallyRound]:
+    """Runs a single transferable vote count for the given number of seats and returns its rounds, a candidate is elected or eliminated in each round.
+
+    The identical rankings are counted once as weighted groups with exact fractions, so a round takes time proportional to the unique rankings.
+    With gregory transfers the quota is the Droop quota and the ballots of an elected candidate move on at the value of its surplus. With meek
+    transfers the elected candidates keep a share of every ballot that reaches them, the shares are iterated until they hold the quota, which
+    follows the continuing votes. Ties are broken by the first-preference count, then by the candidates order.
+    """
+    if transfers not in STV_TRANSFERS:
+        raise ValueError(f"Unknown transfer method: {transfers}")
+
+    groups, group_weights = group_ballots(ballots, weights)
+    rankings = [tuple(int(candidate) for candidate in row if candidate != EMPTY) for row in groups]
+    values = [_exact(weight) for weight in group_weights]
+    first = first_preferences(ballots, n_candidates, weights)
+    total = sum(values, Fraction(0))
+    quota = Fraction(math.floor(total / (seats + 1)) + 1)
+    hopeful = set(range(n_candidates))
+    elected: List[int] = []
+    # Meek: the share of a ballot that every candidate keeps, and the ranking prefixes the ballots are spread over
+    keep = [Fraction(1)] * n_candidates
+    if transfers == "meek":
+        prefix_weights, children = _ranking_prefixes(rankings, values)
+    # Gregory: the position of every group in its ranking, None once it is exhausted or parked with a candidate elected without a surplus
+    position: List[Optional[int]] = [0 if ranking else None for ranking in rankings]
+    parked: set = set()
+    # Gregory: the transfer values, and the index of the value of a ballot of every group, the groups that move on together share one
+    transfer_values = [Fraction(1)]
+    transfer_index = [0] * len(rankings)
+    # Gregory: the votes that every elected candidate holds
+    held: Dict[int, Fraction] = {}
+    rounds = []
+
+    def move_on(group: int) -> None:
+        """Moves a group to its next continuing candidate."""
+        ranking, start = rankings[group], position[group] + 1
+        position[group] = next((p for p in range(start, len(ranking)) if ranking[p] in hopeful), None)
+
+    while True:
+        if transfers == "meek":
+            votes, exhausted, quota = _meek_count(prefix_weights, children, total, keep, elected, hopeful, seats)
+        else:
+            # Add up the weights of the groups by transfer value first, then a single product per pile
+            piles: Dict[Tuple[int, int], Fraction] = {}
+            for group, value in enumerate(values):
+                if position[group] is not None:
+                    key = (rankings[group][position[group]], transfer_index[group])
+                elif group not in parked:
+                    key = (n_candidates, transfer_index[group])
+                else:
+                    continue
+                piles[key] = piles.get(key, 0) + value
+            votes = [Fraction(0)] * (n_candidates + 1)
+            for (candidate, index), value in piles.items():
+                votes[candidate] += transfer_values[index] * value
+            votes, exhausted = votes[:n_candidates], votes[n_candidates]
+            for candidate, value in held.items():
+                votes[candidate] = value
+        tally_round = TallyRound(
+            number=len(rounds) + 1,
+            counts=np.array([float(vote) for vote in votes], dtype=np.float64),
+            exhausted=float(exhausted),
+            quota=float(quota),
+        )
+        rounds.append(tally_round)
+        if not hopeful:
+            return rounds
+
+        reached = [c for c in sorted(hopeful) if (votes[c] > quota if transfers == "meek" else votes[c] >= quota)]
+        if reached or len(hopeful) <= seats - len(elected):
+            # Elect the candidate with the most votes, the last candidates fill the remaining seats without the quota
+            tally_round.elected = max(reached or sorted(hopeful), key=lambda c: (votes[c], first[c], -c))
+            hopeful.remove(tally_round.elected)
+            elected.append(tally_round.elected)
+            if len(elected) == seats:
+                return rounds
+            if transfers == "gregory":
+                # The ballots carry the surplus on at a reduced value, without a surplus they stay with the elected candidate
+                surplus = votes[tally_round.elected] - quota
+                held[tally_round.elected] = quota if surplus > 0 else votes[tally_round.elected]
+                reduced: Dict[int, int] = {}
+                for group in range(len(rankings)):
+                    if position[group] is not None and rankings[group][position[group]] == tally_round.elected:
+                        if surplus > 0:
+                            index = transfer_index[group]
+                            if index not in reduced:
+                                reduced[index] = len(transfer_values)
+                                transfer_values.append(transfer_values[index] * surplus / votes[tally_round.elected])
+                            transfer_index[group] = reduced[index]
+                            move_on(group)
+                        else:
+                            position[group] = None
+                            parked.add(group)
+        else:
+            # Eliminate the candidate with the fewest votes, its ballots move on at their full value
+            tally_round.eliminated = min(hopeful, key=lambda c: (votes[c], first[c], c))
+            hopeful.remove(tally_round.eliminated)
+            if transfers == "meek":
+                keep[tally_round.eliminated] = Fraction(0)
+            else:
+                for group in range(len(rankings)):
+                    if position[group] is not None and rankings[group][position[group]] == tally_round.eliminated:
+                        move_on(group)
+
+
+def _format_count(value: float) -> str:
+    """Returns a count rounded to the report decimals, without the trailing zeros."""
+    return f"{value:.{REPORT_DECIMALS}f}".rstrip("0").rstrip(".")
+
+
+def format_rounds(candidates: Sequence[str], rounds: List[TallyRound]) -> str:
+    """Returns the rounds of a count as a text table, the counts are rounded to REPORT_DECIMALS decimals."""
+    width = max(len(name) for name in [*candidates, "Candidate", "Exhausted", "Quota"])
+    header = f"{'Candidate':<{width}}" + "".join(f"{f'Round {tally_round.number}':>12}" for tally_round in rounds)
+    lines = [header, "-" * len(header)]
+    for i, name in enumerate(candidates):
+        lines.append(f"{name:<{width}}" + "".join(f"{_format_count(tally_round.counts[i]):>12}" for tally_round in rounds))
+    lines.append(f"{'Exhausted':<{width}}" + "".join(f"{_format_count(tally_round.exhausted):>12}" for tally_round in rounds))
+    if any(tally_round.quota is not None for tally_round in rounds):
+        lines.append(f"{'Quota':<{width}}" + "".join(f"{_format_count(tally_round.quota):>12}" for tally_round in rounds))
+    lines.append("")
+    for tally_round in rounds:
+        if tally_round.eliminated is not None:
+            lines.append(f"Round {tally_round.number}: {candidates[tally_round.eliminated]} is eliminated.")
+        if tally_round.elected is not None:
+            lines.append(f"Round {tally_round.number}: {candidates[tally_round.elected]} is elected.")
+    return "\n".join(lines)
+
+
+def format_scores(candidates: Sequence[str], scores: np.ndarray, title: str) -> str:
+    """Returns the scores of a single round count as a text table, sorted from the highest score."""
+    width = max(len(name) for name in [*candidates, "Candidate"])
+    lines = [f"{'Candidate':<{width}}{title:>12}", "-" * (width + 12)]
+    for i in np.argsort(-scores, kind="stable"):
+        lines.append(f"{candidates[i]:<{width}}{_format_count(scores[i]):>12}")
+    return "\n".join(lines)
+
+
+def run_tally(method: str, source: str = "db", seats: int = 1) -> str:
+    """Loads the ballots and returns the report of the given counting method, the single transferable vote fills the given seats."""
+    candidates, ballots = load_ballots(source=source)
+    if method == "irv":
+        return format_rounds(candidates, instant_runoff(ballots, len(candidates)))
+    if method in ("stv", "meek"):
+        transfers = "meek" if method == "meek" else "gregory"
+        return format_rounds(candidates, single_transferable_vote(ballots, len(candidates), seats=seats, transfers=transfers))
+    if method == "borda":
+        return format_scores(candidates, borda_count(ballots, len(candidates)), title="Borda")
+    if method == "first":
+        return format_scores(candidates, first_preferences(ballots, len(candidates)), title="First")
+    raise ValueError(f"Unknown counting method: {method}")
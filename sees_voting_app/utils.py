@@ -5,7 +5,7 @@
 # -----------------------------------------------------------------------------
 # Purpose:
 # This file is used to define utility functions for the voting app. The
-# functions are used to send confirmation emails to voters and to notify the
+# functions are used to queue confirmation emails to voters and to notify the
 # admin group when a new vote is recorded.
 #
 # Copyright (C) 2024 GSECARS, The University of Chicago, USA
@@ -13,16 +13,29 @@
 # -----------------------------------------------------------------------------
 
 import csv
-import glob
+import heapq
+import io
+import json
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from flask_mailman import EmailMessage
-from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 
+from sees_voting_app import mail_outbox
+from sees_voting_app.config import data_dir
+from sees_voting_app.journal import iter_journal
 from sees_voting_app.voting_system import Voter
 
 
-__all__ = ["combine_results"]
+__all__ = ["VOTE_FILE_PATTERN", "combine_results", "vote_file_timestamp"]
+
+
+# Matches the per-vote CSV files, e.g. 0000-0000-0000-0000_2024.03.01_12.00.00.csv
+VOTE_FILE_PATTERN = re.compile(r"^(?P<orcid_id>\d{4}-\d{4}-\d{4}-\d{3}[0-9X])_(?P<timestamp>.+)\.csv$")
+# The header of the per-vote and combined CSV files
+RESULTS_HEADER = ["FullName", "Email", "ORCIDiD", "Pref1", "Pref2", "Pref3", "Pref4"]
 
 
 def send_comfirmation_email(sender_address, voter: Voter) -> None:
@@ -65,19 +78,33 @@ def send_comfirmation_email(sender_address, voter: Voter) -> None:
     # Set the content type to HTML
     msg.content_subtype = "html"
 
-    try:
-        msg.send()
-    except Exception as e:
-        # Temporary catch-all exception handling until the mail is properly configured
-        print(f"An error occurred while sending the email: {e}")
+    # Queue the message, it is sent by the mail outbox dispatcher
+    mail_outbox.enqueue(msg)
 
 
 def send_vote_to_admin_group(sender_address, mailing_list: List[str], voter: Voter) -> None:
-    """Send the vote to the admin group."""
+    """Send the vote to the admin group, or add it to the next digest if digests are enabled."""
 
     # Create the selections string
     selections = "\n".join([f"{selection.name}" for selection in voter.selections_list])
 
+    if mail_outbox.digest_enabled:
+        # Set the entry of the vote in the digest
+        entry = f"""Full Name: {voter.full_name}
+Email: {voter.email}
+ORCID iD: {voter.orcid_id}
+Selections:
+{selections}"""
+        mail_outbox.enqueue_digest_entry(
+            subject="New Votes for SEES election.",
+            header="Hello all,\n\nThe following votes have been recorded in the SEES election.\n\n",
+            entry=entry,
+            footer="\n\nBest regards,\nThe SEES Team\n",
+            from_email=sender_address,
+            to=mailing_list,
+        )
+        return
+
     # Set the body of the message
     body = f"""Hello all,
 
@@ -103,11 +130,8 @@ The SEES Team
         mailing_list,
     )
 
-    try:
-        msg.send()
-    except Exception as e:
-        # Temporary catch-all exception handling until the mail is properly configured
-        print(f"An error occurred while sending the email: {e}")
+    # Queue the message, it is sent by the mail outbox dispatcher
+    mail_outbox.enqueue(msg)
 
 
 def send_database_error_email(sender_address, mailing_list, error) -> None:
@@ -132,36 +156,98 @@ def send_database_error_email(sender_address, mailing_list, error) -> None:
         mailing_list,
     )
 
+    # Queue the message, it is sent by the mail outbox dispatcher
+    mail_outbox.enqueue(msg)
+
+
+def _read_vote_file(path: str) -> List[str]:
+    """Returns the data rows of a per-vote CSV file, without the header."""
+    with open(path, "r", newline="") as file:
+        next(file, None)  # Skip the header
+        lines = file.readlines()
+    # Make sure that the last row of the file is terminated
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\r\n"
+    return lines
+
+
+def vote_file_timestamp(timestamp: str) -> str:
+    """Converts the timestamp of a per-vote file name to the ISO format used by the ballot journal."""
     try:
-        msg.send()
-    except Exception as e:
-        # Temporary catch-all exception handling until the mail is properly configured
-        print(f"An error occurred while sending the email: {e}")
-
-
-def combine_results() -> None:
-    """Combine the results and generate a responses.csv file."""
-    # Set the path to the combined CSV file
-    combined_results_csv = Path(__file__).parent.parent / "data" / "responses.csv"
-
-    # Get a list of all the CSV files
-    csv_files = glob.glob(str(Path(__file__).parent.parent / "data" / "*.csv"))
-
-    # Write the header to the combined CSV file
-    with open(combined_results_csv, "w") as file:
-        writer = csv.writer(file)
-        writer.writerow(["FullName", "Email", "ORCIDiD", "Pref1", "Pref2", "Pref3", "Pref4"])
-
-    # Append the data from each CSV file to the combined CSV file
-    for csv_file in csv_files:
-        # Skip files that do not start with an ORCID iD
-        if not re.match(r".*/\d{4}-\d{4}-\d{4}-\d{3}[0-9X]\_.*\.csv", csv_file):
-            continue
-
-        if csv_file == str(combined_results_csv):
-            continue
-        with open(csv_file, "r") as file:
-            next(file)  # Skip the header
-            with open(combined_results_csv, "a") as combined_file:
-                for line in file:
-                    combined_file.write(line)
+        return datetime.strptime(timestamp, "%Y.%m.%d_%H.%M.%S").isoformat(timespec="microseconds")
+    except ValueError:
+        return timestamp
+
+
+def _read_vote_files(vote_files: List[Tuple[str, str, str, str]], max_workers: int) -> Iterator[Tuple[str, List[str]]]:
+    """Reads the per-vote CSV files in parallel and yields their timestamp and rows, in order."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for vote_file, lines in zip(vote_files, executor.map(_read_vote_file, [vote_file[2] for vote_file in vote_files])):
+            yield vote_file[0], lines
+
+
+def _journal_rows(journal_offsets: Dict[str, int]) -> Iterator[Tuple[str, List[str]]]:
+    """Streams the ballots of the journal as CSV rows, skips repeated ballot IDs and records the offsets that were read."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    seen_ballot_ids = set()
+    for name, offset, ballot in iter_journal(data_dir / "journal", offsets=dict(journal_offsets)):
+        journal_offsets[name] = offset
+        ballot_id = ballot.get("ballot_id")
+        if ballot_id is not None:
+            if ballot_id in seen_ballot_ids:
+                continue
+            seen_ballot_ids.add(ballot_id)
+        writer.writerow([ballot["full_name"], ballot["email"], ballot["orcid_id"], *ballot["selections"]])
+        yield ballot["timestamp"], [buffer.getvalue()]
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def combine_results(incremental: bool = False, max_workers: int = 16) -> int:
+    """Combine the ballot journal and the per-vote files into a responses.csv file, returns the number of merged votes."""
+    # Set the path to the combined CSV file and to the manifest of the merged votes
+    combined_results_csv = data_dir / "responses.csv"
+    manifest_path = data_dir / "responses.manifest.json"
+
+    # Get the merged files and journal offsets from the manifest, a full rebuild is done if it or the results are missing
+    manifest = {"files": [], "journals": {}}
+    if incremental and combined_results_csv.exists() and manifest_path.exists():
+        with open(manifest_path, "r") as file:
+            manifest.update(json.load(file))
+    else:
+        incremental = False
+    merged_files = set(manifest["files"])
+    journal_offsets = manifest["journals"]
+
+    # Scan the data directory once and keep the per-vote files that start with an ORCID iD
+    vote_files = []
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            match = VOTE_FILE_PATTERN.match(entry.name)
+            if match is None or entry.name in merged_files or not entry.is_file():
+                continue
+            timestamp = vote_file_timestamp(match.group("timestamp"))
+            vote_files.append((timestamp, match.group("orcid_id"), entry.path, entry.name))
+
+    # Sort the files by the timestamp in the filename so that the output is deterministic
+    vote_files.sort()
+
+    # Merge the per-vote files and the journal by timestamp and write the rows through a single buffered writer
+    merged_votes = 0
+    with open(combined_results_csv, "a" if incremental else "w", newline="", buffering=1024 * 1024) as combined_file:
+        if not incremental:
+            csv.writer(combined_file).writerow(RESULTS_HEADER)
+        rows = heapq.merge(_read_vote_files(vote_files, max_workers), _journal_rows(journal_offsets), key=lambda item: item[0])
+        for _, lines in rows:
+            combined_file.writelines(lines)
+            merged_votes += len(lines)
+
+    # Update the manifest, the temporary file is renamed so that the manifest is never left half written
+    merged_files.update(vote_file[3] for vote_file in vote_files)
+    temporary_manifest_path = manifest_path.with_suffix(".tmp")
+    with open(temporary_manifest_path, "w") as file:
+        json.dump({"files": sorted(merged_files), "journals": journal_offsets}, file)
+    os.replace(temporary_manifest_path, manifest_path)
+
+    return merged_votes
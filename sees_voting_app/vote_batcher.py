@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: vote_batcher.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the group commit of the votes of a worker. The
+# concurrent submissions are collected for a few milliseconds by a flusher
+# thread and written in a single transaction, every request waits on a
+# future for the outcome of its own vote.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Tuple
+
+from sees_voting_app.metrics import metrics
+
+
+__all__ = ["VoteBatcher"]
+
+
+@dataclass
+class VoteBatcher:
+    """A class to write the concurrent votes of a worker in a single transaction, disabled if the window is 0."""
+
+    _window: float = field(compare=False, repr=False, default=0.0)
+    _max_batch: int = field(compare=False, repr=False, default=100)
+    _timeout: float = field(compare=False, repr=False, default=30.0)
+    _flush: Optional[Callable[[List[Any]], List[Optional[Exception]]]] = field(init=False, compare=False, repr=False, default=None)
+    _pending: List[Tuple[Any, Future]] = field(init=False, compare=False, repr=False, default_factory=list)
+    _pid: Optional[int] = field(init=False, compare=False, repr=False, default=None)
+    _condition: threading.Condition = field(init=False, compare=False, repr=False, default_factory=threading.Condition)
+
+    @property
+    def enabled(self) -> bool:
+        return self._window > 0 and self._flush is not None
+
+    def init_flush(self, flush: Callable[[List[Any]], List[Optional[Exception]]]) -> None:
+        """Sets the function that writes a group of votes and returns the error of each vote, None for the written ones."""
+        self._flush = flush
+
+    def submit(self, item: Any) -> None:
+        """Adds a vote to the next group and waits until it is written, the error of the vote is raised here.
+
+        A TimeoutError is raised if the group is not written within the timeout, the vote may still be written afterwards.
+        """
+        future = Future()
+        with self._condition:
+            # The flusher thread belongs to the process that started it
+            if self._pid != os.getpid():
+                self._pending = []
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="vote-batcher", daemon=True).start()
+            self._pending.append((item, future))
+            self._condition.notify_all()
+        try:
+            future.result(timeout=self._timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"The vote was not written within {self._timeout} seconds.")
+
+    def _run(self) -> None:
+        """The flusher loop, writes the votes submitted during each window as one group."""
+        pid = os.getpid()
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                if self._pid != pid:
+                    return
+                # Let the concurrent votes join the group, a full group is written right away
+                deadline = time.monotonic() + self._window
+                while len(self._pending) < self._max_batch and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch, self._pending = self._pending[: self._max_batch], self._pending[self._max_batch :]
+
+            try:
+                errors = self._flush([item for item, _ in batch])
+            except Exception as e:
+                errors = [e] * len(batch)
+            # Every vote must get its own result, else its request would wait for it
+            if len(errors) != len(batch):
+                errors = [RuntimeError(f"The flush returned {len(errors)} results for a group of {len(batch)} votes.")] * len(batch)
+            metrics.inc("sees_db_group_commits_total")
+            metrics.inc("sees_db_group_commit_votes_total", amount=len(batch))
+            for (_, future), error in zip(batch, errors):
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
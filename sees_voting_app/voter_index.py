@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# Project: SEES-Voting-App
+# File: voter_index.py
+# -----------------------------------------------------------------------------
+# Purpose:
+# This file is used to define the index of the voters who have already voted.
+# The index is a Bloom filter of the normalized emails and ORCID iDs in a
+# memory-mapped file shared by all the gunicorn workers. A voter who is not in
+# the index has not voted yet, a voter who is in it probably has and the
+# database confirms it. The unique constraints remain the final authority.
+#
+# Copyright (C) 2024 GSECARS, The University of Chicago, USA
+# This software is distributed under the terms of the MIT license.
+# -----------------------------------------------------------------------------
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+
+__all__ = ["VoterIndex", "normalize_email"]
+
+
+# The header of the index file: magic, number of slots and number of hash functions
+_HEADER = struct.Struct("8sQI4x")
+_MAGIC = b"SEESBLM1"
+
+
+def normalize_email(email: str) -> str:
+    """Returns the key of an email address, the votes table stores and looks up the emails by this key."""
+    return email.strip().casefold()
+
+
+def _normalize_orcid(orcid_id: str) -> str:
+    return orcid_id.strip().upper()
+
+
+@dataclass
+class VoterIndex:
+    """A class to keep a Bloom filter of the voters in a memory-mapped file shared by the workers.
+
+    Every slot is a whole byte, so concurrent writers only ever set bytes to 1 and can never clear each other's bits.
+    """
+
+    _path: Path = field(compare=False, repr=False)
+    _capacity: int = field(compare=False, repr=False, default=200000)
+    _error_rate: float = field(compare=False, repr=False, default=0.001)
+    _mmap: Optional[mmap.mmap] = field(init=False, compare=False, repr=False, default=None)
+    _slots: int = field(init=False, compare=False, repr=False, default=0)
+    _hashes: int = field(init=False, compare=False, repr=False, default=0)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def _size(self) -> Tuple[int, int]:
+        """Returns the number of slots and of hash functions for the capacity and the error rate."""
+        slots = math.ceil(-self._capacity * math.log(self._error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(slots / self._capacity * math.log(2)))
+        return slots, hashes
+
+    def _positions(self, key: str) -> Iterable[int]:
+        """Returns the slots of a key, using double hashing over a 128-bit BLAKE2 digest."""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        second |= 1
+        return (_HEADER.size + (first + i * second) % self._slots for i in range(self._hashes))
+
+    def _open(self) -> bool:
+        """Maps the index file, returns False if there is no valid index yet."""
+        if self._mmap is not None:
+            return True
+        with self._lock:
+            if self._mmap is not None:
+                return True
+            try:
+                with open(self._path, "r+b") as file:
+                    index = mmap.mmap(file.fileno(), 0)
+            except (FileNotFoundError, ValueError):
+                return False
+            magic, slots, hashes = _HEADER.unpack_from(index, 0)
+            if magic != _MAGIC or len(index) != _HEADER.size + slots:
+                index.close()
+                return False
+            self._slots, self._hashes, self._mmap = slots, hashes, index
+            return True
+
+    @property
+    def exists(self) -> bool:
+        return self._open()
+
+    def rebuild(self, voters: Iterable[Tuple[str, str]]) -> int:
+        """Builds the index from the (email, ORCID iD) pairs of the voters and swaps it in, returns the number of voters."""
+        slots, hashes = self._size()
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = self._path.with_name(f"{self._path.name}.{os.getpid()}.tmp")
+        with self._lock:
+            with open(temporary_path, "w+b") as file:
+                file.truncate(_HEADER.size + slots)
+                index = mmap.mmap(file.fileno(), 0)
+            _HEADER.pack_into(index, 0, _MAGIC, slots, hashes)
+            self._slots, self._hashes = slots, hashes
+            count = 0
+            for email, orcid_id in voters:
+                for key in (f"email:{normalize_email(email)}", f"orcid:{_normalize_orcid(orcid_id)}"):
+                    for position in self._positions(key):
+                        index[position] = 1
+                count += 1
+            index.flush()
+            os.replace(temporary_path, self._path)
+
+            # Map the new index in this process, the other processes map it on first use
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = index
+        return count
+
+    def _contains(self, key: str) -> bool:
+        return all(self._mmap[position] for position in self._positions(key))
+
+    def _insert(self, key: str) -> None:
+        for position in self._positions(key):
+            self._mmap[position] = 1
+
+    def probable_duplicate(self, email: str, orcid_id: str) -> Optional[str]:
+        """Returns the field that has probably been used by an earlier voter, None if the voter is new for sure.
+
+        Without an index every voter is reported as new, the database unique constraints still reject the duplicates.
+        """
+        if not self._open():
+            return None
+        if self._contains(f"orcid:{_normalize_orcid(orcid_id)}"):
+            return "orcid_id"
+        if self._contains(f"email:{normalize_email(email)}"):
+            return "email"
+        return None
+
+    def add(self, email: Optional[str] = None, orcid_id: Optional[str] = None) -> None:
+        """Adds the email and the ORCID iD of a voter to the index."""
+        if not self._open():
+            return
+        if email is not None:
+            self._insert(f"email:{normalize_email(email)}")
+        if orcid_id is not None:
+            self._insert(f"orcid:{_normalize_orcid(orcid_id)}")
@@ -14,16 +14,40 @@
 # -----------------------------------------------------------------------------
 
 import csv
+import os
+import re
+import threading
+from collections import Counter
 from datetime import datetime
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from sqlalchemy import and_, bindparam, func, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from typing import Any, Dict, List, Optional, Tuple
 
 from sees_voting_app import vote_logger
-from sees_voting_app.database import VoteModel, session_scope, DBException
+from sees_voting_app.ballot_buffer import BallotBuffer, CircuitBreaker
+from sees_voting_app.config import Config, data_dir
+from sees_voting_app.database import TallyModel, VoteModel, session_scope, retry_on_busy, DBException, DuplicateVoteException, VoteBufferedException
+from sees_voting_app.eligibility import EligibilityRoll
+from sees_voting_app.ids import new_ballot_id
+from sees_voting_app.journal import BallotJournal
+from sees_voting_app.metrics import metrics
+from sees_voting_app.vote_batcher import VoteBatcher
+from sees_voting_app.voter_index import VoterIndex, normalize_email
 
 
-__all__ = ["Candidate", "Voter", "VotingSystem"]
+__all__ = ["Candidate", "CandidateRegistry", "Voter", "VotingSystem", "ballot_buffer", "ballot_journal", "candidate_registry", "eligibility_roll", "vote_batcher", "voter_index"]
+
+
+# Patterns to get the violated constraint from the MySQL, SQLite and PostgreSQL error messages
+_UNIQUE_VIOLATION_PATTERNS = (
+    re.compile(r"for key '([^']+)'"),
+    re.compile(r"UNIQUE constraint failed: (.+)$"),
+    re.compile(r"Key \(([^)]+)\)"),
+)
+# The names of the candidates that have rows in the vote_tallies table
+_seeded_candidates = set()
 
 
 @dataclass
@@ -34,11 +58,94 @@ class Candidate:
     bio_url: str = field(compare=False, repr=False)
 
 
+@dataclass
+class CandidateRegistry:
+    """A class to keep the candidates list in memory for the lifetime of a worker."""
+
+    _path: Path = field(compare=False, repr=False)
+    _candidates: Tuple[Candidate, ...] = field(init=False, compare=False, repr=False, default=())
+    _candidates_by_name: Dict[str, Candidate] = field(init=False, compare=False, repr=False, default_factory=dict)
+    _choices: Tuple[Tuple[str, str], ...] = field(init=False, compare=False, repr=False, default=())
+    _signature: Optional[Tuple[int, int, int]] = field(init=False, compare=False, repr=False, default=None)
+    _lock: threading.Lock = field(init=False, compare=False, repr=False, default_factory=threading.Lock)
+
+    def _file_signature(self) -> Tuple[int, int, int]:
+        """Returns the inode, modification time and size of the candidates file."""
+        stat = os.stat(self._path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, signature: Tuple[int, int, int]) -> None:
+        """Reads the candidates file and rebuilds the cached lookups."""
+        with open(self._path, "r") as data:
+            # Create a CSV reader object
+            reader = csv.reader(data)
+            # Skip the header row
+            next(reader)
+            # Create a tuple of Candidate objects
+            candidates = tuple(Candidate(name=row[0], bio_url=row[1]) for row in reader if row)
+
+        # Swap the cached values, the name lookup and the form choices are built once per load
+        self._candidates_by_name = {candidate.name: candidate for candidate in candidates}
+        self._choices = (("None", "Select a candidate..."),) + tuple((candidate.name, candidate.name) for candidate in candidates)
+        self._candidates = candidates
+        self._signature = signature
+
+    def refresh(self) -> None:
+        """Reloads the candidates file if it has been replaced or modified since the last load."""
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature != self._signature:
+                self._load(signature)
+
+    def invalidate(self) -> None:
+        """Forces a reload on the next access, e.g. after a SIGHUP."""
+        self._signature = None
+
+    @property
+    def candidates(self) -> Tuple[Candidate, ...]:
+        """Returns the tuple of candidates."""
+        self.refresh()
+        return self._candidates
+
+    @property
+    def candidates_by_name(self) -> Dict[str, Candidate]:
+        """Returns a mapping of candidate names to Candidate objects."""
+        self.refresh()
+        return self._candidates_by_name
+
+    @property
+    def choices(self) -> Tuple[Tuple[str, str], ...]:
+        """Returns the prebuilt choices for the selection fields of the vote form."""
+        self.refresh()
+        return self._choices
+
+
+# The candidates are shared by every request handled by this process
+candidate_registry = CandidateRegistry(_path=data_dir / "candidates.csv")
+# The ballots of this process are appended to its own journal file
+ballot_journal = BallotJournal(_directory=data_dir / "journal", _fsync_interval=Config.JOURNAL_FSYNC_INTERVAL_MS / 1000)
+# The voters who have already voted, shared by all the workers
+voter_index = VoterIndex(_path=data_dir / "voter_index.bloom", _capacity=Config.VOTER_INDEX_CAPACITY)
+# The roll of eligible voters, every voter is eligible if the roll file does not exist
+eligibility_roll = EligibilityRoll(_path=data_dir / "eligible_voters.csv")
+# The ballots waiting for the database to recover, shared by all the workers
+ballot_buffer = BallotBuffer(
+    _path=data_dir / "ballot_buffer.sqlite3",
+    _breaker=CircuitBreaker(_failure_threshold=Config.DB_BREAKER_FAILURES, _reset_timeout=Config.DB_BREAKER_RESET_SECONDS),
+    _batch_size=Config.BALLOT_BUFFER_BATCH_SIZE,
+)
+# The concurrent votes of this process are written in a single transaction if DB_GROUP_COMMIT_MS is set
+vote_batcher = VoteBatcher(_window=Config.DB_GROUP_COMMIT_MS / 1000, _max_batch=Config.DB_GROUP_COMMIT_MAX_VOTES)
+
+
 @dataclass
 class Voter:
     """A class to represent a voter and their selections."""
 
-    _timestamp: str = field(init=False, compare=False, repr=False, default=datetime.now().strftime("%Y.%m.%d_%H.%M.%S"))
+    _ballot_id: str = field(init=False, compare=False, repr=False, default="")
+    _timestamp: Optional[datetime] = field(init=False, compare=False, repr=False, default=None)
 
     selections_list: List[Candidate] = field(compare=False, repr=False, default_factory=list)
     full_name: str = field(init=False, compare=False, repr=False)
@@ -49,7 +156,11 @@ class Voter:
     selection_3: str = field(init=False, compare=False, repr=False)
     selection_4: str = field(init=False, compare=False, repr=False)
 
-    def prepare_data(self, candidates: List[Candidate]) -> List[str]:
+    def __post_init__(self) -> None:
+        # Every ballot gets its own ID and timestamp when it is created
+        self._ballot_id, self._timestamp = new_ballot_id()
+
+    def prepare_data(self, candidates: Dict[str, Candidate]) -> List[str]:
         # Prepare the data format
         data = [
             self.full_name,
@@ -62,23 +173,26 @@ class Voter:
         ]
 
         # Populate the voter's selections with the candidate names
-        selections = [
-            self.selection_1,
-            self.selection_2,
-            self.selection_3,
-            self.selection_4,
-        ]
-        for selection in selections:
+        for selection in self.selections:
             if selection == "None":
                 continue
-            for candidate in candidates:
-                if selection == candidate.name:
-                    self.selections_list.append(candidate)
+            candidate = candidates.get(selection)
+            if candidate is not None:
+                self.selections_list.append(candidate)
 
         return data
 
     @property
-    def timestamp(self) -> str:
+    def selections(self) -> List[str]:
+        """Returns the ranked selections of the voter, "None" marks an empty rank."""
+        return [self.selection_1, self.selection_2, self.selection_3, self.selection_4]
+
+    @property
+    def ballot_id(self) -> str:
+        return self._ballot_id
+
+    @property
+    def timestamp(self) -> datetime:
         return self._timestamp
 
 
@@ -86,87 +200,354 @@ class Voter:
 class VotingSystem:
     """A class to manage the ranking voting system."""
 
-    _candidates: List[Candidate] = field(default_factory=list)
+    _candidates: Tuple[Candidate, ...] = field(default=())
+    _candidates_by_name: Dict[str, Candidate] = field(init=False, compare=False, repr=False, default_factory=dict)
     _data: List[str] = field(init=False, compare=False, repr=False, default_factory=list)
 
     def __post_init__(self) -> None:
         self.generate_candidates_list()
 
     def generate_candidates_list(self) -> None:
-        """Reads the candidates.csv file and creates a list of Candidate objects."""
-        # Set the path to the candidates.csv file
-        candidates_csv = Path(__file__).parent.parent / "data" / "candidates.csv"
-        # Read the candidates.csv file
-        with open(candidates_csv, "r") as data:
-            # Create a CSV reader object
-            reader = csv.reader(data)
-            # Skip the header row
-            next(reader)
-            # Create a list of Candidate objects
-            self._candidates = [Candidate(name=row[0], bio_url=row[1]) for row in reader]
+        """Gets the list of Candidate objects from the process-wide candidate registry."""
+        self._candidates = candidate_registry.candidates
+        self._candidates_by_name = candidate_registry.candidates_by_name
+
+    def record_vote_to_db(self, voter: Voter) -> bool:
+        """Adds a new entry to the votes table, or to the ballot buffer if the database fails, returns False if the vote was buffered."""
+        # A voter waiting in the buffer has already voted, without the buffer the unique constraints still reject a recorded voter
+        try:
+            field_name = ballot_buffer.buffered_field(email=voter.email, orcid_id=voter.orcid_id)
+        except DBException as e:
+            vote_logger.warning(e.message)
+            field_name = None
+        if field_name is not None:
+            raise DuplicateVoteException(f"The {field_name} of the vote is already in the ballot buffer.", field_name=field_name)
+
+        # Buffer the vote right away while the circuit breaker is open, instead of waiting for a connection
+        if not ballot_buffer.breaker.allow():
+            ballot_buffer.add(self._ballot_record(voter))
+            return False
+
+        try:
+            self._insert_vote(voter=voter)
+        except DuplicateVoteException:
+            ballot_buffer.breaker.record_success()
+            raise
+        except DBException as e:
+            ballot_buffer.breaker.record_failure()
+            ballot_buffer.add(self._ballot_record(voter), error=e.message)
+            raise VoteBufferedException(f"{e.message}\n\nThe vote is kept in the ballot buffer and will be added to the database when it recovers.")
+        ballot_buffer.breaker.record_success()
+        return True
+
+    @staticmethod
+    def _ballot_record(voter: Voter) -> Dict[str, Any]:
+        """Returns the ballot of a voter as it is stored in the journal and in the ballot buffer."""
+        return {
+            "ballot_id": voter.ballot_id,
+            "timestamp": voter.timestamp.isoformat(timespec="microseconds"),
+            "full_name": voter.full_name,
+            "email": voter.email,
+            "orcid_id": voter.orcid_id,
+            "selections": voter.selections,
+        }
 
-    def orcid_exists(self, orcid_id: str) -> bool:
-        """Checks if an ORCID iD already exists in the database."""
-        with session_scope() as session:
+    @retry_on_busy
+    def _insert_vote(self, voter: Voter) -> None:
+        """Adds a new entry to the votes table, the unique constraints reject duplicate voters."""
+        # A voter missing from the index is new for sure, a probable duplicate is confirmed by the database
+        with metrics.time("voter_index"):
+            field_name = voter_index.probable_duplicate(email=voter.email, orcid_id=voter.orcid_id)
+        if field_name is not None:
             try:
-                return session.query(VoteModel.orcid_id).filter_by(orcid_id=orcid_id).first() is not None
+                with session_scope() as session:
+                    field_name = self._existing_field(session=session, voter=voter)
             except Exception as e:
-                raise DBException(f"An error occurred while checking if the ORCID iD exists: {e}")
-            
-    def email_exists(self, email: str) -> bool:
-        """Checks if an email address already exists in the database."""
-        with session_scope() as session:
+                raise DBException(f"An error occurred while checking the voter in the database: {e}")
+            metrics.inc("sees_voter_index_lookups_total", {"result": "duplicate" if field_name else "false_positive"})
+            if field_name is not None:
+                raise DuplicateVoteException(f"The {field_name} of the vote is already in the database.", field_name=field_name)
+        else:
+            metrics.inc("sees_voter_index_lookups_total", {"result": "new"})
+
+        # Make sure that the tally rows of the selected candidates exist
+        if not _seeded_candidates.issuperset(voter.selections[i] for i in self._ranked(voter)):
+            self.seed_tallies()
+
+        if vote_batcher.enabled:
+            # Add the vote together with the concurrent votes of this worker, the errors are raised for each vote
             try:
-                return session.query(VoteModel.email).filter_by(email=email).first() is not None
+                with metrics.time("db_group_commit"):
+                    vote_batcher.submit(voter)
+            except DBException:
+                raise
             except Exception as e:
-                raise DBException(f"An error occurred while checking if the email address exists: {e}")
-
-    def record_vote_to_db(self, voter: Voter) -> None:
-        """Adds a new entry to the votes table."""
-        # Create a new entry in the votes table
-        new_vote = VoteModel(
-            full_name=voter.full_name,
-            email=voter.email,
-            orcid_id=voter.orcid_id,
-            selection_1=voter.selection_1,
-            selection_2=voter.selection_2,
-            selection_3=voter.selection_3,
-            selection_4=voter.selection_4,
-            timestamp=voter.timestamp,
-        )
+                raise DBException(f"An error occurred while adding the new vote to the database: {e}")
+        else:
+            # Create a new entry in the votes table
+            new_vote = VoteModel(
+                full_name=voter.full_name,
+                email=normalize_email(voter.email),
+                orcid_id=voter.orcid_id,
+                selection_1=voter.selection_1,
+                selection_2=voter.selection_2,
+                selection_3=voter.selection_3,
+                selection_4=voter.selection_4,
+                timestamp=voter.timestamp,
+            )
 
-        # Add the new Vote instance to the database session and commit the changes
-        with session_scope() as session:
+            # Add the new Vote instance and update the tallies in a single transaction, committed at the end of the session scope
             try:
-                session.add(new_vote)
+                with session_scope(commit_stage="db_commit") as session:
+                    try:
+                        with metrics.time("db_insert"):
+                            session.add(new_vote)
+                            session.flush()
+                        with metrics.time("db_tallies"):
+                            self._increment_tallies(session=session, voter=voter)
+                    except IntegrityError as e:
+                        session.rollback()
+                        field_name = self._duplicate_field(error=e) or self._find_duplicate_field(session=session, voter=voter)
+                        # The earlier voter was missing from the index, e.g. it was recorded by another server
+                        voter_index.add(**{field_name: getattr(voter, field_name)})
+                        raise DuplicateVoteException(f"The {field_name} of the vote is already in the database: {e.orig}", field_name=field_name)
+            except DuplicateVoteException:
+                raise
             except Exception as e:
                 raise DBException(f"An error occurred while adding the new vote to the database: {e}")
 
-    def record_vote(self, voter: Voter) -> None:
-        """Creates a .csv file with the voter's selections, appends to the vote.log and prints the vote."""
-        # Set the path to the new CSV file
-        response_csv = Path(__file__).parent.parent / "data" / f"{voter.orcid_id}_{voter.timestamp}.csv"
+        voter_index.add(email=voter.email, orcid_id=voter.orcid_id)
 
-        # Get the data format
-        data = voter.prepare_data(self._candidates)
+    def insert_group(self, voters: List[Voter]) -> List[Optional[DBException]]:
+        """Adds the votes of a group commit in a single transaction, returns the error of each vote, None for the recorded ones."""
+        ballots = [self._ballot_record(voter) for voter in voters]
+        try:
+            with session_scope(commit_stage="db_commit") as session:
+                with metrics.time("db_insert"):
+                    self._insert_ballots(session=session, ballots=ballots)
+            return [None] * len(voters)
+        except IntegrityError:
+            pass
+        except Exception as e:
+            return [DBException(f"An error occurred while adding the new votes to the database: {e}")] * len(voters)
 
-        # Write the data to the new CSV file
-        with open(response_csv, "w") as file:
-            writer = csv.writer(file)
-            writer.writerow(["FullName", "Email", "ORCIDiD", "Pref1", "Pref2", "Pref3", "Pref4"])
-            writer.writerow(data)
+        # A voter of the group has already voted, add the votes again with a savepoint each so that only the duplicates fail
+        errors = []
+        try:
+            with session_scope() as session:
+                for voter, ballot in zip(voters, ballots):
+                    try:
+                        with session.begin_nested():
+                            self._insert_ballots(session=session, ballots=[ballot])
+                        errors.append(None)
+                    except IntegrityError as e:
+                        field_name = self._duplicate_field(error=e) or self._find_duplicate_field(session=session, voter=voter)
+                        voter_index.add(**{field_name: getattr(voter, field_name)})
+                        errors.append(DuplicateVoteException(f"The {field_name} of the vote is already in the database: {e.orig}", field_name=field_name))
+        except Exception as e:
+            # Nothing of the group is committed, the duplicates are still reported as duplicates
+            error = DBException(f"An error occurred while adding the new votes to the database: {e}")
+            return [item if isinstance(item, DuplicateVoteException) else error for item in errors + [None] * (len(voters) - len(errors))]
+        return errors
 
-        # Append the vote to the log file
-        vote_logger.info(
-            f"New vote submited: {voter.full_name}, {voter.email}, {voter.orcid_id}, {[candidate.name for candidate in voter.selections_list]}, vote timestamp: {voter.timestamp}"
+    @retry_on_busy
+    def record_buffered_votes(self, ballots: List[Dict[str, Any]]) -> Dict[str, str]:
+        """Adds a batch of buffered ballots to the votes table, returns the outcome of each ballot ID: recorded or duplicate.
+
+        A ballot whose ORCID iD is already in the table with the same timestamp was added by an earlier replay and is reported as recorded.
+        """
+        outcomes = {}
+        try:
+            if not _seeded_candidates.issuperset(selection for ballot in ballots for selection in ballot["selections"] if selection != "None"):
+                self.seed_tallies()
+
+            with session_scope() as session:
+                orcid_ids = [ballot["orcid_id"] for ballot in ballots]
+                emails = [normalize_email(ballot["email"]) for ballot in ballots]
+                existing = dict(session.query(VoteModel.orcid_id, VoteModel.timestamp).filter(VoteModel.orcid_id.in_(orcid_ids)).all())
+                existing_emails = {email for (email,) in session.query(VoteModel.email).filter(VoteModel.email.in_(emails)).all()}
+
+            new_ballots = []
+            for ballot in ballots:
+                if ballot["orcid_id"] in existing:
+                    replayed = existing[ballot["orcid_id"]] == datetime.fromisoformat(ballot["timestamp"])
+                    outcomes[ballot["ballot_id"]] = "recorded" if replayed else "duplicate"
+                elif normalize_email(ballot["email"]) in existing_emails:
+                    outcomes[ballot["ballot_id"]] = "duplicate"
+                else:
+                    new_ballots.append(ballot)
+
+            # Add the new ballots with a single executemany, or one by one if a vote recorded meanwhile collides with them
+            try:
+                with session_scope() as session:
+                    self._insert_ballots(session=session, ballots=new_ballots)
+                outcomes.update((ballot["ballot_id"], "recorded") for ballot in new_ballots)
+            except IntegrityError:
+                for ballot in new_ballots:
+                    try:
+                        with session_scope() as session:
+                            self._insert_ballots(session=session, ballots=[ballot])
+                        outcomes[ballot["ballot_id"]] = "recorded"
+                    except IntegrityError:
+                        outcomes[ballot["ballot_id"]] = "duplicate"
+        except Exception as e:
+            raise DBException(f"An error occurred while adding the buffered votes to the database: {e}")
+
+        for ballot in new_ballots:
+            if outcomes[ballot["ballot_id"]] == "recorded":
+                voter_index.add(email=ballot["email"], orcid_id=ballot["orcid_id"])
+        return outcomes
+
+    @staticmethod
+    def _insert_ballots(session, ballots: List[Dict[str, Any]]) -> None:
+        """Inserts a batch of ballots and adds their selections to the tallies, both as executemany statements."""
+        if not ballots:
+            return
+        session.execute(
+            insert(VoteModel),
+            [
+                {
+                    "full_name": ballot["full_name"],
+                    "email": normalize_email(ballot["email"]),
+                    "orcid_id": ballot["orcid_id"],
+                    "selection_1": ballot["selections"][0],
+                    "selection_2": ballot["selections"][1],
+                    "selection_3": ballot["selections"][2],
+                    "selection_4": ballot["selections"][3],
+                    "timestamp": datetime.fromisoformat(ballot["timestamp"]),
+                }
+                for ballot in ballots
+            ],
+        )
+        counts = Counter(
+            (selection, rank) for ballot in ballots for rank, selection in enumerate(ballot["selections"], start=1) if selection != "None"
         )
+        if counts:
+            tallies = TallyModel.__table__
+            session.execute(
+                update(tallies)
+                .where(and_(tallies.c.candidate == bindparam("tally_candidate"), tallies.c.rank == bindparam("tally_rank")))
+                .values(count=tallies.c.count + bindparam("tally_count")),
+                [{"tally_candidate": name, "tally_rank": rank, "tally_count": count} for (name, rank), count in counts.items()],
+            )
 
-        # Print the vote
-        print(
-            f"New vote submited: {voter.full_name}, {voter.email}, {voter.orcid_id}, {[candidate.name for candidate in voter.selections_list]}, vote timestamp: {voter.timestamp}"
+    @staticmethod
+    def _ranked(voter: Voter) -> List[int]:
+        """Returns the indices of the non-empty ranks of a voter."""
+        return [i for i, selection in enumerate(voter.selections) if selection != "None"]
+
+    def _increment_tallies(self, session, voter: Voter) -> None:
+        """Adds the selections of a voter to the vote_tallies table with a single UPDATE."""
+        conditions = [and_(TallyModel.candidate == voter.selections[i], TallyModel.rank == i + 1) for i in self._ranked(voter)]
+        if conditions:
+            session.execute(update(TallyModel).where(or_(*conditions)).values(count=TallyModel.count + 1))
+
+    @retry_on_busy
+    def seed_tallies(self) -> None:
+        """Creates the missing rows of the vote_tallies table, the counts are rebuilt from the votes table if it has no rows."""
+        selection_columns = [VoteModel.selection_1, VoteModel.selection_2, VoteModel.selection_3, VoteModel.selection_4]
+        try:
+            with session_scope() as session:
+                existing = set(session.query(TallyModel.candidate, TallyModel.rank).all())
+                counts = {}
+                if not existing:
+                    for rank, column in enumerate(selection_columns, start=1):
+                        for name, count in session.query(column, func.count()).group_by(column).all():
+                            counts[(name, rank)] = count
+
+            # Create the rows of the current candidates and of any candidate found in the votes table
+            keys = {(candidate.name, rank) for candidate in self._candidates for rank in range(1, len(selection_columns) + 1)}
+            keys.update(key for key in counts if key[0] != "None")
+            missing = [TallyModel(candidate=name, rank=rank, count=counts.get((name, rank), 0)) for name, rank in sorted(keys - existing)]
+            try:
+                with session_scope() as session:
+                    session.add_all(missing)
+            except IntegrityError:
+                # Another worker created some of the rows, add the remaining ones one by one
+                for row in missing:
+                    try:
+                        with session_scope() as session:
+                            session.add(TallyModel(candidate=row.candidate, rank=row.rank, count=row.count))
+                    except IntegrityError:
+                        pass
+        except Exception as e:
+            raise DBException(f"An error occurred while creating the vote tallies: {e}")
+
+        _seeded_candidates.update(candidate.name for candidate in self._candidates)
+
+    def tallies(self) -> Dict[str, List[int]]:
+        """Returns the number of votes of each candidate at each rank."""
+        try:
+            with session_scope() as session:
+                rows = session.query(TallyModel.candidate, TallyModel.rank, TallyModel.count).all()
+        except Exception as e:
+            raise DBException(f"An error occurred while reading the vote tallies: {e}")
+
+        tallies = {candidate.name: [0, 0, 0, 0] for candidate in self._candidates}
+        for name, rank, count in rows:
+            tallies.setdefault(name, [0, 0, 0, 0])[rank - 1] = count
+        return tallies
+
+    @staticmethod
+    def _duplicate_field(error: IntegrityError) -> Optional[str]:
+        """Returns the field named by the violated unique constraint, if the driver reports it."""
+        message = str(error.orig)
+        for pattern in _UNIQUE_VIOLATION_PATTERNS:
+            match = pattern.search(message)
+            if match is None:
+                continue
+            constraint = match.group(1)
+            # The composite constraint is only hit when both fields are duplicates
+            if "orcid" in constraint:
+                return "orcid_id"
+            if "email" in constraint:
+                return "email"
+        return None
+
+    @staticmethod
+    def _existing_field(session, voter: Voter) -> Optional[str]:
+        """Returns the field of the vote that is already in the votes table, None if the voter has not voted."""
+        if session.query(VoteModel.orcid_id).filter_by(orcid_id=voter.orcid_id).first() is not None:
+            return "orcid_id"
+        if session.query(VoteModel.email).filter_by(email=normalize_email(voter.email)).first() is not None:
+            return "email"
+        return None
+
+    def _find_duplicate_field(self, session, voter: Voter) -> str:
+        """Looks up which field of the vote is a duplicate when the driver does not report it."""
+        return self._existing_field(session=session, voter=voter) or "email"
+
+    def warm_voter_index(self, only_if_missing: bool = False) -> int:
+        """Builds the voter index from the votes table, returns the number of voters in it."""
+        if only_if_missing and voter_index.exists:
+            return 0
+        try:
+            with session_scope() as session:
+                return voter_index.rebuild(session.query(VoteModel.email, VoteModel.orcid_id).yield_per(10000))
+        except Exception as e:
+            raise DBException(f"An error occurred while building the voter index: {e}")
+
+    def record_vote(self, voter: Voter) -> None:
+        """Appends the vote to the ballot journal and to the vote log."""
+        # Populate the voter's selections
+        voter.prepare_data(self._candidates_by_name)
+
+        # Append the vote to the journal, this returns once the vote is on disk
+        with metrics.time("journal"):
+            ballot_journal.append(self._ballot_record(voter))
+
+        # Append the vote to the log, the record is written by the log pipeline
+        vote_logger.info(
+            f"New vote submited: {voter.full_name}, {voter.email}, {voter.orcid_id}, {[candidate.name for candidate in voter.selections_list]}, vote timestamp: {voter.timestamp}, ballot ID: {voter.ballot_id}",
+            extra={"ballot_id": voter.ballot_id, "orcid_id": voter.orcid_id, "selections": voter.selections},
         )
 
     @property
-    def candidates(self) -> List[Candidate]:
-        """Returns the list of candidates."""
+    def candidates(self) -> Tuple[Candidate, ...]:
+        """Returns the tuple of candidates."""
         return self._candidates
+
+
+# The replayer adds the buffered ballots through the voting system
+ballot_buffer.init_replay(lambda ballots: VotingSystem().record_buffered_votes(ballots))
+vote_batcher.init_flush(lambda voters: VotingSystem().insert_group(voters))
@@ -14,6 +14,10 @@
 import argparse
 import subprocess
 from sees_voting_app import create_flask_app
+from sees_voting_app.bootstrap import run_bootstrap
+from sees_voting_app.export import EXPORT_FORMATS, export_ballots
+from sees_voting_app.reconcile import reconcile
+from sees_voting_app.tally import run_tally
 from sees_voting_app.utils import combine_results
 
 
@@ -26,11 +30,56 @@ def main() -> None:
     parser = argparse.ArgumentParser(description="SEES Voting App")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("-r", "--results", action="store_true", help="Combine results and generate a results.csv file.")
+    parser.add_argument(
+        "-i", "--incremental", action="store_true", help="Only append the votes that are not already in the responses.csv file."
+    )
+    parser.add_argument(
+        "-t",
+        "--tally",
+        choices=["irv", "stv", "meek", "borda", "first"],
+        help="Count the ballots with instant-runoff, single transferable vote (Gregory or Meek transfers), Borda or first preferences.",
+    )
+    parser.add_argument("--seats", type=int, default=1, help="Number of seats filled by the single transferable vote.")
+    parser.add_argument(
+        "-b", "--bootstrap", type=int, metavar="REPLICATES", help="Resample the ballots and count them again to estimate the win probabilities."
+    )
+    parser.add_argument("--workers", type=int, help="Number of processes of the bootstrap, all the CPUs by default.")
+    parser.add_argument("--seed", type=int, help="Seed of the bootstrap resampling.")
+    parser.add_argument(
+        "--source", choices=["db", "csv", "journal"], default="db", help="Read the ballots from the database, the responses.csv file or the ballot journal."
+    )
+    parser.add_argument(
+        "-e", "--export", choices=sorted(EXPORT_FORMATS), help="Export the ballots of the database to data/ballots.parquet, .arrow or .csv."
+    )
+    parser.add_argument("-o", "--output", help="Path of the exported file or of the reconciliation report.")
+    parser.add_argument(
+        "--reconcile", action="store_true", help="Compare the ballot files, the database and the vote log and write data/reconciliation.csv."
+    )
+    parser.add_argument("--repair", action="store_true", help="Add the ballots missing from the database from the ballot files.")
     args = parser.parse_args()
 
     # Combine results and generate a results.csv file
     if args.results:
-        combine_results()
+        merged_votes = combine_results(incremental=args.incremental)
+        print(f"Combined {merged_votes} new votes into the results file.")
+    # Stream the ballots of the database to a Parquet, Arrow or CSV file
+    elif args.export:
+        exported_votes = export_ballots(fmt=args.export, path=args.output)
+        print(f"Exported {exported_votes} ballots.")
+    # Reconcile the three records of the ballots and print the number of ORCID iDs with each issue
+    elif args.reconcile:
+        for issue, count in reconcile(report_path=args.output, repair=args.repair).items():
+            print(f"{issue}: {count}")
+    # Resample the ballots and print the win probabilities and the margin of victory
+    elif args.bootstrap:
+        print(
+            run_bootstrap(
+                method=args.tally or "irv", source=args.source, replicates=args.bootstrap, seats=args.seats, workers=args.workers, seed=args.seed
+            )
+        )
+    # Count the ballots and print the round-by-round table
+    elif args.tally:
+        print(run_tally(method=args.tally, source=args.source, seats=args.seats))
     # Run the Flask app
     elif args.debug:
         app.run(host="0.0.0.0", port=5000, debug=True)